@@ -23,6 +23,7 @@ export class ChatTablesConstruct extends Construct {
 
   public readonly byUserIdIndex: string = "byUserId";
   public readonly bySessionIdIndex: string = "bySessionId";
+  public readonly bySessionIdTimestampIndex: string = "bySessionIdTimestamp";
   public readonly byTimestampIndex: string = "byTimestamp";
 
   constructor(scope: Construct, id: string) {
@@ -75,6 +76,16 @@ export class ChatTablesConstruct extends Construct {
       indexName: this.bySessionIdIndex,
       partitionKey: { name: "sessionId", type: dynamodb.AttributeType.STRING },
     });
+    // Sorted by creation time so the latest messages of a session can be
+    // queried newest first with a limit, only the attributes of the chat
+    // history are projected
+    messagesTable.addGlobalSecondaryIndex({
+      indexName: this.bySessionIdTimestampIndex,
+      partitionKey: sessionIdAttr,
+      sortKey: timestampAttr,
+      projectionType: dynamodb.ProjectionType.INCLUDE,
+      nonKeyAttributes: ["role", "content", "entryType", "customMessageId", "additional_kwargs"],
+    });
 
     const promptTable = new DynamoDBTable(this, "Prompt", groupNameAttr2, sortKeyAttr).table;
     const intentionTable = new DynamoDBTable(this, "Intention", groupNameAttr, intentionIdAttr).table;
@@ -191,6 +191,13 @@ export class ModelConstruct extends NestedStack implements ModelConstructOutputs
     let knowledgeBaseModelEcrImageTag = props.config.knowledgeBase.knowledgeBaseType.intelliAgentKb.knowledgeBaseModel.ecrImageTag;
     let knowledgeBaseModelImageUrl = this.modelAccount + ".dkr.ecr." + this.modelRegion + this.modelImageUrlDomain + knowledgeBaseModelEcrRepository + ":" + knowledgeBaseModelEcrImageTag;
 
+    // The ETL job lists this output prefix while it waits for results, expire
+    // the outputs so the listing stays small
+    props.sharedConstructOutputs.resultBucket.addLifecycleRule({
+      prefix: `${knowledgeBaseModelName}/`,
+      expiration: Duration.days(1),
+    });
+
     const knowledgeBaseModelResources = this.deploySagemakerEndpoint({
       modelProps: {
         modelName: knowledgeBaseModelName,
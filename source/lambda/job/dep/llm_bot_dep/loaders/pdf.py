@@ -3,8 +3,13 @@ import json
 import logging
 import os
 import re
+import tempfile
+import threading
 import time
 import uuid
+from concurrent.futures import Future, wait
+from typing import List
+from urllib.parse import urlparse
 
 import botocore
 from langchain.docstore.document import Document
@@ -21,6 +26,14 @@ logger = logging.getLogger(__name__)
 # Max retry is 2 hours
 _S3_FETCH_MAX_RETRY = 3600
 _S3_FETCH_WAIT_TIME = 5
+# ETL inferences a client keeps submitted to the endpoint at once
+_ETL_MAX_IN_FLIGHT = 32
+# Keys per DeleteObjects request
+_S3_DELETE_BATCH_SIZE = 1000
+# Blocks set this much larger than the body text are headings in native mode
+_HEADING_SIZE_RATIO = 1.15
+_MAX_HEADING_LENGTH = 100
+_MAX_HEADING_LEVEL = 3
 
 metadata_template = {
     "content_type": "paragraph",
@@ -48,6 +61,208 @@ def detect_language(input):
         return "en"
 
 
+class AsyncETLClient:
+    """
+    Submits PDFs to the async ETL endpoint and resolves the outstanding
+    inferences from one background poller. Every poll interval the poller
+    lists the output and failure prefixes of the endpoint once for all
+    outstanding inferences instead of checking each output object, the
+    outputs expire through a lifecycle rule so the prefixes stay small.
+    At most max_in_flight inferences are submitted at once, submit blocks
+    until an earlier one is resolved.
+
+    Args:
+        s3_client: The S3 client used to upload requests and list outputs.
+        smr_client: The SageMaker Runtime client.
+        etl_model_endpoint (str): The name of the async ETL endpoint.
+        res_bucket (str): The bucket the inference requests are uploaded to.
+        poll_interval (float): Seconds between two polls.
+        timeout (float): Seconds after which an inference is failed.
+        max_in_flight (int): The maximum number of outstanding inferences.
+    """
+
+    def __init__(
+        self,
+        s3_client: "botocore.client.S3",
+        smr_client: "botocore.client.SageMakerRuntime",
+        etl_model_endpoint: str,
+        res_bucket: str,
+        poll_interval: float = _S3_FETCH_WAIT_TIME,
+        timeout: float = _S3_FETCH_MAX_RETRY * _S3_FETCH_WAIT_TIME,
+        max_in_flight: int = _ETL_MAX_IN_FLIGHT,
+    ):
+        self.s3_client = s3_client
+        self.smr_client = smr_client
+        self.etl_model_endpoint = etl_model_endpoint
+        self.res_bucket = res_bucket
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        # inference id -> (output location, failure location, future, deadline)
+        self._outstanding = {}
+        self._lock = threading.Lock()
+        self._poller = None
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+
+    def submit(
+        self,
+        bucket: str,
+        key: str,
+        portal_bucket_name: str,
+        mode: str = "ppstructure",
+        lang: str = "zh",
+    ) -> Future:
+        """
+        Submits one PDF to the endpoint.
+
+        Returns:
+            Future: Resolves to the destination prefix of the markdown.
+        """
+        self._in_flight.acquire()
+        try:
+            json_data = {
+                "s3_bucket": bucket,
+                "object_key": key,
+                "destination_bucket": self.res_bucket,
+                "portal_bucket": portal_bucket_name,
+                "mode": mode,
+                "lang": lang,
+            }
+            file_name = f"data_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex}.json"
+            s3_file_path = "etl_pdf_inference/" + file_name
+            self.s3_client.put_object(
+                Bucket=self.res_bucket, Key=s3_file_path, Body=json.dumps(json_data)
+            )
+            logger.info(f"JSON data uploaded to S3 bucket: {self.res_bucket}/{s3_file_path}")
+
+            response = self.smr_client.invoke_endpoint_async(
+                EndpointName=self.etl_model_endpoint,
+                ContentType="application/json",
+                InputLocation=f"s3://{self.res_bucket}/{s3_file_path}",
+            )
+            logger.info(f"ETL inference {response['InferenceId']} submitted for s3://{bucket}/{key}")
+        except Exception:
+            self._in_flight.release()
+            raise
+
+        future = Future()
+        future.add_done_callback(lambda _: self._in_flight.release())
+        with self._lock:
+            self._outstanding[response["InferenceId"]] = (
+                response["OutputLocation"],
+                response.get("FailureLocation"),
+                future,
+                time.time() + self.timeout,
+            )
+            if self._poller is None:
+                self._poller = threading.Thread(
+                    target=self._poll, name="etl-poller", daemon=True
+                )
+                self._poller.start()
+        return future
+
+    def _list_keys(self, bucket: str, prefix: str) -> set:
+        keys = set()
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            keys.update(item["Key"] for item in page.get("Contents", []))
+        return keys
+
+    def _existing_locations(self, locations: List[str]) -> set:
+        """Returns the S3 URIs of locations which exist, with one listing per prefix."""
+        locations_by_prefix = {}
+        for location in locations:
+            parsed = urlparse(location)
+            prefix = os.path.dirname(parsed.path.lstrip("/"))
+            locations_by_prefix.setdefault((parsed.netloc, prefix), []).append(location)
+
+        existing = set()
+        for (bucket, prefix), prefix_locations in locations_by_prefix.items():
+            keys = self._list_keys(bucket, prefix + "/" if prefix else "")
+            existing.update(
+                location for location in prefix_locations
+                if urlparse(location).path.lstrip("/") in keys
+            )
+        return existing
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                outstanding = dict(self._outstanding)
+            try:
+                locations = [item[0] for item in outstanding.values()]
+                locations += [item[1] for item in outstanding.values() if item[1]]
+                existing = self._existing_locations(locations)
+            except Exception as e:
+                logger.warning(f"Failed to poll ETL outputs: {e}")
+                existing = set()
+
+            done = {}
+            for inference_id, (output_location, failure_location, future, deadline) in outstanding.items():
+                try:
+                    if output_location in existing:
+                        logger.info(f"ETL inference {inference_id} completed")
+                        output = json.load(smart_open(output_location))
+                        done[inference_id] = (future, output["destination_prefix"], None)
+                    elif failure_location in existing:
+                        with smart_open(failure_location) as f:
+                            error = f.read()
+                        done[inference_id] = (
+                            future, None, Exception(f"ETL inference {inference_id} failed: {error}")
+                        )
+                    elif time.time() > deadline:
+                        done[inference_id] = (
+                            future,
+                            None,
+                            Exception(
+                                "Unable to fetch ETL inference result, and the number of retries reached."
+                            ),
+                        )
+                except Exception as e:
+                    done[inference_id] = (future, None, e)
+
+            with self._lock:
+                for inference_id in done:
+                    del self._outstanding[inference_id]
+                stop = not self._outstanding
+                if stop:
+                    self._poller = None
+            for future, result, error in done.values():
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+            if done or stop:
+                logger.info(f"Waiting for {len(outstanding) - len(done)} ETL outputs...")
+            if stop:
+                return
+
+
+_etl_clients = {}
+_etl_clients_lock = threading.Lock()
+
+
+def get_etl_client(
+    s3_client: "botocore.client.S3",
+    smr_client: "botocore.client.SageMakerRuntime",
+    etl_model_endpoint: str,
+    res_bucket: str,
+    max_in_flight: int = _ETL_MAX_IN_FLIGHT,
+) -> AsyncETLClient:
+    """Returns the AsyncETLClient shared by all callers of the endpoint."""
+    with _etl_clients_lock:
+        client_key = (etl_model_endpoint, res_bucket)
+        if client_key not in _etl_clients:
+            _etl_clients[client_key] = AsyncETLClient(
+                s3_client,
+                smr_client,
+                etl_model_endpoint,
+                res_bucket,
+                max_in_flight=max_in_flight,
+            )
+        return _etl_clients[client_key]
+
+
 def invoke_etl_model(
     s3_client: "botocore.client.S3",
     smr_client: "botocore.client.SageMakerRuntime",
@@ -58,50 +273,13 @@ def invoke_etl_model(
     portal_bucket_name: str,
     mode: str = "ppstructure",
     lang: str = "zh",
+    max_in_flight: int = _ETL_MAX_IN_FLIGHT,
 ):
-    json_data = {
-        "s3_bucket": bucket,
-        "object_key": key,
-        "destination_bucket": res_bucket,
-        "portal_bucket": portal_bucket_name,
-        "mode": mode,
-        "lang": lang,
-    }
-
-    file_name = f"data_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex}.json"
-    with open(file_name, "w") as json_file:
-        json.dump(json_data, json_file)
-
-    s3_file_path = "etl_pdf_inference/" + file_name
-    # Upload the file to S3
-    s3_client.upload_file(file_name, res_bucket, s3_file_path)
-    logger.info(f"JSON data uploaded to S3 bucket: {res_bucket}/{s3_file_path}")
-
-    response = smr_client.invoke_endpoint_async(
-        EndpointName=etl_model_endpoint,
-        ContentType="application/json",
-        InputLocation=f"s3://{res_bucket}/{s3_file_path}",
-    )
-    logger.info("This is the async response:")
-    logger.info(response)
-    inference_id = response["InferenceId"]
-    output_location = response["OutputLocation"]
-
-    fetch_count = 0
-    while fetch_count < _S3_FETCH_MAX_RETRY:
-        if _s3_uri_exist(s3_client, output_location):
-            logger.info("ETL inference completed")
-            output = json.load(smart_open(output_location))
-
-            return output["destination_prefix"]
-        else:
-            logger.info("Waiting for ETL output...")
-            fetch_count = fetch_count + 1
-            time.sleep(_S3_FETCH_WAIT_TIME)
-
-    raise Exception(
-        "Unable to fetch ETL inference result, and the number of retries reached."
+    etl_client = get_etl_client(
+        s3_client, smr_client, etl_model_endpoint, res_bucket, max_in_flight
     )
+    future = etl_client.submit(bucket, key, portal_bucket_name, mode=mode, lang=lang)
+    return future.result()
 
 
 def load_content_from_s3(s3, bucket, key):
@@ -113,18 +291,191 @@ def load_content_from_s3(s3, bucket, key):
     return obj["Body"].read().decode("utf-8")
 
 
+def _import_fitz():
+    try:
+        import fitz
+    except ImportError:
+        raise ImportError(
+            "PyMuPDF is not installed, please install it with `pip install pymupdf`."
+        )
+    return fitz
+
+
+def extract_native_text_blocks(local_path: str) -> List[List[tuple]]:
+    """
+    Extracts the text layer of each page of a PDF with PyMuPDF.
+
+    Returns:
+    list[list[tuple]]: The (text, font size) of the text blocks of each page, empty for pages without text layer.
+    """
+    fitz = _import_fitz()
+    pages = []
+    with fitz.open(local_path) as pdf_document:
+        for page in pdf_document:
+            blocks = []
+            for block in page.get_text("dict")["blocks"]:
+                # Type 1 blocks are images
+                if block.get("type", 0) != 0:
+                    continue
+                # Lines are grouped while their font size stays the same, so a
+                # heading sharing a block with body text is kept apart
+                lines, size = [], None
+                for line in block["lines"]:
+                    line_text = "".join(span["text"] for span in line["spans"]).strip()
+                    if not line_text:
+                        continue
+                    line_size = round(max(span["size"] for span in line["spans"]), 1)
+                    if lines and line_size != size:
+                        blocks.append((" ".join(lines), size))
+                        lines = []
+                    lines.append(line_text)
+                    size = line_size
+                if lines:
+                    blocks.append((" ".join(lines), size))
+            pages.append(blocks)
+    return pages
+
+
+def native_blocks_to_markdown(pages: List[List[tuple]]) -> List[str]:
+    """
+    Converts the text blocks of each page to markdown. The font size covering
+    most characters is taken as the body size, short blocks set noticeably
+    larger become headings, the larger the font the higher the level.
+
+    Returns:
+    list[str]: The markdown of each page.
+    """
+    size_counts = {}
+    for blocks in pages:
+        for text, size in blocks:
+            size_counts[size] = size_counts.get(size, 0) + len(text)
+    if not size_counts:
+        return ["" for _ in pages]
+    body_size = max(size_counts, key=size_counts.get)
+
+    def is_heading(text, size):
+        return size > body_size * _HEADING_SIZE_RATIO and len(text) <= _MAX_HEADING_LENGTH
+
+    heading_sizes = sorted(
+        {size for blocks in pages for text, size in blocks if is_heading(text, size)},
+        reverse=True,
+    )
+    heading_levels = {
+        size: min(level, _MAX_HEADING_LEVEL)
+        for level, size in enumerate(heading_sizes, start=1)
+    }
+
+    markdown_pages = []
+    for blocks in pages:
+        lines = []
+        for text, size in blocks:
+            if is_heading(text, size):
+                lines.append("#" * heading_levels[size] + " " + text)
+            else:
+                lines.append(text)
+        markdown_pages.append("\n\n".join(lines))
+    return markdown_pages
+
+
+def process_pdf_native(
+    s3,
+    local_path: str,
+    key: str,
+    etl_client: AsyncETLClient = None,
+    portal_bucket_name: str = None,
+    lang: str = "zh",
+) -> str:
+    """
+    Converts a born-digital PDF to markdown from its text layer, skipping OCR.
+    Consecutive pages without text layer, such as scanned pages, are cut into
+    sub PDFs and sent to the ETL endpoint concurrently when etl_client is
+    given, otherwise they are skipped.
+
+    Returns:
+    str: The markdown of the PDF.
+    """
+    pages = extract_native_text_blocks(local_path)
+    markdown_pages = native_blocks_to_markdown(pages)
+
+    # (first page, last page) of each run of pages without text layer
+    empty_runs = []
+    for page_index, blocks in enumerate(pages):
+        if blocks:
+            continue
+        if empty_runs and empty_runs[-1][1] == page_index - 1:
+            empty_runs[-1] = (empty_runs[-1][0], page_index)
+        else:
+            empty_runs.append((page_index, page_index))
+    logger.info(
+        f"{len(pages) - sum(end - start + 1 for start, end in empty_runs)} of "
+        f"{len(pages)} pages have a text layer"
+    )
+
+    if empty_runs and etl_client is None:
+        logger.warning(
+            f"No ETL model endpoint provided, skipping {len(empty_runs)} page ranges without text layer"
+        )
+        empty_runs = []
+    if empty_runs:
+        fitz = _import_fitz()
+        file_stem = os.path.splitext(os.path.basename(key))[0]
+        run_prefix = f"etl_pdf_inference/pages/{uuid.uuid4().hex}"
+        futures = {}
+        sub_keys = []
+        try:
+            with fitz.open(local_path) as pdf_document:
+                for start, end in empty_runs:
+                    sub_document = fitz.open()
+                    sub_document.insert_pdf(pdf_document, from_page=start, to_page=end)
+                    sub_key = f"{run_prefix}/{file_stem}-{start + 1}-{end + 1}.pdf"
+                    s3.put_object(
+                        Bucket=etl_client.res_bucket, Key=sub_key, Body=sub_document.tobytes()
+                    )
+                    sub_keys.append(sub_key)
+                    sub_document.close()
+                    futures[start] = etl_client.submit(
+                        etl_client.res_bucket, sub_key, portal_bucket_name, lang=lang
+                    )
+            for start, future in futures.items():
+                markdown_prefix = future.result()
+                markdown_pages[start] = load_content_from_s3(
+                    s3, etl_client.res_bucket, markdown_prefix
+                )
+        finally:
+            # Wait for every submitted inference before removing its input
+            wait(list(futures.values()))
+            for start in range(0, len(sub_keys), _S3_DELETE_BATCH_SIZE):
+                s3.delete_objects(
+                    Bucket=etl_client.res_bucket,
+                    Delete={
+                        "Objects": [
+                            {"Key": sub_key}
+                            for sub_key in sub_keys[start:start + _S3_DELETE_BATCH_SIZE]
+                        ]
+                    },
+                )
+
+    return "\n\n".join(page for page in markdown_pages if page)
+
+
 def process_pdf(s3, pdf: bytes, **kwargs):
     """
     Process a given PDF file and extracts structured information from it.
 
-    This function reads a PDF file, converts it to HTML using PDFMiner, then extracts
-    and structures the information into a list of dictionaries containing headings and content.
+    The extraction strategy is decided first and the PDF is only parsed
+    locally when the strategy needs it:
+    - native: the text layer is read with PyMuPDF, pages without text layer
+      go through the ETL model endpoint if one is provided.
+    - auto: the ETL model endpoint if one is provided, otherwise the PDF is
+      converted to HTML using PDFMiner.
 
     Parameters:
     s3 (boto3.client): The S3 client to use for downloading the PDF file.
     pdf (bytes): The PDF file to process.
     **kwargs: Arbitrary keyword arguments. The function expects 'bucket' and 'key' among the kwargs
-              to specify the S3 bucket and key where the PDF file is located.
+              to specify the S3 bucket and key where the PDF file is located, 'pdf_extraction_mode'
+              to choose the strategy, 'auto' by default, and 'etl_max_in_flight' to limit the
+              inferences submitted to the ETL model endpoint at once.
 
     Returns:
     list[Document]: A list of Document objects, each representing a semantically grouped section of the PDF file. Each Document object contains a metadata defined in metadata_template, and page_content string with the text content of that section.
@@ -139,67 +490,76 @@ def process_pdf(s3, pdf: bytes, **kwargs):
     portal_bucket_name = kwargs.get("portal_bucket_name", None)
     # TODO: make it configurable in frontend
     document_language = kwargs.get("document_language", "zh")
-    # Extract file name also in consideration of file name with blank space
-    local_path = str(os.path.basename(key))
-    # Download to local for further processing
-    logger.info(local_path)
-    s3.download_file(Bucket=bucket, Key=key, Filename=local_path)
-    loader = PDFMinerPDFasHTMLLoader(local_path)
-    # Entire PDF is loaded as a single Document
-    file_content = loader.load()[0].page_content
-
-    if not etl_model_endpoint or not smr_client or not res_bucket:
-        logger.info(
-            "No ETL model endpoint or SageMaker Runtime client provided, using default PDF loader..."
-        )
-        loader = CustomHtmlLoader(aws_path=f"s3://{bucket}/{key}")
-        doc = loader.load(file_content)
-        splitter = MarkdownHeaderTextSplitter(res_bucket)
-        doc_list = splitter.split_text(doc)
-
-        for doc in doc_list:
-            doc.metadata["file_path"] = f"s3://{bucket}/{key}"
-            doc.metadata["file_type"] = "pdf"
-    else:
-        if document_language == "zh":
-            logger.info("Detected language is Chinese, using default PDF loader...")
-            markdown_prefix = invoke_etl_model(
-                s3,
-                smr_client,
-                etl_model_endpoint,
-                bucket,
-                key,
-                res_bucket,
-                portal_bucket_name,
-                mode="ppstructure",
-                lang="zh",
-            )
-            logger.info(f"Markdown file path: s3://{res_bucket}/{markdown_prefix}")
-            content = load_content_from_s3(s3, res_bucket, markdown_prefix)
-        else:
-            logger.info("Detected language is English, using ETL model endpoint...")
-            markdown_prefix = invoke_etl_model(
-                s3,
-                smr_client,
-                etl_model_endpoint,
-                bucket,
-                key,
-                res_bucket,
-                portal_bucket_name,
-                mode="ppstructure",
-                lang="en",
-            )
-            logger.info(f"Markdown file path: s3://{res_bucket}/{markdown_prefix}")
-            content = load_content_from_s3(s3, res_bucket, markdown_prefix)
+    pdf_extraction_mode = kwargs.get("pdf_extraction_mode", "auto")
+    etl_max_in_flight = kwargs.get("etl_max_in_flight", _ETL_MAX_IN_FLIGHT)
+    lang = "zh" if document_language == "zh" else "en"
+    use_etl_model = bool(etl_model_endpoint and smr_client and res_bucket)
 
-        # Remove duplicate sections
-        content = remove_duplicate_sections(content)
+    if pdf_extraction_mode == "native" or not use_etl_model:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Extract file name also in consideration of file name with blank space
+            local_path = os.path.join(tmp_dir, os.path.basename(key))
+            if pdf:
+                with open(local_path, "wb") as f:
+                    f.write(pdf)
+            else:
+                s3.download_file(Bucket=bucket, Key=key, Filename=local_path)
 
-        metadata = {"file_path": f"s3://{bucket}/{key}", "file_type": "pdf"}
+            if pdf_extraction_mode == "native":
+                logger.info("Using the PDF text layer...")
+                etl_client = None
+                if use_etl_model:
+                    etl_client = get_etl_client(
+                        s3,
+                        smr_client,
+                        etl_model_endpoint,
+                        res_bucket,
+                        etl_max_in_flight,
+                    )
+                content = process_pdf_native(
+                    s3, local_path, key, etl_client, portal_bucket_name, lang
+                )
+            else:
+                logger.info(
+                    "No ETL model endpoint or SageMaker Runtime client provided, using default PDF loader..."
+                )
+                loader = PDFMinerPDFasHTMLLoader(local_path)
+                # Entire PDF is loaded as a single Document
+                file_content = loader.load()[0].page_content
+                loader = CustomHtmlLoader(aws_path=f"s3://{bucket}/{key}")
+                doc = loader.load(file_content)
+                splitter = MarkdownHeaderTextSplitter(res_bucket)
+                doc_list = splitter.split_text(doc)
 
-        markdown_splitter = MarkdownHeaderTextSplitter(res_bucket)
-        doc_list = markdown_splitter.split_text(
-            Document(page_content=content, metadata=metadata)
+                for doc in doc_list:
+                    doc.metadata["file_path"] = f"s3://{bucket}/{key}"
+                    doc.metadata["file_type"] = "pdf"
+                return doc_list
+    else:
+        logger.info(f"Using ETL model endpoint with language {lang}...")
+        markdown_prefix = invoke_etl_model(
+            s3,
+            smr_client,
+            etl_model_endpoint,
+            bucket,
+            key,
+            res_bucket,
+            portal_bucket_name,
+            mode="ppstructure",
+            lang=lang,
+            max_in_flight=etl_max_in_flight,
         )
+        logger.info(f"Markdown file path: s3://{res_bucket}/{markdown_prefix}")
+        content = load_content_from_s3(s3, res_bucket, markdown_prefix)
+
+    # Remove duplicate sections
+    content = remove_duplicate_sections(content)
+
+    metadata = {"file_path": f"s3://{bucket}/{key}", "file_type": "pdf"}
+
+    markdown_splitter = MarkdownHeaderTextSplitter(res_bucket)
+    doc_list = markdown_splitter.split_text(
+        Document(page_content=content, metadata=metadata)
+    )
 
     return doc_list
@@ -3,9 +3,11 @@ from __future__ import annotations
 import copy
 import math
 import re
+import threading
 import traceback
 import uuid
 import warnings
+from contextlib import contextmanager
 from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 import numpy as np
@@ -94,6 +96,20 @@ def _is_aoss_enabled(http_auth: Any) -> bool:
     return False
 
 
+def _ensure_index(client: Any, index_name: str, mapping: Dict) -> None:
+    """Create the index with mapping if it does not exist."""
+    not_found_error = _import_not_found_error()
+    try:
+        client.indices.get(index=index_name)
+    except not_found_error:
+        try:
+            client.indices.create(index=index_name, body=mapping)
+        except Exception as error:
+            # Another writer created the index in the meantime
+            if "resource_already_exists_exception" not in str(error):
+                raise
+
+
 def _bulk_ingest_embeddings(
     client: Any,
     index_name: str,
@@ -107,21 +123,23 @@ def _bulk_ingest_embeddings(
     max_chunk_bytes: Optional[int] = 1 * 1024 * 1024,
     is_aoss: bool = False,
     max_retry_time: int = 3,
+    ensure_index: bool = True,
+    refresh: bool = True,
 ) -> List[str]:
-    """Bulk Ingest Embeddings into given index."""
+    """Bulk Ingest Embeddings into given index.
+
+    ensure_index and refresh can be turned off when the caller already
+    verified the index and refreshes once at the end of an ingestion session.
+    """
     if not mapping:
         mapping = dict()
 
     bulk = _import_bulk()
-    not_found_error = _import_not_found_error()
     requests = []
     return_ids = []
-    mapping = mapping
 
-    try:
-        client.indices.get(index=index_name)
-    except not_found_error:
-        client.indices.create(index=index_name, body=mapping)
+    if ensure_index:
+        _ensure_index(client, index_name, mapping)
 
     for i, text in enumerate(texts):
         metadata = metadatas[i] if metadatas else {}
@@ -151,7 +169,9 @@ def _bulk_ingest_embeddings(
             traceback.print_exc()
             print(f"retry bulk {retry_time}", error)
             retry_time += 1
-    if not is_aoss:
+            if retry_time == max_retry_time:
+                raise
+    if refresh and not is_aoss:
         client.indices.refresh(index=index_name)
     return return_ids
 
@@ -164,21 +184,19 @@ def _bulk_ingest_data(
     mapping: Optional[Dict] = None,
     max_chunk_bytes: Optional[int] = 1 * 1024 * 1024,
     is_aoss: bool = False,
+    ensure_index: bool = True,
+    refresh: bool = True,
 ) -> List[str]:
     """Bulk Ingest Embeddings into given index."""
     if not mapping:
         mapping = dict()
 
     bulk = _import_bulk()
-    not_found_error = _import_not_found_error()
     requests = []
     return_ids = []
-    mapping = mapping
 
-    try:
-        client.indices.get(index=index_name)
-    except not_found_error:
-        client.indices.create(index=index_name, body=mapping)
+    if ensure_index:
+        _ensure_index(client, index_name, mapping)
 
     for i, data in enumerate(data_list):
         _id = ids[i] if ids else str(uuid.uuid4())
@@ -194,7 +212,7 @@ def _bulk_ingest_data(
         requests.append(request)
         return_ids.append(_id)
     bulk(client, requests, max_chunk_bytes=max_chunk_bytes)
-    if not is_aoss:
+    if refresh and not is_aoss:
         client.indices.refresh(index=index_name)
     return return_ids
 
@@ -512,11 +530,108 @@ class OpenSearchVectorSearch(VectorStore):
         self.is_aoss = _is_aoss_enabled(http_auth=http_auth)
         self.client = _get_opensearch_client(opensearch_url, **kwargs)
         self.engine = _get_kwargs_value(kwargs, "engine", None)
+        self._ingestion_session = None
+        self._ingestion_session_lock = threading.Lock()
 
     @property
     def embeddings(self) -> Embeddings:
         return self.embedding_function
 
+    def start_ingestion_session(
+        self, disable_refresh: bool = False, disable_replicas: bool = False
+    ) -> None:
+        """Start an ingestion session for a bulk loading job.
+
+        Within the session every index is verified or created once instead of
+        before each bulk, and bulks are sent without refresh, the indexes are
+        refreshed once by end_ingestion_session. Optionally the refresh
+        interval and the replica count of the index are switched off until
+        end_ingestion_session restores them. Other jobs writing the same index
+        at the same time see these settings too, so only turn them on when a
+        single job ingests into the index.
+
+        Args:
+            disable_refresh: Set refresh_interval to -1 during the session.
+            disable_replicas: Set number_of_replicas to 0 during the session.
+        """
+        with self._ingestion_session_lock:
+            if self._ingestion_session is not None:
+                raise RuntimeError("An ingestion session is already running")
+            self._ingestion_session = {
+                "disable_refresh": disable_refresh,
+                "disable_replicas": disable_replicas,
+                # index_name -> settings to restore
+                "indexes": {},
+            }
+
+    def end_ingestion_session(self) -> None:
+        """Restore the index settings and refresh the indexes of the session."""
+        with self._ingestion_session_lock:
+            session = self._ingestion_session
+            self._ingestion_session = None
+        if session is None or self.is_aoss:
+            return
+        for index_name, original_settings in session["indexes"].items():
+            try:
+                if original_settings:
+                    self.client.indices.put_settings(
+                        index=index_name, body={"index": original_settings}
+                    )
+                self.client.indices.refresh(index=index_name)
+            except Exception as error:
+                traceback.print_exc()
+                print(f"failed to finish ingestion session of {index_name}", error)
+
+    @contextmanager
+    def ingestion_session(
+        self, disable_refresh: bool = False, disable_replicas: bool = False
+    ):
+        """Context manager around start_ingestion_session and end_ingestion_session."""
+        self.start_ingestion_session(disable_refresh, disable_replicas)
+        try:
+            yield self
+        finally:
+            self.end_ingestion_session()
+
+    def _prepare_session_index(self, index_name: str, mapping: Dict) -> bool:
+        """Verify the index once per session and apply the session settings.
+
+        Returns:
+            bool: Whether an ingestion session is running.
+        """
+        with self._ingestion_session_lock:
+            session = self._ingestion_session
+            if session is None:
+                return False
+            if index_name in session["indexes"]:
+                return True
+
+            _ensure_index(self.client, index_name, mapping or dict())
+            original_settings = {}
+            if not self.is_aoss:
+                response = self.client.indices.get_settings(index=index_name)
+                index_settings = next(iter(response.values()))["settings"]["index"]
+                session_settings = {}
+                if session["disable_refresh"]:
+                    refresh_interval = index_settings.get("refresh_interval")
+                    # -1 is left by another session, never restore it, None
+                    # resets the index to the cluster default
+                    if refresh_interval == "-1":
+                        refresh_interval = None
+                    original_settings["refresh_interval"] = refresh_interval
+                    session_settings["refresh_interval"] = "-1"
+                if session["disable_replicas"]:
+                    original_settings["number_of_replicas"] = index_settings.get(
+                        "number_of_replicas"
+                    )
+                    session_settings["number_of_replicas"] = 0
+                if session_settings:
+                    self.client.indices.put_settings(
+                        index=index_name, body={"index": session_settings}
+                    )
+            session["indexes"][index_name] = original_settings
+            return True
+
     def add_documents(
         self, documents: List[Dict], ids: List[int], **kwargs: Any
     ) -> List[str]:
@@ -838,6 +953,20 @@ class OpenSearchVectorSearch(VectorStore):
         vector_field = _get_kwargs_value(kwargs, "vector_field", "vector_field")
         max_chunk_bytes = _get_kwargs_value(kwargs, "max_chunk_bytes", 1 * 1024 * 1024)
         mapping = _get_kwargs_value(kwargs, "mapping", None)
+        if not mapping:
+            # Same knn mapping as the langchain vector store creates
+            engine = _get_kwargs_value(kwargs, "engine", "nmslib")
+            _validate_aoss_with_engines(self.is_aoss, engine)
+            mapping = _default_text_mapping(
+                len(embeddings[0]),
+                engine,
+                _get_kwargs_value(kwargs, "space_type", "l2"),
+                _get_kwargs_value(kwargs, "ef_search", 512),
+                _get_kwargs_value(kwargs, "ef_construction", 512),
+                _get_kwargs_value(kwargs, "m", 16),
+                vector_field,
+            )
+        in_session = self._prepare_session_index(index_name, mapping)
 
         return _bulk_ingest_embeddings(
             self.client,
@@ -851,6 +980,8 @@ class OpenSearchVectorSearch(VectorStore):
             mapping=mapping,
             max_chunk_bytes=max_chunk_bytes,
             is_aoss=self.is_aoss,
+            ensure_index=not in_session,
+            refresh=not in_session,
         )
 
     def add_texts(
@@ -1,5 +1,7 @@
 import json
 import io
+import os
+import threading
 from typing import Any, Dict, Iterator, List, Mapping, Optional
 from langchain_community.llms import SagemakerEndpoint
 from langchain_community.llms.sagemaker_endpoint import LLMContentHandler
@@ -10,6 +12,7 @@ from langchain_community.llms.utils import enforce_stop_tokens
 from typing import Dict, List, Optional, Any,Iterator
 from langchain_core.outputs import GenerationChunk
 import boto3
+from botocore.config import Config
 from langchain_core.pydantic_v1 import Extra, root_validator
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.messages import (
@@ -20,6 +23,20 @@ import logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Clients and endpoint wrappers are created once per container and reused,
+# so every embedding and rerank call runs on a warm connection pool.
+runtime_client_config = Config(
+    max_pool_connections=int(os.environ.get("SM_MAX_POOL_CONNECTIONS", 50)),
+    tcp_keepalive=True,
+    retries={
+        "max_attempts": int(os.environ.get("SM_MAX_ATTEMPTS", 5)),
+        "mode": "adaptive",
+    },
+)
+_registry_lock = threading.Lock()
+_client_registry = {}
+_endpoint_registry = {}
+
 class vectorContentHandler(EmbeddingsContentHandler):
     content_type = "application/json"
     accepts = "application/json"
@@ -365,75 +382,110 @@ class SagemakerEndpointChat(BaseChatModel):
         return text
         
 
-def SagemakerEndpointVectorOrCross(prompt: str, endpoint_name: str, region_name: str, model_type: str, stop: List[str], target_model=None, **kwargs) -> SagemakerEndpoint:
-    """
-    original class invocation:
-        response = self.client.invoke_endpoint(
-            EndpointName=self.endpoint_name,
-            Body=body,
-            ContentType=content_type,
-            Accept=accepts,
-            **_endpoint_kwargs,
-        )
-    """
+def get_runtime_client(service_name: str, region_name: str = None):
+    """Get a pooled boto3 client, shared by all callers in the container."""
+    key = (service_name, region_name)
+    client = _client_registry.get(key)
+    if client is None:
+        with _registry_lock:
+            client = _client_registry.get(key)
+            if client is None:
+                client = boto3.client(
+                    service_name,
+                    region_name=region_name,
+                    config=runtime_client_config,
+                )
+                _client_registry[key] = client
+    return client
+
+
+def _create_endpoint_model(endpoint_name: str, region_name: str, model_type: str, target_model=None):
     if target_model:
         endpoint_kwargs={"TargetModel":target_model}
     else:
         endpoint_kwargs=None
-    client = boto3.client(
-            "sagemaker-runtime",
-            region_name=region_name
-        )
+    client = get_runtime_client("sagemaker-runtime", region_name)
     if model_type == "vector" or model_type == "bce":
         content_handler = vectorContentHandler()
-        embeddings = SagemakerEndpointEmbeddings(
+        return SagemakerEndpointEmbeddings(
             client=client,
             endpoint_name=endpoint_name,
             content_handler=content_handler,
             endpoint_kwargs=endpoint_kwargs
         )
-        query_result = embeddings.embed_query(prompt)
-        return query_result
-    elif model_type == "cross":
-        content_handler = crossContentHandler()
     elif model_type == "m3":
         content_handler = m3ContentHandler()
         model_kwargs = {}
         model_kwargs['batch_size'] = 12
         model_kwargs['max_length'] = 512
         model_kwargs['return_type'] = 'dense'
-        embeddings = SagemakerEndpointEmbeddings(
+        return SagemakerEndpointEmbeddings(
             client=client,
             endpoint_name=endpoint_name,
             content_handler=content_handler,
             model_kwargs=model_kwargs,
             endpoint_kwargs=endpoint_kwargs
         )
-        query_result = embeddings.embed_query(prompt)
-        return query_result
+    elif model_type == "cross":
+        content_handler = crossContentHandler()
     elif model_type == "answer":
         content_handler = answerContentHandler()
     elif model_type == "rerank":
         content_handler = rerankContentHandler()
+    else:
+        raise ValueError(f"invalid sagemaker model type: {model_type}")
     # TODO: replace with SagemakerEndpointStreaming
-    genericModel = SagemakerEndpoint(
+    return SagemakerEndpoint(
         client=client,
         endpoint_name = endpoint_name,
         # region_name = region_name,
         content_handler = content_handler,
         endpoint_kwargs=endpoint_kwargs
     )
-    return genericModel(prompt=prompt, stop=stop, **kwargs)
+
+
+def get_endpoint_model(endpoint_name: str, region_name: str, model_type: str, target_model=None):
+    """Get the cached endpoint wrapper for (endpoint, model_type, target_model, region)."""
+    key = (endpoint_name, model_type, target_model, region_name)
+    model = _endpoint_registry.get(key)
+    if model is None:
+        with _registry_lock:
+            model = _endpoint_registry.get(key)
+        if model is None:
+            model = _create_endpoint_model(
+                endpoint_name, region_name, model_type, target_model)
+            with _registry_lock:
+                model = _endpoint_registry.setdefault(key, model)
+    return model
+
+
+def SagemakerEndpointVectorOrCross(prompt: str, endpoint_name: str, region_name: str, model_type: str, stop: List[str], target_model=None, **kwargs) -> SagemakerEndpoint:
+    """
+    original class invocation:
+        response = self.client.invoke_endpoint(
+            EndpointName=self.endpoint_name,
+            Body=body,
+            ContentType=content_type,
+            Accept=accepts,
+            **_endpoint_kwargs,
+        )
+    """
+    model = get_endpoint_model(
+        endpoint_name, region_name, model_type, target_model)
+    if isinstance(model, SagemakerEndpointEmbeddings):
+        query_result = model.embed_query(prompt)
+        return query_result
+    return model(prompt=prompt, stop=stop, **kwargs)
 
 def getCustomEmbeddings(endpoint_name: str, region_name: str, model_type: str) -> SagemakerEndpointEmbeddings:
-    client = boto3.client(
-            "sagemaker-runtime",
-            region_name=region_name
-            )
-    bedrock_client = boto3.client("bedrock-runtime")
+    key = ("custom_embeddings", endpoint_name, model_type, region_name)
+    embeddings = _endpoint_registry.get(key)
+    if embeddings is not None:
+        return embeddings
+    client = get_runtime_client("sagemaker-runtime", region_name)
+    bedrock_client = get_runtime_client("bedrock-runtime")
     embeddings = None
     if model_type == "bedrock":
-        content_handler = BedrockEmbeddings()
         embeddings = BedrockEmbeddings(
             client=bedrock_client,
             region_name=region_name,
@@ -461,4 +513,6 @@ def getCustomEmbeddings(endpoint_name: str, region_name: str, model_type: str) -
             model_kwargs=model_kwargs,
             content_handler=content_handler,
         )
-    return embeddings
\ No newline at end of file
+    with _registry_lock:
+        embeddings = _endpoint_registry.setdefault(key, embeddings)
+    return embeddings
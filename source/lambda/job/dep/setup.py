@@ -19,6 +19,7 @@ setup(
         "python-docx==1.1.0",
         "nltk==3.9",
         "pdfminer.six==20221105",
+        "pymupdf==1.24.9",
         "smart-open==7.0.4",
     ],
 )
@@ -1,9 +1,14 @@
+import inspect
 import itertools
 import logging
 import os
+import queue
 import sys
 import json
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from typing import Generator, Iterable, List
 
@@ -12,10 +17,6 @@ import chardet
 import nltk
 from langchain.docstore.document import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import OpenSearchVectorSearch
-from langchain_community.vectorstores.opensearch_vector_search import (
-    OpenSearchVectorSearch,
-)
 from opensearchpy import RequestsHttpConnection
 from requests_aws4auth import AWS4Auth
 from tenacity import retry, stop_after_attempt, wait_exponential
@@ -88,6 +89,7 @@ except Exception as e:
 from llm_bot_dep import sm_utils
 from llm_bot_dep.constant import SplittingType
 from llm_bot_dep.loaders.auto import cb_process_object
+from llm_bot_dep.opensearch_vector_search import OpenSearchVectorSearch
 from llm_bot_dep.storage_utils import save_content_to_s3
 
 # Adaption to allow nougat to run in AWS Glue with writable /tmp
@@ -124,11 +126,71 @@ operation_type = args["OPERATION_TYPE"]
 aos_secret = args.get("AOS_SECRET_NAME", "opensearch-master-user")
 
 
+def get_optional_arg(name: str, default):
+    """getResolvedOptions only returns required arguments, so optional job
+    arguments are resolved here when they are passed, falling back to the
+    environment and then to the default value.
+    """
+    if name in args:
+        return args[name]
+    if f"--{name}" in sys.argv:
+        try:
+            return getResolvedOptions(sys.argv, [name])[name]
+        except Exception:
+            logger.warning("Failed to resolve job argument %s", name)
+    return os.environ.get(name, default)
+
+
+# Worker count of each ingestion pipeline stage and the size of the bounded
+# queues between the stages
+FETCH_WORKERS = int(get_optional_arg("FETCH_WORKERS", 4))
+PARSE_WORKERS = int(get_optional_arg("PARSE_WORKERS", 2))
+# The maximum number of inferences submitted to the ETL endpoint at once
+ETL_MAX_IN_FLIGHT = int(get_optional_arg("ETL_MAX_IN_FLIGHT", 32))
+# "auto" uses the ETL endpoint when configured and PDFMiner otherwise, "native"
+# reads the PDF text layer and only sends pages without one to the endpoint
+PDF_EXTRACTION_MODE = get_optional_arg("PDF_EXTRACTION_MODE", "auto")
+CHUNK_WORKERS = int(get_optional_arg("CHUNK_WORKERS", 2))
+EMBED_WORKERS = int(get_optional_arg("EMBED_WORKERS", 4))
+INDEX_WORKERS = int(get_optional_arg("INDEX_WORKERS", 2))
+S3_UPLOAD_WORKERS = int(get_optional_arg("S3_UPLOAD_WORKERS", 8))
+PIPELINE_QUEUE_SIZE = int(get_optional_arg("PIPELINE_QUEUE_SIZE", 8))
+# Number of chunks handed from the chunk stage to the embed stage at once
+CHUNK_BATCH_SIZE = int(get_optional_arg("CHUNK_BATCH_SIZE", 64))
+# Embedding batches are limited by document count, estimated tokens and request
+# payload (SageMaker real-time endpoints accept up to 6 MB), the document count
+# adapts between 1 and EMBED_MAX_BATCH_SIZE
+EMBED_BATCH_SIZE = int(get_optional_arg("EMBED_BATCH_SIZE", 16))
+EMBED_MAX_BATCH_SIZE = int(get_optional_arg("EMBED_MAX_BATCH_SIZE", 64))
+EMBED_MAX_BATCH_TOKENS = int(get_optional_arg("EMBED_MAX_BATCH_TOKENS", 16384))
+EMBED_MAX_PAYLOAD_BYTES = int(
+    get_optional_arg("EMBED_MAX_PAYLOAD_BYTES", 5 * 1024 * 1024)
+)
+EMBED_TARGET_LATENCY = float(get_optional_arg("EMBED_TARGET_LATENCY", 10))
+# OpenSearch bulk requests are accumulated by size, independent of the
+# embedding batches
+BULK_MAX_BYTES = int(get_optional_arg("BULK_MAX_BYTES", 8 * 1024 * 1024))
+BULK_MAX_DOCS = int(get_optional_arg("BULK_MAX_DOCS", 500))
+BULK_MIN_BYTES = 1024 * 1024
+# Bulks are sent without refresh and the index is refreshed once at the end
+# of a job. Switching off the refresh interval or the replicas as well
+# affects every job writing the index, so it is only safe when a single job
+# ingests into it
+INGESTION_DISABLE_REFRESH = (
+    str(get_optional_arg("INGESTION_DISABLE_REFRESH", "false")).lower() == "true"
+)
+INGESTION_DISABLE_REPLICAS = (
+    str(get_optional_arg("INGESTION_DISABLE_REPLICAS", "false")).lower() == "true"
+)
+
+
 s3_client = boto3.client("s3")
 sm_client = boto3.client("secretsmanager")
 smr_client = boto3.client("sagemaker-runtime")
 dynamodb = boto3.resource("dynamodb")
 etl_object_table = dynamodb.Table(etl_object_table_name)
+# boto3 resources are not thread safe, status rows are written by pipeline workers
+etl_object_table_lock = threading.Lock()
 
 ENHANCE_CHUNK_SIZE = 25000
 OBJECT_EXPIRY_TIME = 3600
@@ -138,6 +200,11 @@ MAX_OS_DOCS_PER_PUT = 8
 
 nltk.data.path.append("/tmp/nltk_data")
 
+def put_etl_object_item(item: dict):
+    with etl_object_table_lock:
+        etl_object_table.put_item(Item=item)
+
+
 def get_aws_auth():
     try:
         master_user = sm_client.get_secret_value(SecretId=aos_secret)[
@@ -199,6 +266,8 @@ class S3FileProcessor:
             "create_time": create_time,
             "portal_bucket_name": portal_bucket_name,
             "document_language": document_language,
+            "pdf_extraction_mode": PDF_EXTRACTION_MODE,
+            "etl_max_in_flight": ETL_MAX_IN_FLIGHT,
         }
 
         input_body = {
@@ -209,7 +278,7 @@ class S3FileProcessor:
             "createTime": create_time,
             "status": "RUNNING",
         }
-        etl_object_table.put_item(Item=input_body)
+        put_etl_object_item(input_body)
 
         if file_type == "txt":
             return "txt", self.decode_file_content(file_content), kwargs
@@ -245,7 +314,7 @@ class S3FileProcessor:
                 "status": "FAILED",
                 "detail": message,
             }
-            etl_object_table.put_item(Item=input_body)
+            put_etl_object_item(input_body)
             logger.info(message)
 
     def decode_file_content(self, file_content: str, default_encoding: str = "utf-8"):
@@ -265,7 +334,14 @@ class S3FileProcessor:
 
         return decoded_content
 
-    def iterate_s3_files(self, extract_content=True) -> Generator:
+    def iterate_s3_objects(self) -> Generator:
+        """
+        Iterate the keys of the supported objects in this batch without
+        downloading them.
+
+        Yields:
+            tuple: A tuple containing the object key and the file type.
+        """
         current_indice = 0
         for page in self.paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
             for obj in page.get("Contents", []):
@@ -282,19 +358,36 @@ class S3FileProcessor:
                     # Exit this nested loop
                     break
                 else:
-                    logger.info("Processing object: %s", key)
                     current_indice += 1
-
-                    if extract_content:
-                        file_content = self.get_file_content(key)
-                        yield self.process_file(key, file_type, file_content)
-                    else:
-                        yield file_type, "", {"bucket": self.bucket, "key": key}
+                    yield key, file_type
 
             if current_indice >= (int(batchIndice) + 1) * int(batchFileNumber):
                 # Exit the outer loop
                 break
 
+    def fetch_file(self, key: str, file_type: str):
+        """
+        Download and process a single object.
+
+        Returns:
+            tuple: The result of process_file, None for unknown file types.
+        """
+        logger.info("Processing object: %s", key)
+        if file_type == "pdf" and etlModelEndpoint and PDF_EXTRACTION_MODE != "native":
+            # The ETL endpoint reads the PDF from S3 itself
+            file_content = b""
+        else:
+            file_content = self.get_file_content(key)
+        return self.process_file(key, file_type, file_content)
+
+    def iterate_s3_files(self, extract_content=True) -> Generator:
+        for key, file_type in self.iterate_s3_objects():
+            if extract_content:
+                yield self.fetch_file(key, file_type)
+            else:
+                logger.info("Processing object: %s", key)
+                yield file_type, "", {"bucket": self.bucket, "key": key}
+
 
 class BatchChunkDocumentProcessor:
     """
@@ -470,23 +563,259 @@ class BatchQueryDocumentProcessor:
             yield batch
 
 
+def is_throttling_error(error: Exception) -> bool:
+    """
+    Check whether an error was caused by throttling. Embedding wrappers re-raise
+    endpoint errors as ValueError, so the message is checked as well.
+    """
+    if getattr(error, "status_code", None) == 429:
+        return True
+    message = str(error)
+    return any(
+        pattern in message
+        for pattern in ["Throttl", "TooManyRequests", "Too Many Requests", "429"]
+    )
+
+
+class IngestionBatchController:
+    """
+    Size embedding batches and OpenSearch bulk requests for the ingestion worker.
+
+    Embedding batches are limited by document count, estimated tokens and the
+    endpoint payload size. The document count is halved when the endpoint
+    throttles or responds slower than the target latency, and grows back by
+    one after every fast call. The bulk byte limit is halved when OpenSearch
+    throttles and grows back on success. Throughput of the job is reported by
+    report().
+
+    Args:
+        batch_size (int): The initial number of documents per embedding call.
+        max_batch_size (int): The maximum number of documents per embedding call.
+        max_batch_tokens (int): The maximum estimated tokens per embedding call.
+        max_payload_bytes (int): The maximum request payload of an embedding call.
+        target_latency (float): Embedding calls slower than this shrink the batch.
+        bulk_max_bytes (int): The maximum size of an OpenSearch bulk request.
+        bulk_max_docs (int): The maximum documents of an OpenSearch bulk request.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = EMBED_BATCH_SIZE,
+        max_batch_size: int = EMBED_MAX_BATCH_SIZE,
+        max_batch_tokens: int = EMBED_MAX_BATCH_TOKENS,
+        max_payload_bytes: int = EMBED_MAX_PAYLOAD_BYTES,
+        target_latency: float = EMBED_TARGET_LATENCY,
+        bulk_max_bytes: int = BULK_MAX_BYTES,
+        bulk_max_docs: int = BULK_MAX_DOCS,
+    ):
+        self.max_batch_size = max(1, max_batch_size)
+        self.batch_size = min(max(1, batch_size), self.max_batch_size)
+        self.max_batch_tokens = max_batch_tokens
+        self.max_payload_bytes = max_payload_bytes
+        self.target_latency = target_latency
+        self.max_bulk_bytes = bulk_max_bytes
+        self.bulk_max_bytes = bulk_max_bytes
+        self.bulk_max_docs = bulk_max_docs
+        self.start_time = time.time()
+        self.stats = {
+            "embedded_docs": 0,
+            "embedded_bytes": 0,
+            "embedding_calls": 0,
+            "embedding_throttled": 0,
+            "indexed_docs": 0,
+            "indexed_bytes": 0,
+            "bulk_requests": 0,
+            "bulk_throttled": 0,
+        }
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        # CJK characters are roughly one token each, other text about four
+        # characters per token
+        cjk_count = sum(1 for char in text if "\u4e00" <= char <= "\u9fff")
+        return cjk_count + (len(text) - cjk_count) // 4 + 1
+
+    def split_embedding_batches(
+        self, documents: List[Document]
+    ) -> Generator[List[Document], None, None]:
+        """
+        Split documents into embedding batches within the current limits.
+
+        Yields:
+            List[Document]: A batch of documents for one embedding call.
+        """
+        batch = []
+        batch_tokens = 0
+        batch_bytes = 0
+        for document in documents:
+            tokens = self.estimate_tokens(document.page_content)
+            # Payload is json encoded, non ascii characters are escaped
+            num_bytes = len(json.dumps(document.page_content))
+            if batch and (
+                len(batch) >= self.batch_size
+                or batch_tokens + tokens > self.max_batch_tokens
+                or batch_bytes + num_bytes > self.max_payload_bytes
+            ):
+                yield batch
+                batch = []
+                batch_tokens = 0
+                batch_bytes = 0
+            batch.append(document)
+            batch_tokens += tokens
+            batch_bytes += num_bytes
+        if batch:
+            yield batch
+
+    def record_embedding(
+        self, num_docs: int, num_bytes: int, latency: float, error: Exception = None
+    ):
+        with self._lock:
+            self.stats["embedding_calls"] += 1
+            if error is not None:
+                if is_throttling_error(error):
+                    self.stats["embedding_throttled"] += 1
+                    self.batch_size = max(1, self.batch_size // 2)
+                    logger.info(
+                        "Embedding throttled, batch size reduced to %d", self.batch_size
+                    )
+                return
+            self.stats["embedded_docs"] += num_docs
+            self.stats["embedded_bytes"] += num_bytes
+            if latency > self.target_latency:
+                self.batch_size = max(1, self.batch_size // 2)
+                logger.info(
+                    "Embedding took %.2fs, batch size reduced to %d",
+                    latency,
+                    self.batch_size,
+                )
+            elif num_docs >= self.batch_size:
+                self.batch_size = min(self.max_batch_size, self.batch_size + 1)
+
+    def record_bulk(
+        self, num_docs: int, num_bytes: int, error: Exception = None
+    ):
+        with self._lock:
+            self.stats["bulk_requests"] += 1
+            if error is not None:
+                if is_throttling_error(error):
+                    self.stats["bulk_throttled"] += 1
+                    self.bulk_max_bytes = max(BULK_MIN_BYTES, self.bulk_max_bytes // 2)
+                    logger.info(
+                        "Bulk throttled, bulk size reduced to %d bytes",
+                        self.bulk_max_bytes,
+                    )
+                return
+            self.stats["indexed_docs"] += num_docs
+            self.stats["indexed_bytes"] += num_bytes
+            self.bulk_max_bytes = min(
+                self.max_bulk_bytes, self.bulk_max_bytes + BULK_MIN_BYTES
+            )
+
+    def report(self) -> dict:
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        with self._lock:
+            report = dict(self.stats)
+            report["embedding_batch_size"] = self.batch_size
+            report["bulk_max_bytes"] = self.bulk_max_bytes
+        report["elapsed_seconds"] = round(elapsed, 2)
+        report["embedded_docs_per_sec"] = round(report["embedded_docs"] / elapsed, 2)
+        report["embedded_bytes_per_sec"] = round(report["embedded_bytes"] / elapsed, 2)
+        report["indexed_docs_per_sec"] = round(report["indexed_docs"] / elapsed, 2)
+        report["indexed_bytes_per_sec"] = round(report["indexed_bytes"] / elapsed, 2)
+        return report
+
+
+class BulkBuffer:
+    """
+    Accumulate embedded documents of several embedding batches, possibly from
+    different objects, until they fill one OpenSearch bulk request.
+
+    Args:
+        batch_controller (IngestionBatchController): Provides the bulk size limits.
+    """
+
+    def __init__(self, batch_controller: IngestionBatchController):
+        self.batch_controller = batch_controller
+        self._entries = []
+        self._num_docs = 0
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def estimate_bytes(texts, embeddings_vectors, metadatas) -> int:
+        num_bytes = 0
+        for text, vector, metadata in zip(texts, embeddings_vectors, metadatas):
+            num_bytes += len(json.dumps(text).encode("utf-8"))
+            num_bytes += len(json.dumps(metadata, default=str).encode("utf-8"))
+            # A float is about 20 bytes in the json body
+            num_bytes += len(vector) * 20
+        return num_bytes
+
+    def add(self, owner, texts, embeddings_vectors, metadatas) -> List:
+        """
+        Add an embedded batch. Returns the entries to flush once the buffer is
+        full, otherwise an empty list.
+        """
+        num_bytes = self.estimate_bytes(texts, embeddings_vectors, metadatas)
+        with self._lock:
+            self._entries.append(
+                (owner, texts, embeddings_vectors, metadatas, num_bytes)
+            )
+            self._num_docs += len(texts)
+            self._num_bytes += num_bytes
+            if (
+                self._num_bytes >= self.batch_controller.bulk_max_bytes
+                or self._num_docs >= self.batch_controller.bulk_max_docs
+            ):
+                return self._drain()
+        return []
+
+    def drain(self) -> List:
+        with self._lock:
+            return self._drain()
+
+    def _drain(self) -> List:
+        entries = self._entries
+        self._entries = []
+        self._num_docs = 0
+        self._num_bytes = 0
+        return entries
+
+
 class OpenSearchIngestionWorker:
     def __init__(
         self,
         docsearch: OpenSearchVectorSearch,
         embedding_model_endpoint: str,
+        batch_controller: IngestionBatchController = None,
     ):
         self.docsearch = docsearch
         self.embedding_model_endpoint = embedding_model_endpoint
+        self.batch_controller = batch_controller or IngestionBatchController()
 
     @retry(
         stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10)
     )
-    def aos_ingestion(self, documents: List[Document]) -> None:
+    def embed_documents(self, documents: List[Document]):
         texts = [doc.page_content for doc in documents]
         metadatas = [doc.metadata for doc in documents]
-        embeddings_vectors = self.docsearch.embedding_function.embed_documents(
-            list(texts)
+        num_bytes = sum(len(text.encode("utf-8")) for text in texts)
+        embed_kwargs = {}
+        embed_function = self.docsearch.embedding_function.embed_documents
+        if "chunk_size" in inspect.signature(embed_function).parameters:
+            # The batch is already sized by the controller, embed it in one call
+            embed_kwargs["chunk_size"] = len(texts)
+        start_time = time.time()
+        try:
+            embeddings_vectors = embed_function(list(texts), **embed_kwargs)
+        except Exception as e:
+            self.batch_controller.record_embedding(
+                len(texts), num_bytes, time.time() - start_time, e
+            )
+            raise
+        self.batch_controller.record_embedding(
+            len(texts), num_bytes, time.time() - start_time
         )
 
         if isinstance(embeddings_vectors[0], dict):
@@ -500,9 +829,30 @@ class OpenSearchIngestionWorker:
                 metadata_list.append(metadata)
             embeddings_vectors = embeddings_vectors_list
             metadatas = metadata_list
-        self.docsearch._OpenSearchVectorSearch__add(
-            texts, embeddings_vectors, metadatas=metadatas
-        )
+        return texts, embeddings_vectors, metadatas
+
+    @retry(
+        stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10)
+    )
+    def index_documents(self, texts, embeddings_vectors, metadatas) -> None:
+        num_bytes = BulkBuffer.estimate_bytes(texts, embeddings_vectors, metadatas)
+        try:
+            self.docsearch._OpenSearchVectorSearch__add(
+                texts,
+                embeddings_vectors,
+                metadatas=metadatas,
+                bulk_size=max(len(texts), 500),
+                max_chunk_bytes=self.batch_controller.bulk_max_bytes,
+            )
+        except Exception as e:
+            self.batch_controller.record_bulk(len(texts), num_bytes, e)
+            raise
+        self.batch_controller.record_bulk(len(texts), num_bytes)
+
+    def aos_ingestion(self, documents: List[Document]) -> None:
+        for batch in self.batch_controller.split_embedding_batches(documents):
+            texts, embeddings_vectors, metadatas = self.embed_documents(batch)
+            self.index_documents(texts, embeddings_vectors, metadatas)
 
 
 class OpenSearchDeleteWorker:
@@ -530,67 +880,348 @@ class OpenSearchDeleteWorker:
             return
 
 
-def ingestion_pipeline(
-    s3_files_iterator, batch_chunk_processor, ingestion_worker, extract_only=False
-):
-    for file_type, file_content, kwargs in s3_files_iterator:
+# Sentinel telling a stage worker that its upstream stage is drained
+_STOP = object()
+
+
+class FileTask:
+    """
+    Track the work items of one S3 object flowing through the ingestion
+    pipeline, the final status of the object is written once the last item
+    derived from it is finished.
+
+    Args:
+        kwargs (dict): The keyword arguments returned by S3FileProcessor.process_file.
+    """
+
+    def __init__(self, kwargs: dict):
+        self.kwargs = kwargs
+        self.error = None
+        self._refs = 0
+        self._lock = threading.Lock()
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None
+
+    def acquire(self):
+        with self._lock:
+            self._refs += 1
+
+    def release(self):
+        with self._lock:
+            self._refs -= 1
+            finished = self._refs == 0
+        if finished:
+            try:
+                self._finish()
+            except Exception as e:
+                # Never let a status write break the pipeline worker
+                logger.error(
+                    "Error writing the status of object %s: %s",
+                    self.kwargs["bucket"] + "/" + self.kwargs["key"],
+                    e,
+                )
+                traceback.print_exc()
+
+    def fail(self, error: Exception):
+        with self._lock:
+            if self.error is None:
+                self.error = error
+
+    def _finish(self):
         input_body = {
-            "s3Path": f"s3://{kwargs['bucket']}/{kwargs['key']}",
-            "s3Bucket": kwargs["bucket"],
-            "s3Prefix": kwargs["key"],
+            "s3Path": f"s3://{self.kwargs['bucket']}/{self.kwargs['key']}",
+            "s3Bucket": self.kwargs["bucket"],
+            "s3Prefix": self.kwargs["key"],
             "executionId": table_item_id,
-            "createTime": kwargs["create_time"],
+            "createTime": self.kwargs["create_time"],
             "status": "SUCCEED",
         }
+        if self.error is not None:
+            input_body["status"] = "FAILED"
+            input_body["detail"] = str(self.error)
+        put_etl_object_item(input_body)
+
+
+class PipelineStage:
+    """
+    A stage of the ingestion pipeline running on its own worker threads.
+
+    Workers take (file_task, payload) items from a bounded input queue and
+    hand every (file_task, payload) yielded by func to the next stage. Since
+    the queues are bounded, a slow stage blocks the stages before it.
+
+    Args:
+        name (str): The name of the stage, used in logs.
+        func (Callable): Called with (file_task, payload), returns an iterable of (file_task, payload) for the next stage.
+        num_workers (int): The number of worker threads.
+        queue_size (int): The maximum number of items waiting in the input queue.
+        on_finish (Callable, optional): Called by the last worker once the input is drained.
+    """
+
+    def __init__(
+        self, name: str, func, num_workers: int, queue_size: int, on_finish=None
+    ):
+        self.name = name
+        self.func = func
+        self.on_finish = on_finish
+        self.num_workers = max(1, num_workers)
+        self.input_queue = queue.Queue(maxsize=queue_size)
+        self.next_stage = None
+        self.processed = 0
+        self.busy_time = 0.0
+        self._active_workers = self.num_workers
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.num_workers):
+            thread = threading.Thread(
+                target=self._run, name=f"{self.name}-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def put(self, file_task, payload):
+        if file_task is not None:
+            file_task.acquire()
+        self.input_queue.put((file_task, payload))
+
+    def stop(self):
+        for _ in range(self.num_workers):
+            self.input_queue.put(_STOP)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _process(self, file_task, payload):
+        start_time = time.time()
         try:
-            # The res is list[Document] type
-            res = cb_process_object(s3_client, file_type, file_content, **kwargs)
-            for document in res:
-                save_content_to_s3(
-                    s3_client, document, res_bucket, SplittingType.SEMANTIC.value
+            for next_file_task, next_payload in self.func(file_task, payload):
+                if self.next_stage is not None:
+                    self.next_stage.put(next_file_task, next_payload)
+        except Exception as e:
+            if file_task is None:
+                logger.error("Error in stage %s: %s", self.name, e)
+            else:
+                logger.error(
+                    "Error processing object %s in stage %s: %s",
+                    file_task.kwargs["bucket"] + "/" + file_task.kwargs["key"],
+                    self.name,
+                    e,
                 )
+                file_task.fail(e)
+            traceback.print_exc()
+        finally:
+            with self._lock:
+                self.processed += 1
+                self.busy_time += time.time() - start_time
+            if file_task is not None:
+                file_task.release()
 
-            gen_chunk_flag = False if file_type == "csv" else True
-            batches = batch_chunk_processor.batch_generator(res, gen_chunk_flag)
-
-            for batch in batches:
-                if len(batch) == 0:
+    def _run(self):
+        try:
+            while True:
+                item = self.input_queue.get()
+                if item is _STOP:
+                    break
+                file_task, payload = item
+                if file_task is not None and file_task.failed:
+                    # Skip the remaining work of an object which already failed
+                    file_task.release()
                     continue
+                self._process(file_task, payload)
+        finally:
+            # The next stage is stopped by the last worker, even if a worker dies
+            self._finish_worker()
+
+    def _finish_worker(self):
+        with self._lock:
+            self._active_workers -= 1
+            last_worker = self._active_workers == 0
+        if not last_worker:
+            return
+        if self.on_finish is not None:
+            try:
+                self.on_finish()
+            except Exception as e:
+                logger.error("Error finishing stage %s: %s", self.name, e)
+                traceback.print_exc()
+        if self.next_stage is not None:
+            self.next_stage.stop()
 
-                for document in batch:
-                    if "complete_heading" in document.metadata:
-                        document.page_content = (
-                            document.metadata["complete_heading"]
-                            + " "
-                            + document.page_content
-                        )
-                    else:
-                        document.page_content = document.page_content
-
-                    save_content_to_s3(
-                        s3_client, document, res_bucket, SplittingType.CHUNK.value
-                    )
 
-                if not extract_only:
-                    ingestion_worker.aos_ingestion(batch)
+def ingestion_pipeline(
+    s3_objects_iterator,
+    file_processor,
+    batch_chunk_processor,
+    ingestion_worker,
+    extract_only=False,
+):
+    """
+    Ingest the S3 objects through the stages fetch -> parse -> chunk -> embed
+    -> index, each stage with its own workers and bounded queues in between,
+    so that S3 downloads and uploads, parsing, embedding endpoint calls and
+    OpenSearch bulk writes overlap. Embedding batches are buffered into bulk
+    requests sized by the worker's IngestionBatchController. The embed and
+    index stages are skipped when extract_only is set.
+    """
+    upload_executor = ThreadPoolExecutor(
+        max_workers=S3_UPLOAD_WORKERS, thread_name_prefix="s3-upload"
+    )
+
+    def save_documents(documents: List[Document], splitting_type: str):
+        # Wait for the uploads, so that an upload error fails the object
+        list(
+            upload_executor.map(
+                lambda document: save_content_to_s3(
+                    s3_client, document, res_bucket, splitting_type
+                ),
+                documents,
+            )
+        )
+
+    def fetch(_, s3_object):
+        key, file_type = s3_object
+        try:
+            processed = file_processor.fetch_file(key, file_type)
         except Exception as e:
-            logger.error(
-                "Error processing object %s: %s",
-                kwargs["bucket"] + "/" + kwargs["key"],
-                e,
+            # There is no FileTask yet, record the failed object with one
+            file_task = FileTask(
+                {
+                    "bucket": file_processor.bucket,
+                    "key": key,
+                    "create_time": str(datetime.now(timezone.utc)),
+                }
             )
-            input_body = {
-                "s3Path": f"s3://{kwargs['bucket']}/{kwargs['key']}",
-                "s3Bucket": kwargs["bucket"],
-                "s3Prefix": kwargs["key"],
-                "executionId": table_item_id,
-                "createTime": kwargs["create_time"],
-                "status": "FAILED",
-                "detail": str(e),
-            }
-            traceback.print_exc()
+            file_task.acquire()
+            file_task.fail(e)
+            file_task.release()
+            raise
+        # Unknown file types are marked as failed by process_file
+        if processed is not None:
+            yield FileTask(processed[2]), processed
+
+    def parse(file_task, processed):
+        file_type, file_content, kwargs = processed
+        # The res is list[Document] type
+        res = cb_process_object(s3_client, file_type, file_content, **kwargs)
+        save_documents(res, SplittingType.SEMANTIC.value)
+        yield file_task, (file_type, res)
+
+    def chunk(file_task, parsed):
+        file_type, res = parsed
+        gen_chunk_flag = False if file_type == "csv" else True
+        batches = batch_chunk_processor.batch_generator(res, gen_chunk_flag)
+
+        for batch in batches:
+            if len(batch) == 0:
+                continue
+            if file_task.failed:
+                return
+
+            for document in batch:
+                if "complete_heading" in document.metadata:
+                    document.page_content = (
+                        document.metadata["complete_heading"]
+                        + " "
+                        + document.page_content
+                    )
+            save_documents(batch, SplittingType.CHUNK.value)
+
+            if not extract_only:
+                yield file_task, batch
+
+    batch_controller = ingestion_worker.batch_controller
+    bulk_buffer = BulkBuffer(batch_controller)
+
+    def embed(file_task, batch):
+        for embedding_batch in batch_controller.split_embedding_batches(batch):
+            if file_task.failed:
+                return
+            yield file_task, ingestion_worker.embed_documents(embedding_batch)
+
+    def index_entries(entries):
+        ingestion_worker.index_documents(
+            [text for entry in entries for text in entry[1]],
+            [vector for entry in entries for vector in entry[2]],
+            [metadata for entry in entries for metadata in entry[3]],
+        )
+
+    def flush(entries):
+        entries_to_index = [entry for entry in entries if not entry[0].failed]
+        try:
+            if entries_to_index:
+                index_entries(entries_to_index)
+        except Exception as e:
+            logger.error("Error indexing %d batches: %s", len(entries_to_index), e)
+            # A bulk mixes objects, index them one by one so that only the
+            # failing objects are marked as failed
+            entries_by_owner = {}
+            for entry in entries_to_index:
+                entries_by_owner.setdefault(id(entry[0]), []).append(entry)
+            for owner_entries in entries_by_owner.values():
+                try:
+                    index_entries(owner_entries)
+                except Exception as owner_error:
+                    traceback.print_exc()
+                    owner_entries[0][0].fail(owner_error)
         finally:
-            etl_object_table.put_item(Item=input_body)
+            for entry in entries:
+                entry[0].release()
+
+    def index(file_task, embedded):
+        # The object stays open until its buffered documents are flushed
+        file_task.acquire()
+        flush(bulk_buffer.add(file_task, *embedded))
+        return []
+
+    stages = [
+        PipelineStage("fetch", fetch, FETCH_WORKERS, PIPELINE_QUEUE_SIZE),
+        PipelineStage("parse", parse, PARSE_WORKERS, PIPELINE_QUEUE_SIZE),
+        PipelineStage("chunk", chunk, CHUNK_WORKERS, PIPELINE_QUEUE_SIZE),
+    ]
+    if not extract_only:
+        stages.append(
+            PipelineStage("embed", embed, EMBED_WORKERS, PIPELINE_QUEUE_SIZE)
+        )
+        stages.append(
+            PipelineStage(
+                "index",
+                index,
+                INDEX_WORKERS,
+                PIPELINE_QUEUE_SIZE,
+                on_finish=lambda: flush(bulk_buffer.drain()),
+            )
+        )
+    for stage, next_stage in zip(stages, stages[1:]):
+        stage.next_stage = next_stage
+
+    start_time = time.time()
+    for stage in stages:
+        stage.start()
+    try:
+        for s3_object in s3_objects_iterator:
+            stages[0].put(None, s3_object)
+    finally:
+        stages[0].stop()
+        for stage in stages:
+            stage.join()
+        upload_executor.shutdown()
+
+    logger.info("Ingestion pipeline finished in %.2fs", time.time() - start_time)
+    for stage in stages:
+        logger.info(
+            "Stage %s: %d items processed by %d workers, busy for %.2fs",
+            stage.name,
+            stage.processed,
+            stage.num_workers,
+            stage.busy_time,
+        )
+    if not extract_only:
+        logger.info("Ingestion throughput: %s", batch_controller.report())
 
 
 def delete_pipeline(s3_files_iterator, document_generator, delete_worker):
@@ -633,9 +1264,10 @@ def create_processors_and_workers(
     """
 
     if operation_type in ["create", "extract_only"]:
-        s3_files_iterator = file_processor.iterate_s3_files(extract_content=True)
+        # Objects are downloaded by the fetch stage of the ingestion pipeline
+        s3_files_iterator = file_processor.iterate_s3_objects()
         batch_processor = BatchChunkDocumentProcessor(
-            chunk_size=1024, chunk_overlap=30, batch_size=10
+            chunk_size=1024, chunk_overlap=30, batch_size=CHUNK_BATCH_SIZE
         )
         worker = OpenSearchIngestionWorker(docsearch, embedding_model_endpoint)
     elif operation_type in ["delete", "update"]:
@@ -699,10 +1331,19 @@ def main():
     )
 
     if operation_type == "create":
-        ingestion_pipeline(s3_files_iterator, batch_processor, worker)
+        with docsearch.ingestion_session(
+            INGESTION_DISABLE_REFRESH, INGESTION_DISABLE_REPLICAS
+        ):
+            ingestion_pipeline(
+                s3_files_iterator, file_processor, batch_processor, worker
+            )
     elif operation_type == "extract_only":
         ingestion_pipeline(
-            s3_files_iterator, batch_processor, worker, extract_only=True
+            s3_files_iterator,
+            file_processor,
+            batch_processor,
+            worker,
+            extract_only=True,
         )
     elif operation_type == "delete":
         delete_pipeline(s3_files_iterator, batch_processor, worker)
@@ -714,7 +1355,12 @@ def main():
         s3_files_iterator, batch_processor, worker = create_processors_and_workers(
             "create", docsearch, embedding_model_endpoint, file_processor
         )
-        ingestion_pipeline(s3_files_iterator, batch_processor, worker)
+        with docsearch.ingestion_session(
+            INGESTION_DISABLE_REFRESH, INGESTION_DISABLE_REPLICAS
+        ):
+            ingestion_pipeline(
+                s3_files_iterator, file_processor, batch_processor, worker
+            )
     else:
         raise ValueError(
             "Invalid operation type. Valid types: create, delete, update, extract_only"
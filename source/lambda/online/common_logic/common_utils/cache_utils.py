@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import OrderedDict
+
+# name -> cache, for stats reporting
+_cache_registry = {}
+# caches which only live for the duration of one request
+_request_caches = []
+
+
+class LRUCache:
+    """Thread safe LRU cache with an optional ttl, living in the warm container.
+
+    Args:
+        name (str): cache name used in stats
+        max_size (int): maximum number of entries, None for unbounded
+        ttl (float): seconds an entry stays valid, None for no expiry
+    """
+
+    def __init__(self, name: str, max_size: int = 1024, ttl: float = None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        _cache_registry[name] = self
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and (item[0] is None or item[0] > time.time()):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, ttl: float = None):
+        if self.max_size is not None and self.max_size <= 0:
+            return
+        ttl = ttl if ttl is not None else self.ttl
+        expire_time = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (expire_time, value)
+            self._data.move_to_end(key)
+            if self.max_size is not None:
+                while len(self._data) > self.max_size:
+                    self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._data),
+        }
+
+    def __len__(self):
+        return len(self._data)
+
+
+def request_cache(name: str) -> LRUCache:
+    """Create an unbounded cache which is cleared by reset_request_caches."""
+    cache = LRUCache(name, max_size=None)
+    _request_caches.append(cache)
+    return cache
+
+
+def reset_request_caches():
+    """Clear all request scoped caches, call at the start of every request."""
+    for cache in _request_caches:
+        cache.clear()
+
+
+def get_cache_stats():
+    return {name: cache.stats() for name, cache in _cache_registry.items()}
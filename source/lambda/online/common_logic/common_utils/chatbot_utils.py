@@ -1,3 +1,4 @@
+import copy
 import logging
 import os
 from datetime import datetime
@@ -5,10 +6,30 @@ from typing import List
 
 import boto3
 
+from .cache_utils import LRUCache, request_cache
 from .chatbot import Chatbot
+from .logger_utils import get_logger
+
+logger = get_logger("chatbot_utils")
+
+BATCH_GET_ITEM_LIMIT = 100
+# Seconds a resolved chatbot is served without reading DynamoDB
+CHATBOT_CACHE_TTL = float(os.environ.get("CHATBOT_CACHE_TTL", 60))
+# Seconds the index and model rows of a chatbot are reused while the chatbot
+# row is unchanged, they are updated without touching the chatbot row
+CHATBOT_VERSION_CACHE_TTL = float(
+    os.environ.get("CHATBOT_VERSION_CACHE_TTL", 300))
+
+chatbot_cache = LRUCache("chatbot", max_size=128, ttl=CHATBOT_CACHE_TTL)
+# (group_name, chatbot_id) -> (updateTime, chatbot), used to revalidate expired entries
+chatbot_version_cache = LRUCache(
+    "chatbot_version", max_size=128, ttl=CHATBOT_VERSION_CACHE_TTL)
+request_chatbot_cache = request_cache("request_chatbot")
 
 
 class ChatbotManager:
+    _environ_instance = None
+
     def __init__(self, chatbot_table, index_table, model_table):
         self.chatbot_table = chatbot_table
         self.index_table = index_table
@@ -16,6 +37,9 @@ class ChatbotManager:
 
     @classmethod
     def from_environ(cls):
+        # Reuse the DynamoDB resource across calls in the warm container
+        if cls._environ_instance is not None:
+            return cls._environ_instance
         chatbot_table_name = os.environ.get("CHATBOT_TABLE_NAME", "")
         model_table_name = os.environ.get("MODEL_TABLE_NAME", "")
         index_table_name = os.environ.get("INDEX_TABLE_NAME", "")
@@ -24,11 +48,81 @@ class ChatbotManager:
         model_table = dynamodb.Table(model_table_name)
         index_table = dynamodb.Table(index_table_name)
         chatbot_manager = cls(chatbot_table, index_table, model_table)
+        cls._environ_instance = chatbot_manager
         return chatbot_manager
 
+    def _batch_get_items(self, table, keys: List[dict]):
+        """Read items with BatchGetItem, retrying unprocessed keys
+
+        Args:
+            table: DynamoDB table resource
+            keys (List[dict]): primary keys of the items
+
+        Returns:
+            list of items found
+        """
+        items = []
+        for start in range(0, len(keys), BATCH_GET_ITEM_LIMIT):
+            request_items = {
+                table.name: {"Keys": keys[start:start + BATCH_GET_ITEM_LIMIT]}
+            }
+            while request_items:
+                response = table.meta.client.batch_get_item(
+                    RequestItems=request_items)
+                items.extend(response.get("Responses", {}).get(table.name, []))
+                request_items = response.get("UnprocessedKeys")
+        return items
+
+    def _load_chatbot_item(self, group_name: str, chatbot_content: dict):
+        """Resolve index and embedding model rows of a chatbot item in two batched reads"""
+        index_ids = list(dict.fromkeys(
+            index_id
+            for index_item in chatbot_content.get("indexIds").values()
+            for index_id in index_item.get("value").values()
+        ))
+        index_items = self._batch_get_items(
+            self.index_table,
+            [{"groupName": group_name, "indexId": index_id}
+                for index_id in index_ids],
+        )
+        index_item_dict = {item["indexId"]: item for item in index_items}
+
+        model_ids = list(dict.fromkeys(
+            item.get("modelIds", {}).get("embedding")
+            for item in index_items
+            if item.get("modelIds", {}).get("embedding")
+        ))
+        model_items = self._batch_get_items(
+            self.model_table,
+            [{"groupName": group_name, "modelId": model_id}
+                for model_id in model_ids],
+        )
+        model_item_dict = {item["modelId"]: item for item in model_items}
+
+        for index_type, index_item in chatbot_content.get("indexIds").items():
+            for tag, index_id in list(index_item.get("value").items()):
+                index_content = copy.deepcopy(index_item_dict.get(index_id))
+                if index_content is None:
+                    logger.warning(
+                        f"index {index_id} of chatbot {chatbot_content.get('chatbotId')} not found")
+                    del index_item["value"][tag]
+                    continue
+                embedding_model_id = index_content.get(
+                    "modelIds").get("embedding")
+                if embedding_model_id:
+                    index_content["modelIds"]["embedding"] = model_item_dict.get(
+                        embedding_model_id)
+                chatbot_content["indexIds"][index_type]["value"][tag] = index_content
+        return chatbot_content
+
     def get_chatbot(self, group_name: str, chatbot_id: str):
         """Get chatbot from chatbot id and add index, model, etc. data
 
+        The resolved chatbot is shared by the whole request and cached in the
+        container for CHATBOT_CACHE_TTL seconds. After the ttl only the chatbot
+        row is read again, index and model rows are reused while its
+        updateTime is unchanged, for at most CHATBOT_VERSION_CACHE_TTL seconds.
+
         Args:
             group_name (str): group name
             chatbot_id (str): chatbot id
@@ -36,27 +130,34 @@ class ChatbotManager:
         Returns:
             Chatbot instance
         """
+        cache_key = (group_name, chatbot_id)
+        chatbot = request_chatbot_cache.get(cache_key)
+        if chatbot is not None:
+            return chatbot
+        chatbot = chatbot_cache.get(cache_key)
+        if chatbot is None:
+            chatbot = self._get_chatbot_from_ddb(group_name, chatbot_id)
+            chatbot_cache.put(cache_key, chatbot)
+        request_chatbot_cache.put(cache_key, chatbot)
+        return chatbot
+
+    def _get_chatbot_from_ddb(self, group_name: str, chatbot_id: str):
+        cache_key = (group_name, chatbot_id)
         chatbot_response = self.chatbot_table.get_item(
             Key={"groupName": group_name, "chatbotId": chatbot_id}
         )
         chatbot_content = chatbot_response.get("Item")
         if not chatbot_content:
+            chatbot_version_cache.pop(cache_key)
             return Chatbot.from_dynamodb_item({})
-        for index_type, index_item in chatbot_content.get("indexIds").items():
-            for tag, index_id in index_item.get("value").items():
-                index_content = self.index_table.get_item(
-                    Key={"groupName": group_name, "indexId": index_id}
-                ).get("Item")
-                embedding_model_id = index_content.get(
-                    "modelIds").get("embedding")
-                if embedding_model_id:
-                    model_content = self.model_table.get_item(
-                        Key={"groupName": group_name,
-                             "modelId": embedding_model_id}
-                    ).get("Item")
-                    index_content["modelIds"]["embedding"] = model_content
-                chatbot_content["indexIds"][index_type]["value"][tag] = index_content
 
-        chatbot = Chatbot.from_dynamodb_item(chatbot_content)
+        version = chatbot_content.get("updateTime")
+        cached = chatbot_version_cache.get(cache_key)
+        if cached is not None and version is not None and cached[0] == version:
+            return cached[1]
 
+        chatbot = Chatbot.from_dynamodb_item(
+            self._load_chatbot_item(group_name, chatbot_content)
+        )
+        chatbot_version_cache.put(cache_key, (version, chatbot))
         return chatbot
@@ -1,6 +1,8 @@
 import json
 import math
-from datetime import datetime
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from typing import List
 
 import boto3
@@ -8,10 +10,29 @@ from botocore.exceptions import ClientError
 from langchain.schema import BaseChatMessageHistory
 from langchain.schema.messages import BaseMessage
 from common_logic.common_utils.chatbot_utils import ChatbotManager
+from common_logic.common_utils.logger_utils import get_logger
 from .constant import MessageType, IndexType, INDEX_DESC
 
+logger = get_logger("ddb_utils")
 client = boto3.resource("dynamodb")
 
+# Number of rounds (a user and an ai message) of chat history loaded per request
+CHAT_HISTORY_MAX_ROUNDS = int(os.environ.get("CHAT_HISTORY_MAX_ROUNDS", 20))
+# Attributes read from the history index, aliased since role is reserved
+_HISTORY_ATTRIBUTE_NAMES = {
+    "#messageId": "messageId",
+    "#role": "role",
+    "#content": "content",
+    "#createTimestamp": "createTimestamp",
+    "#entryType": "entryType",
+    "#customMessageId": "customMessageId",
+    "#additional_kwargs": "additional_kwargs",
+}
+# Falls back to the unsorted index until the sorted index is deployed
+_sorted_index_available = True
+# Upserts the session while the messages of a turn are written
+_write_executor = ThreadPoolExecutor(max_workers=2)
+
 
 class DynamoDBChatMessageHistory(BaseChatMessageHistory):
     def __init__(
@@ -28,6 +49,7 @@ class DynamoDBChatMessageHistory(BaseChatMessageHistory):
         self.user_id = user_id
         self.client_type = client_type
         self.MESSAGE_BY_SESSION_ID_INDEX_NAME = "bySessionId"
+        self.MESSAGE_BY_SESSION_ID_TIMESTAMP_INDEX_NAME = "bySessionIdTimestamp"
 
     @property
     def session(self):
@@ -40,40 +62,91 @@ class DynamoDBChatMessageHistory(BaseChatMessageHistory):
     @property
     def messages(self):
         """Retrieve the messages from DynamoDB"""
-        response = {}
+        return self.query_messages()
+
+    @property
+    def messages_as_langchain(self):
+        return self.to_langchain_messages(self.query_messages())
+
+    def get_recent_messages_as_langchain(self, max_rounds: int = CHAT_HISTORY_MAX_ROUNDS):
+        """Retrieve the messages of the latest max_rounds rounds, oldest first"""
+        items = self.query_messages(max_messages=max_rounds * 2)
+        # A window always starts with a user message so that rounds stay paired
+        while items and items[0]["role"] != MessageType.HUMAN_MESSAGE_TYPE:
+            items = items[1:]
+        return self.to_langchain_messages(items)
+
+    def query_messages(self, max_messages: int = None):
+        """Retrieve the messages of the session, oldest first
+
+        Args:
+            max_messages (int): only the latest max_messages messages are
+                retrieved, None for all messages
+        """
+        global _sorted_index_available
+        if max_messages is not None and max_messages <= 0:
+            return []
+        if _sorted_index_available:
+            try:
+                return self._query_messages_newest_first(max_messages)
+            except ClientError as error:
+                if error.response["Error"]["Code"] != "ValidationException":
+                    raise
+                # the sorted index is not deployed yet
+                logger.warning(
+                    f"index {self.MESSAGE_BY_SESSION_ID_TIMESTAMP_INDEX_NAME} unavailable: {error}"
+                )
+                _sorted_index_available = False
+
+        items = []
+        query_kwargs = {
+            "KeyConditionExpression": "sessionId = :session_id",
+            "ExpressionAttributeValues": {":session_id": self.session_id},
+            "IndexName": self.MESSAGE_BY_SESSION_ID_INDEX_NAME,
+        }
         try:
-            response = self.messages_table.query(
-                KeyConditionExpression="sessionId = :session_id",
-                ExpressionAttributeValues={":session_id": self.session_id},
-                IndexName=self.MESSAGE_BY_SESSION_ID_INDEX_NAME,
-            )
+            while True:
+                response = self.messages_table.query(**query_kwargs)
+                items.extend(response.get("Items", []))
+                if "LastEvaluatedKey" not in response:
+                    break
+                query_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
         except ClientError as error:
             if error.response["Error"]["Code"] == "ResourceNotFoundException":
                 print("No record found for session id: %s", self.session_id)
             else:
                 print(error)
 
-        items = response.get("Items", [])
         items = sorted(items, key=lambda x: x["createTimestamp"])
+        if max_messages is not None:
+            items = items[-max_messages:]
+        return items
 
+    def _query_messages_newest_first(self, max_messages: int = None):
+        query_kwargs = {
+            "KeyConditionExpression": "sessionId = :session_id",
+            "ExpressionAttributeValues": {":session_id": self.session_id},
+            "IndexName": self.MESSAGE_BY_SESSION_ID_TIMESTAMP_INDEX_NAME,
+            "ScanIndexForward": False,
+            "ProjectionExpression": ", ".join(_HISTORY_ATTRIBUTE_NAMES),
+            "ExpressionAttributeNames": _HISTORY_ATTRIBUTE_NAMES,
+        }
+        items = []
+        while True:
+            if max_messages is not None:
+                query_kwargs["Limit"] = max_messages - len(items)
+            response = self.messages_table.query(**query_kwargs)
+            items.extend(response.get("Items", []))
+            if "LastEvaluatedKey" not in response or (
+                max_messages is not None and len(items) >= max_messages
+            ):
+                break
+            query_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        items.reverse()
         return items
 
-    @property
-    def messages_as_langchain(self):
-        response = {}
-        try:
-            response = self.messages_table.query(
-                KeyConditionExpression="sessionId = :session_id",
-                ExpressionAttributeValues={":session_id": self.session_id},
-                IndexName=self.MESSAGE_BY_SESSION_ID_INDEX_NAME,
-            )
-        except ClientError as error:
-            if error.response["Error"]["Code"] == "ResourceNotFoundException":
-                print("No record found for session id: %s", self.session_id)
-            else:
-                print(error)
-        items = response.get("Items", [])
-        items = sorted(items, key=lambda x: x["createTimestamp"])
+    @staticmethod
+    def to_langchain_messages(items):
         ret = []
 
         for item in items:
@@ -203,6 +276,79 @@ class DynamoDBChatMessageHistory(BaseChatMessageHistory):
         )
         self.update_session()
 
+    def add_turn(
+        self,
+        message_id,
+        custom_message_id,
+        entry_type,
+        query,
+        answer,
+        additional_kwargs=None,
+    ) -> None:
+        """Write the user and ai messages of one turn and update the session
+
+        The two messages are written with one BatchWriteItem while the session
+        is upserted with one update_item, instead of a put_item, get_item and
+        update_item per message.
+        """
+        additional_kwargs = json.dumps(additional_kwargs or {})
+        user_time = datetime.utcnow()
+        # the ai message must sort after the user message
+        user_timestamp = user_time.isoformat(timespec="microseconds") + "Z"
+        ai_timestamp = (
+            user_time + timedelta(microseconds=1)
+        ).isoformat(timespec="microseconds") + "Z"
+        session_future = _write_executor.submit(
+            self.upsert_session, query, ai_timestamp
+        )
+
+        user_message_id = f"user_{message_id}"
+        try:
+            with self.messages_table.batch_writer() as batch:
+                for item_message_id, role, content, input_message_id, timestamp in (
+                    (user_message_id, MessageType.HUMAN_MESSAGE_TYPE, query, "", user_timestamp),
+                    (f"ai_{message_id}", MessageType.AI_MESSAGE_TYPE, answer, user_message_id, ai_timestamp),
+                ):
+                    batch.put_item(
+                        Item={
+                            "messageId": item_message_id,
+                            "sessionId": self.session_id,
+                            "role": role,
+                            "customMessageId": custom_message_id,
+                            "inputMessageId": input_message_id,
+                            "entryType": entry_type,
+                            "content": content,
+                            "createTimestamp": timestamp,
+                            "lastModifiedTimestamp": timestamp,
+                            "additional_kwargs": additional_kwargs,
+                        }
+                    )
+        except ClientError as err:
+            print(f"Error adding messages: {err}")
+        session_future.result()
+
+    def upsert_session(self, latest_question="", current_timestamp=None):
+        """Create or update the session with a single update_item"""
+        current_timestamp = current_timestamp or datetime.utcnow().isoformat() + "Z"
+        update_expression = (
+            "SET lastModifiedTimestamp = :t, "
+            "clientType = if_not_exists(clientType, :c), "
+            "startTime = if_not_exists(startTime, :t), "
+            "createTimestamp = if_not_exists(createTimestamp, :t)"
+        )
+        expression_attribute_values = {
+            ":t": current_timestamp,
+            ":c": self.client_type,
+        }
+        if latest_question:
+            update_expression += ", latestQuestion = :q"
+            expression_attribute_values[":q"] = latest_question
+        self.sessions_table.update_item(
+            Key={"sessionId": self.session_id, "userId": self.user_id},
+            UpdateExpression=update_expression,
+            ExpressionAttributeValues=expression_attribute_values,
+        )
+
     def clear(self) -> None:
         """Clear session memory from DynamoDB"""
         try:
@@ -1,17 +1,25 @@
 import boto3
 import os
 import json
+import time
 
 from pydantic import BaseModel, Field
 from collections import defaultdict
 from common_logic.common_utils.constant import LLMModelType, LLMTaskType
 import copy
 from common_logic.common_utils.constant import SceneType, MessageType
+from common_logic.common_utils.cache_utils import LRUCache, request_cache
 
 ddb_prompt_table_name = os.environ.get("PROMPT_TABLE_NAME", "")
 dynamodb_resource = boto3.resource("dynamodb")
 ddb_prompt_table = dynamodb_resource.Table(ddb_prompt_table_name)
 
+# Seconds a prompt item is served before checking its version again
+PROMPT_CACHE_TTL = float(os.environ.get("PROMPT_CACHE_TTL", 60))
+# (group_name, sort_key) -> (version, expire time, prompts of all task types)
+prompt_cache = LRUCache("prompt", max_size=256)
+request_prompt_cache = request_cache("request_prompt")
+
 
 # export models to front
 EXPORT_MODEL_IDS = [
@@ -80,12 +88,52 @@ class PromptTemplateManager:
             raise KeyError(
                 f'prompt_template_id: {prompt_template_id}, prompt_name: {prompt_name}')
 
+    @staticmethod
+    def _get_prompt_version(item: dict):
+        # items written before Version was introduced only have LastModifiedTime
+        return item.get("Version", item.get("LastModifiedTime"))
+
+    def _get_prompts_from_ddb(self, group_name: str, sort_key: str):
+        """Get the prompts of all task types for a sort key.
+
+        Prompts are served from memory for PROMPT_CACHE_TTL seconds, after
+        that only the Version written by prompt management is read and the
+        prompts are fetched again when it changed.
+        """
+        cache_key = (group_name, sort_key)
+        prompts = request_prompt_cache.get(cache_key)
+        if prompts is not None:
+            return prompts
+        key = {"GroupName": group_name, "SortKey": sort_key}
+        cached = prompt_cache.get(cache_key)
+        if cached is not None:
+            cached_version, expire_time, prompts = cached
+            if expire_time < time.time():
+                item = ddb_prompt_table.get_item(
+                    Key=key,
+                    ProjectionExpression="#version, LastModifiedTime",
+                    ExpressionAttributeNames={"#version": "Version"},
+                ).get("Item", {})
+                if self._get_prompt_version(item) != cached_version:
+                    cached = None
+        if cached is None:
+            item = ddb_prompt_table.get_item(Key=key).get("Item", {})
+            cached_version = self._get_prompt_version(item)
+            prompts = item.get("Prompt", {})
+        prompt_cache.put(
+            cache_key, (cached_version, time.time() + PROMPT_CACHE_TTL, prompts))
+        request_prompt_cache.put(cache_key, prompts)
+        return prompts
+
     def get_prompt_templates_from_ddb(self, group_name: str, model_id: str, task_type: str, chatbot_id: str = "admin", scene: str = "common"):
-        response = ddb_prompt_table.get_item(
-            Key={"GroupName": group_name,
-                 "SortKey": f"{model_id}__{scene}__{chatbot_id}"}
-        )
-        return response.get("Item", {}).get("Prompt", {}).get(task_type, {})
+        prompts = self._get_prompts_from_ddb(
+            group_name, f"{model_id}__{scene}__{chatbot_id}")
+        return copy.deepcopy(prompts.get(task_type, {}))
+
+    def prefetch_prompt_templates(self, group_name: str, model_id: str, chatbot_id: str = "admin", scene: str = "common"):
+        """Load the prompts of all task types into the request cache"""
+        self._get_prompts_from_ddb(
+            group_name, f"{model_id}__{scene}__{chatbot_id}")
 
     def get_all_templates(self, allow_model_ids=EXPORT_MODEL_IDS):
         assert isinstance(allow_model_ids, list), allow_model_ids
@@ -122,6 +170,7 @@ register_prompt_template = prompt_template_manager.register_prompt_template
 register_prompt_templates = prompt_template_manager.register_prompt_templates
 get_all_templates = prompt_template_manager.get_all_templates
 get_prompt_templates_from_ddb = prompt_template_manager.get_prompt_templates_from_ddb
+prefetch_prompt_templates = prompt_template_manager.prefetch_prompt_templates
 
 
 #### rag template #######
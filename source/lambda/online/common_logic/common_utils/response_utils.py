@@ -3,16 +3,12 @@ import logging
 import time
 import traceback
 from common_logic.common_utils.ddb_utils import DynamoDBChatMessageHistory
-from common_logic.common_utils.websocket_utils import send_to_ws_client
+from common_logic.common_utils.websocket_utils import StreamSender, WebsocketClientError
 from common_logic.common_utils.constant import StreamMessageType
 from common_logic.common_utils.logger_utils import get_logger
 logger = get_logger("response_utils")
 
 
-class WebsocketClientError(Exception):
-    pass
-
-
 def write_chat_history_to_ddb(
         query: str,
         answer: str,
@@ -22,15 +18,12 @@ def write_chat_history_to_ddb(
         entry_type,
         additional_kwargs=None,
 ):
-    ddb_obj.add_user_message(
-        f"user_{message_id}", custom_message_id, entry_type, query, additional_kwargs
-    )
-    ddb_obj.add_ai_message(
-        f"ai_{message_id}",
+    ddb_obj.add_turn(
+        message_id,
         custom_message_id,
         entry_type,
+        query,
         answer,
-        input_message_id=f"user_{message_id}",
         additional_kwargs=additional_kwargs
     )
 
@@ -77,16 +70,23 @@ def stream_response(event_body: dict, response: dict):
         answer = iter([answer])
 
     ddb_history_obj = event_body["ddb_history_obj"]
+    answer_str = ""
+    # posts from a background thread, chunks are coalesced
+    sender = StreamSender(
+        ws_connection_id,
+        chunk_message={
+            "message_type": StreamMessageType.CHUNK,
+            "message_id": f"ai_{message_id}",
+            "custom_message_id": custom_message_id,
+        },
+    )
 
     try:
-        send_to_ws_client(message={
+        sender.send({
             "message_type": StreamMessageType.START,
             "message_id": f"ai_{message_id}",
             "custom_message_id": custom_message_id,
-        },
-            ws_connection_id=ws_connection_id
-        )
-        answer_str = ""
+        })
 
         for i, chunk in enumerate(answer):
             if i == 0 and log_first_token_time:
@@ -95,19 +95,10 @@ def stream_response(event_body: dict, response: dict):
                 logger.info(
                     f"{custom_message_id} running time of first token whole {entry_type} entry: {first_token_time-request_timestamp}s"
                 )
-            send_to_ws_client(message={
-                "message_type": StreamMessageType.CHUNK,
-                "message_id": f"ai_{message_id}",
-                "custom_message_id": custom_message_id,
-                "message": {
-                    "role": "assistant",
-                    "content": chunk,
-                    # "knowledge_sources": sources,
-                },
-                "chunk_id": i,
-            },
-                ws_connection_id=ws_connection_id
-            )
+            # stop pulling the answer once the client is gone
+            if sender.error is not None:
+                raise WebsocketClientError(sender.error) from sender.error
+            sender.send_chunk(chunk)
             answer_str += chunk
 
         if log_first_token_time:
@@ -117,16 +108,6 @@ def stream_response(event_body: dict, response: dict):
 
         logger.info(f"answer: {answer_str}")
 
-        write_chat_history_to_ddb(
-            query=event_body['query'],
-            answer=answer_str,
-            ddb_obj=ddb_history_obj,
-            message_id=message_id,
-            custom_message_id=custom_message_id,
-            entry_type=entry_type,
-            additional_kwargs=response.get("ddb_additional_kwargs", {})
-        )
-
         # Send source and contexts
         if response:
             context_msg = {
@@ -137,36 +118,58 @@ def stream_response(event_body: dict, response: dict):
             }
             if figure and len(figure) > 1:
                 context_msg["figure"] = figure
-            send_to_ws_client(
-                message=context_msg,
-                ws_connection_id=ws_connection_id
-            )
+            sender.send(context_msg)
 
         # send end
-        send_to_ws_client(
+        sender.send(
             {
                 "message_type": StreamMessageType.END,
                 "message_id": f"ai_{message_id}",
                 "custom_message_id": custom_message_id,
-            },
-            ws_connection_id=ws_connection_id
+            }
         )
+        # written while the sender posts the end of the stream, so the user
+        # does not wait on DynamoDB, the answer is complete even if it fails
+        try:
+            write_chat_history_to_ddb(
+                query=event_body['query'],
+                answer=answer_str,
+                ddb_obj=ddb_history_obj,
+                message_id=message_id,
+                custom_message_id=custom_message_id,
+                entry_type=entry_type,
+                additional_kwargs=response.get("ddb_additional_kwargs", {})
+            )
+        except Exception:
+            logger.error(traceback.format_exc())
+        sender.close()
     except WebsocketClientError:
         error = traceback.format_exc()
         logger.info(error)
         # _stop_stream()
+        try:
+            sender.close()
+        except WebsocketClientError:
+            pass
     except:
         # bedrock error
         error = traceback.format_exc()
         logger.info(error)
-        send_to_ws_client(
+        sender.send(
             {
                 "message_type": StreamMessageType.ERROR,
                 "message_id": f"ai_{message_id}",
                 "custom_message_id": custom_message_id,
                 "message": {"content": error},
-            },
-            ws_connection_id=ws_connection_id
+            }
+        )
+        try:
+            sender.close()
+        except WebsocketClientError:
+            logger.info(traceback.format_exc())
+    if sender.first_chunk_post_time is not None:
+        logger.info(
+            f"{custom_message_id} running time of first chunk sent whole {entry_type} entry: {sender.first_chunk_post_time-request_timestamp}s"
         )
     return answer_str
 
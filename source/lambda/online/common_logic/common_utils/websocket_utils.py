@@ -1,4 +1,8 @@
 import json
+import os
+import queue
+import threading
+import time
 
 import boto3
 from common_logic.common_utils.logger_utils import get_logger
@@ -7,6 +11,11 @@ logger = get_logger("websocket_utils")
 
 ws_client = None
 
+# Streamed chunks are coalesced for this many seconds or until this many
+# characters are buffered before they are posted to the connection
+STREAM_FLUSH_INTERVAL = float(os.environ.get("STREAM_FLUSH_INTERVAL", 0.04))
+STREAM_MAX_BUFFER_CHARS = int(os.environ.get("STREAM_MAX_BUFFER_CHARS", 1024))
+
 
 class WebsocketClientError(Exception):
     pass
@@ -41,3 +50,125 @@ def send_to_ws_client(message: dict, ws_connection_id):
         ConnectionId=ws_connection_id,
         Data=json.dumps(message).encode("utf-8"),
     )
+
+
+class StreamSender:
+    """Posts the messages of one streamed answer from a background thread, so
+    the LLM iterator never waits on API Gateway. Chunks are coalesced until
+    flush_interval has passed since the oldest buffered chunk or
+    max_buffer_chars are buffered, the first chunk is posted right away.
+    Messages keep their order and coalesced chunks get consecutive chunk_ids.
+
+    Args:
+        ws_connection_id (str): the websocket connection to post to
+        chunk_message (dict): fields of every chunk message besides message and chunk_id
+    """
+
+    _STOP = object()
+
+    def __init__(
+        self,
+        ws_connection_id: str,
+        chunk_message: dict,
+        flush_interval: float = STREAM_FLUSH_INTERVAL,
+        max_buffer_chars: int = STREAM_MAX_BUFFER_CHARS,
+    ):
+        self.ws_connection_id = ws_connection_id
+        self.chunk_message = chunk_message
+        self.flush_interval = flush_interval
+        self.max_buffer_chars = max_buffer_chars
+        self.error = None
+        self.chunk_count = 0
+        self.post_count = 0
+        self.first_chunk_post_time = None
+        self.max_queue_latency = 0
+        self.total_queue_latency = 0
+        self._chunk_id = 0
+        self._closed = False
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def send(self, message: dict):
+        self._queue.put((time.time(), message))
+
+    def send_chunk(self, content: str):
+        self.chunk_count += 1
+        self._queue.put((time.time(), content))
+
+    def close(self):
+        """Posts everything still queued, raises WebsocketClientError if a post failed.
+
+        Closing again only raises the error.
+        """
+        if not self._closed:
+            self._closed = True
+            self._queue.put(self._STOP)
+            self._thread.join()
+            logger.info(
+                f"stream sender posted {self.chunk_count} chunks in {self.post_count} messages, "
+                f"queue latency avg: {self.total_queue_latency / max(self.post_count, 1):.3f}s, "
+                f"max: {self.max_queue_latency:.3f}s"
+            )
+        if self.error is not None:
+            raise WebsocketClientError(self.error) from self.error
+
+    def _post(self, message: dict, enqueue_time: float):
+        if self.error is not None:
+            return
+        try:
+            send_to_ws_client(message, self.ws_connection_id)
+        except Exception as e:
+            self.error = e
+            return
+        queue_latency = time.time() - enqueue_time
+        self.post_count += 1
+        self.total_queue_latency += queue_latency
+        self.max_queue_latency = max(self.max_queue_latency, queue_latency)
+
+    def _flush(self, buffer: list, enqueue_time: float):
+        if not buffer:
+            return
+        self._post(
+            {
+                **self.chunk_message,
+                "message": {"role": "assistant", "content": "".join(buffer)},
+                "chunk_id": self._chunk_id,
+            },
+            enqueue_time,
+        )
+        self._chunk_id += 1
+        if self.first_chunk_post_time is None:
+            self.first_chunk_post_time = time.time()
+        buffer.clear()
+
+    def _run(self):
+        buffer = []
+        buffer_chars = 0
+        buffer_time = None
+        while True:
+            timeout = None
+            if buffer:
+                timeout = max(buffer_time + self.flush_interval - time.time(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                self._flush(buffer, buffer_time)
+                buffer_chars = 0
+                continue
+            if item is self._STOP:
+                self._flush(buffer, buffer_time)
+                return
+            enqueue_time, payload = item
+            if isinstance(payload, dict):
+                self._flush(buffer, buffer_time)
+                buffer_chars = 0
+                self._post(payload, enqueue_time)
+                continue
+            if not buffer:
+                buffer_time = enqueue_time
+            buffer.append(payload)
+            buffer_chars += len(payload)
+            if self._chunk_id == 0 or buffer_chars >= self.max_buffer_chars:
+                self._flush(buffer, buffer_time)
+                buffer_chars = 0
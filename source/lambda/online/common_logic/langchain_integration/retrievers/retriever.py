@@ -1,5 +1,7 @@
 from langchain.schema.runnable import RunnableLambda, RunnablePassthrough
-from langchain.retrievers.merger_retriever import MergerRetriever
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain.docstore.document import Document
+from langchain.schema.retriever import BaseRetriever
 from langchain_community.retrievers import AmazonKnowledgeBasesRetriever
 from langchain.retrievers import (
     ContextualCompressionRetriever,
@@ -19,8 +21,15 @@ from common_logic.langchain_integration.retrievers.utils.aos_retrievers import (
     QueryDocumentKNNRetriever,
     QueryQuestionRetriever,
 )
+from common_logic.common_utils.cache_utils import request_cache
 from common_logic.common_utils.chatbot_utils import ChatbotManager
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import copy
+from functools import partial
+import threading
+from typing import Dict, List
 import boto3
+import time
 import sys
 import logging
 import json
@@ -50,6 +59,99 @@ region = boto3.Session().region_name
 knowledgebase_client = boto3.client("bedrock-agent-runtime", region)
 sm_client = boto3.client("sagemaker-runtime")
 
+# Seconds each retriever is given before its results are dropped
+retriever_timeout = float(os.environ.get("RETRIEVER_TIMEOUT", 20))
+retriever_max_workers = int(os.environ.get("RETRIEVER_MAX_WORKERS", 8))
+# Shared by all retrievals of the container, so retrievers which missed the
+# deadline cannot pile up threads across invocations
+retriever_executor = ThreadPoolExecutor(
+    max_workers=retriever_max_workers, thread_name_prefix="retriever"
+)
+
+
+def _log_late_retriever(i, retriever, start_time, future):
+    logger.warning(
+        f"retriever {i + 1} {type(retriever).__name__} finished "
+        f"{time.perf_counter() - start_time:.4f} seconds into the retrieval, "
+        f"past the timeout, error: {future.exception()!r}")
+
+
+class ConcurrentMergerRetriever(BaseRetriever):
+    """Run all retrievers concurrently and merge their results.
+
+    Results are interleaved in the same order as LangChain's MergerRetriever.
+    A retriever which fails or misses the deadline contributes no documents,
+    and the latency of every retriever is recorded in debug_info. Retrievers
+    run on the bounded retriever_executor, one which missed the deadline
+    keeps its worker until it finishes and is logged then.
+    """
+
+    retrievers: List[BaseRetriever]
+    timeout: float = retriever_timeout
+
+    def _get_relevant_documents(
+        self, query: Dict, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        latencies = [None] * len(self.retrievers)
+        start_time = time.perf_counter()
+
+        def _invoke(i, retriever):
+            retriever_start_time = time.perf_counter()
+            docs = retriever.invoke(
+                query,
+                config={"callbacks": run_manager.get_child(
+                    tag=f"retriever_{i + 1}")},
+            )
+            latencies[i] = time.perf_counter() - retriever_start_time
+            return docs
+
+        futures = [
+            retriever_executor.submit(_invoke, i, retriever)
+            for i, retriever in enumerate(self.retrievers)
+        ]
+        wait(futures, timeout=self.timeout)
+
+        retriever_docs = []
+        retriever_latency = []
+        for i, (retriever, future) in enumerate(zip(self.retrievers, futures)):
+            status = "success"
+            docs = []
+            if not future.done():
+                status = "timeout"
+                logger.warning(
+                    f"retriever {i + 1} {type(retriever).__name__} timed out after {self.timeout}s")
+                # Do not block on it, drop it if it has not started yet
+                if not future.cancel():
+                    future.add_done_callback(
+                        partial(_log_late_retriever, i, retriever, start_time))
+            elif future.exception() is not None:
+                status = "error"
+                logger.error(
+                    f"retriever {i + 1} {type(retriever).__name__} failed: {future.exception()!r}")
+            else:
+                docs = future.result()
+            retriever_docs.append(docs)
+            retriever_latency.append(
+                {
+                    "retriever": type(retriever).__name__,
+                    "index_name": getattr(retriever, "index_name", None),
+                    "status": status,
+                    "latency": latencies[i] if status == "success" else None,
+                }
+            )
+        logger.info(
+            f"retrievers finished in {time.perf_counter() - start_time:.4f} seconds: {retriever_latency}")
+        if isinstance(query, dict) and isinstance(query.get("debug_info"), dict):
+            query["debug_info"]["retriever_latency"] = retriever_latency
+
+        merged_documents = []
+        max_docs = max(map(len, retriever_docs), default=0)
+        for i in range(max_docs):
+            for docs in retriever_docs:
+                if i < len(docs):
+                    merged_documents.append(docs[i])
+        return merged_documents
+
 
 def get_bedrock_kb_retrievers(knowledge_base_id_list, top_k: int):
     retriever_list = [
@@ -90,7 +192,7 @@ def get_custom_qq_retrievers(config: dict):
 
 
 def get_whole_chain(retriever_list, reranker_config):
-    lotr = MergerRetriever(retrievers=retriever_list)
+    lotr = ConcurrentMergerRetriever(retrievers=retriever_list)
     if len(reranker_config):
         default_reranker_config = {
             "enable_debug": False,
@@ -148,6 +250,65 @@ def lambda_handler(event, context=None):
     return {"code": 0, "result": docs}
 
 
+# retrieval key -> Future, lives for one request
+submitted_retrievals = request_cache("submitted_retrievals")
+
+
+def submit_background(fn, *args, **kwargs) -> Future:
+    """Run fn on its own daemon thread and return its future.
+
+    Unlike a shared pool, a task left running by an abandoned request never
+    delays the tasks of later requests, a task cancelled before it starts
+    does not run.
+    """
+    future = Future()
+
+    def _run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=_run, daemon=True).start()
+    return future
+
+
+def retrieval_key(event: dict) -> str:
+    return json.dumps(event, ensure_ascii=False, sort_keys=True, default=str)
+
+
+def submit_retrieval(event: dict) -> Future:
+    """Start a retrieval in the background so later nodes can reuse it.
+
+    The event is copied, as lambda_handler updates the retriever configs
+    in place, and the future is kept for get_submitted_retrieval until the
+    request caches are reset.
+    """
+    key = retrieval_key(event)
+    future = submit_background(lambda_handler, copy.deepcopy(event))
+    submitted_retrievals.put(key, future)
+    return future
+
+
+def get_submitted_retrieval(event: dict):
+    """Return the output of a retrieval submitted with the same event.
+
+    None is returned when there is no such retrieval or it failed, the
+    caller then retrieves by itself.
+    """
+    future = submitted_retrievals.get(retrieval_key(event))
+    if future is None or future.cancelled():
+        return None
+    try:
+        return future.result()
+    except Exception:
+        logger.exception("submitted retrieval failed, retrieve again")
+        submitted_retrievals.pop(retrieval_key(event))
+        return None
+
+
 if __name__ == "__main__":
     query = """test"""
     event = {
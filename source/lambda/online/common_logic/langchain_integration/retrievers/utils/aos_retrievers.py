@@ -1,17 +1,19 @@
-import asyncio
 import json
 import logging
 import os
+import threading
 import traceback
+from concurrent.futures import Future
 from typing import Any, Dict, List, Union
 
 import boto3
+from common_logic.common_utils.cache_utils import LRUCache, request_cache
 from common_logic.common_utils.time_utils import timeit
 from langchain.callbacks.manager import CallbackManagerForRetrieverRun
 from langchain.docstore.document import Document
 from langchain.schema.retriever import BaseRetriever
 from langchain_community.embeddings import BedrockEmbeddings
-from sm_utils import SagemakerEndpointVectorOrCross
+from sm_utils import SagemakerEndpointVectorOrCross, get_runtime_client
 
 from .aos_utils import LLMBotOpenSearchClient
 
@@ -58,6 +60,14 @@ DEFAULT_TEXT_FIELD_NAME = "text"
 DEFAULT_VECTOR_FIELD_NAME = "vector_field"
 DEFAULT_SOURCE_FIELD_NAME = "source"
 
+# Query embeddings are cached per request and across requests in a warm container
+embedding_cache = LRUCache(
+    "embedding", max_size=int(os.environ.get("EMBEDDING_CACHE_SIZE", 512))
+)
+# cache key -> Future, concurrent retrievers of a request wait on one embedding
+request_embedding_cache = request_cache("request_embedding")
+_request_embedding_lock = threading.Lock()
+
 
 def remove_redundancy_debug_info(results):
     # filtered_results = copy.deepcopy(results)
@@ -69,6 +79,40 @@ def remove_redundancy_debug_info(results):
     return filtered_results
 
 
+def get_cached_embedding(cache_key, embed_fn):
+    """
+    Look up an embedding in the request cache, then the container cache,
+    and only call embed_fn when both miss. Callers asking for a key which is
+    being embedded in the same request wait for that embedding
+
+    :param cache_key: tuple of embedding type, endpoint, target model, model type and prompt
+    :param embed_fn: function computing the embedding
+    """
+    with _request_embedding_lock:
+        future = request_embedding_cache.get(cache_key)
+        if future is not None:
+            owner = False
+        else:
+            owner = True
+            future = Future()
+            request_embedding_cache.put(cache_key, future)
+    if not owner:
+        return future.result()
+
+    try:
+        response = embedding_cache.get(cache_key)
+        if response is None:
+            response = embed_fn()
+            embedding_cache.put(cache_key, response)
+    except Exception as e:
+        # let a later caller retry
+        request_embedding_cache.pop(cache_key)
+        future.set_exception(e)
+        raise
+    future.set_result(response)
+    return response
+
+
 @timeit
 def get_similarity_embedding(
     query: str,
@@ -76,16 +120,17 @@ def get_similarity_embedding(
     target_model: str,
     model_type: str = "vector",
 ) -> List[List[float]]:
-    if model_type.lower() == "bedrock":
-        embeddings = BedrockEmbeddings(
-            model_id=embedding_model_endpoint,
-            region_name=bedrock_region,
-            normalize=True
-        )
-        response = embeddings.embed_query(query)
-    else:
+    def _embed():
+        if model_type.lower() == "bedrock":
+            embeddings = BedrockEmbeddings(
+                client=get_runtime_client("bedrock-runtime", bedrock_region),
+                model_id=embedding_model_endpoint,
+                region_name=bedrock_region,
+                normalize=True
+            )
+            return embeddings.embed_query(query)
         query_similarity_embedding_prompt = query
-        response = SagemakerEndpointVectorOrCross(
+        return SagemakerEndpointVectorOrCross(
             prompt=query_similarity_embedding_prompt,
             endpoint_name=embedding_model_endpoint,
             model_type=model_type,
@@ -93,7 +138,12 @@ def get_similarity_embedding(
             region_name=None,
             target_model=target_model,
         )
-    return response
+
+    return get_cached_embedding(
+        ("similarity", embedding_model_endpoint,
+         target_model, model_type.lower(), query),
+        _embed,
+    )
 
 
 @timeit
@@ -105,26 +155,38 @@ def get_relevance_embedding(
     model_type: str = "vector",
 ):
     if model_type == "bedrock":
-        embeddings = BedrockEmbeddings(
-            model_id=embedding_model_endpoint, region_name=bedrock_region)
-        response = embeddings.embed_query(query)
-    else:
-        if model_type == "vector":
-            if query_lang == "zh":
-                query_relevance_embedding_prompt = (
-                    "为这个句子生成表示以用于检索相关文章：" + query
-                )
-            elif query_lang == "en":
-                query_relevance_embedding_prompt = (
-                    "Represent this sentence for searching relevant passages: " + query
-                )
-            else:
-                query_relevance_embedding_prompt = query
-        elif model_type == "m3" or model_type == "bce":
-            query_relevance_embedding_prompt = query
+        def _embed():
+            embeddings = BedrockEmbeddings(
+                client=get_runtime_client("bedrock-runtime", bedrock_region),
+                model_id=embedding_model_endpoint,
+                region_name=bedrock_region,
+            )
+            return embeddings.embed_query(query)
+
+        return get_cached_embedding(
+            ("relevance", embedding_model_endpoint,
+             target_model, model_type, query),
+            _embed,
+        )
+
+    if model_type == "vector":
+        if query_lang == "zh":
+            query_relevance_embedding_prompt = (
+                "为这个句子生成表示以用于检索相关文章：" + query
+            )
+        elif query_lang == "en":
+            query_relevance_embedding_prompt = (
+                "Represent this sentence for searching relevant passages: " + query
+            )
         else:
-            raise ValueError(f"invalid embedding model type: {model_type}")
-        response = SagemakerEndpointVectorOrCross(
+            query_relevance_embedding_prompt = query
+    elif model_type == "m3" or model_type == "bce":
+        query_relevance_embedding_prompt = query
+    else:
+        raise ValueError(f"invalid embedding model type: {model_type}")
+
+    def _embed():
+        return SagemakerEndpointVectorOrCross(
             prompt=query_relevance_embedding_prompt,
             endpoint_name=embedding_model_endpoint,
             model_type=model_type,
@@ -133,7 +195,11 @@ def get_relevance_embedding(
             target_model=target_model,
         )
 
-    return response
+    return get_cached_embedding(
+        ("relevance", embedding_model_endpoint, target_model,
+         model_type, query_relevance_embedding_prompt),
+        _embed,
+    )
 
 
 def get_filter_list(parsed_query: dict):
@@ -214,197 +280,164 @@ def get_doc(file_path, index_name):
     return "\n".join(chunk_text_list)
 
 
-def get_child_context(chunk_id, index_name, window_size):
-    next_content_list = []
-    previous_content_list = []
-    previous_pos = 0
-    next_pos = 0
-    chunk_id_prefix = "-".join(chunk_id.split("-")[:-1])
-    section_id = int(chunk_id.split("-")[-1])
-    previous_section_id = section_id
-    next_section_id = section_id
-    while previous_pos < window_size:
-        previous_section_id -= 1
-        if previous_section_id < 1:
-            break
-        previous_chunk_id = f"{chunk_id_prefix}-{previous_section_id}"
-        opensearch_query_response = aos_client.search(
-            index_name=index_name,
-            query_type="basic",
-            query_term=previous_chunk_id,
-            field="metadata.chunk_id",
-            size=1,
-        )
-        if len(opensearch_query_response["hits"]["hits"]) > 0:
-            r = opensearch_query_response["hits"]["hits"][0]
-            previous_content_list.insert(0, r["_source"]["text"])
-            previous_pos += 1
-        else:
-            break
-    while next_pos < window_size:
-        next_section_id += 1
-        next_chunk_id = f"{chunk_id_prefix}-{next_section_id}"
-        opensearch_query_response = aos_client.search(
-            index_name=index_name,
-            query_type="basic",
-            query_term=next_chunk_id,
-            field="metadata.chunk_id",
-            size=1,
-        )
-        if len(opensearch_query_response["hits"]["hits"]) > 0:
-            r = opensearch_query_response["hits"]["hits"][0]
-            next_content_list.insert(0, r["_source"]["text"])
-            next_pos += 1
-        else:
-            break
-    return [previous_content_list, next_content_list]
-
-
-def get_sibling_context(chunk_id, index_name, window_size):
-    next_content_list = []
-    previous_content_list = []
-    previous_pos = 0
-    next_pos = 0
-    chunk_id_prefix = "-".join(chunk_id.split("-")[:-1])
-    section_id = int(chunk_id.split("-")[-1])
-    previous_section_id = section_id
-    next_section_id = section_id
-    while previous_pos < window_size:
-        previous_section_id -= 1
-        if previous_section_id < 1:
-            break
-        previous_chunk_id = f"{chunk_id_prefix}-{previous_section_id}"
-        opensearch_query_response = aos_client.search(
-            index_name=index_name,
-            query_type="basic",
-            query_term=previous_chunk_id,
-            field="metadata.chunk_id",
-            size=1,
-        )
-        if len(opensearch_query_response["hits"]["hits"]) > 0:
-            r = opensearch_query_response["hits"]["hits"][0]
-            previous_content_list.insert(0, r["_source"]["text"])
-            previous_pos += 1
-        else:
-            break
-    while next_pos < window_size:
-        next_section_id += 1
-        next_chunk_id = f"{chunk_id_prefix}-{next_section_id}"
-        opensearch_query_response = aos_client.search(
-            index_name=index_name,
-            query_type="basic",
-            query_term=next_chunk_id,
-            field="metadata.chunk_id",
-            size=1,
-        )
-        if len(opensearch_query_response["hits"]["hits"]) > 0:
-            r = opensearch_query_response["hits"]["hits"][0]
-            next_content_list.insert(0, r["_source"]["text"])
-            next_pos += 1
-        else:
-            break
-    return [previous_content_list, next_content_list]
+def get_chunks_by_ids(chunk_ids, index_name):
+    """
+    Fetch chunks by chunk id with a single terms query
 
+    :param chunk_ids: chunk ids to fetch
+    :param index_name: Target Index Name
 
-def get_context(aos_hit, index_name, window_size):
-    previous_content_list = []
-    next_content_list = []
-    if "chunk_id" not in aos_hit["_source"]["metadata"]:
-        return previous_content_list, next_content_list
-    chunk_id = aos_hit["_source"]["metadata"]["chunk_id"]
-    inner_previous_content_list, inner_next_content_list = get_sibling_context(
-        chunk_id, index_name, window_size
+    :return: dict mapping chunk id to the chunk's _source
+    """
+    chunk_ids = list(dict.fromkeys(chunk_ids))
+    if not chunk_ids:
+        return {}
+    response = aos_client.search(
+        index_name=index_name,
+        query_type="terms",
+        query_term=chunk_ids,
+        field="metadata.chunk_id.keyword",
+        size=len(chunk_ids),
     )
-    if (
-        len(inner_previous_content_list) == window_size
-        and len(inner_next_content_list) == window_size
-    ):
-        return inner_previous_content_list, inner_next_content_list
+    chunk_dict = {}
+    if not response:
+        return chunk_dict
+    for r in response["hits"]["hits"]:
+        chunk_id = r["_source"]["metadata"].get("chunk_id")
+        if chunk_id and chunk_id not in chunk_dict:
+            chunk_dict[chunk_id] = r["_source"]
+    return chunk_dict
+
+
+def get_sibling_chunk_ids(chunk_id, window_size):
+    """
+    Compute the ids of the neighbouring chunks of a chunk, nearest first
 
-    if "heading_hierarchy" not in aos_hit["_source"]["metadata"]:
-        return [previous_content_list, next_content_list]
-    if "previous" in aos_hit["_source"]["metadata"]["heading_hierarchy"]:
-        previous_chunk_id = aos_hit["_source"]["metadata"]["heading_hierarchy"][
-            "previous"
+    :param chunk_id: chunk id like $1-abcd1234-3
+    :param window_size: number of neighbours on each side
+
+    :return: [previous_chunk_ids, next_chunk_ids], or None if the id
+        has no numeric section suffix
+    """
+    try:
+        chunk_id_prefix = "-".join(chunk_id.split("-")[:-1])
+        section_id = int(chunk_id.split("-")[-1])
+    except ValueError:
+        return None
+    if not chunk_id_prefix:
+        return None
+    previous_chunk_ids = [
+        f"{chunk_id_prefix}-{section_id - i}"
+        for i in range(1, window_size + 1)
+        if section_id - i >= 1
+    ]
+    next_chunk_ids = [
+        f"{chunk_id_prefix}-{section_id + i}" for i in range(1, window_size + 1)
+    ]
+    return [previous_chunk_ids, next_chunk_ids]
+
+
+def _collect_contiguous(chunk_ids, chunk_dict):
+    content_list = []
+    for chunk_id in chunk_ids:
+        if chunk_id not in chunk_dict:
+            break
+        content_list.append(chunk_dict[chunk_id]["text"])
+    return content_list
+
+
+def _walk_heading_hierarchy(walk_list, index_name, window_size):
+    """
+    Walk the heading_hierarchy previous/next links of several hits at once,
+    fetching one step of every walk per request
+
+    :param walk_list: list of [start_chunk_id, direction, content_list]
+    """
+    for _ in range(window_size):
+        frontier = [
+            walk for walk in walk_list
+            if walk[0] and walk[0].startswith("$")
         ]
-        previous_pos = 0
-        while (
-            previous_chunk_id
-            and previous_chunk_id.startswith("$")
-            and previous_pos < window_size
-        ):
-            opensearch_query_response = aos_client.search(
-                index_name=index_name,
-                query_type="basic",
-                query_term=previous_chunk_id,
-                field="metadata.chunk_id",
-                size=1,
-            )
-            if len(opensearch_query_response["hits"]["hits"]) > 0:
-                r = opensearch_query_response["hits"]["hits"][0]
-                previous_chunk_id = r["_source"]["metadata"]["heading_hierarchy"][
-                    "previous"
-                ]
-                previous_content_list.insert(0, r["_source"]["text"])
-                previous_pos += 1
-            else:
-                break
-    if "next" in aos_hit["_source"]["metadata"]["heading_hierarchy"]:
-        next_chunk_id = aos_hit["_source"]["metadata"]["heading_hierarchy"]["next"]
-        next_pos = 0
-        while (
-            next_chunk_id and next_chunk_id.startswith(
-                "$") and next_pos < window_size
-        ):
-            opensearch_query_response = aos_client.search(
-                index_name=index_name,
-                query_type="basic",
-                query_term=next_chunk_id,
-                field="metadata.chunk_id",
-                size=1,
-            )
-            if len(opensearch_query_response["hits"]["hits"]) > 0:
-                r = opensearch_query_response["hits"]["hits"][0]
-                next_chunk_id = r["_source"]["metadata"]["heading_hierarchy"]["next"]
-                next_content_list.append(r["_source"]["text"])
-                next_pos += 1
-            else:
-                break
-    return [previous_content_list, next_content_list]
-
-
-def get_parent_content(previous_chunk_id, next_chunk_id, index_name):
-    previous_content_list = []
-    while previous_chunk_id.startswith("$"):
-        opensearch_query_response = aos_client.search(
-            index_name=index_name,
-            query_type="basic",
-            query_term=previous_chunk_id,
-            field="metadata.chunk_id",
-            size=10,
-        )
-        if len(opensearch_query_response["hits"]["hits"]) > 0:
-            r = opensearch_query_response["hits"]["hits"][0]
-            previous_chunk_id = r["_source"]["metadata"]["chunk_id"]
-            previous_content_list.append(r["_source"]["text"])
-        else:
+        if not frontier:
             break
-    next_content_list = []
-    while next_chunk_id.startswith("$"):
-        opensearch_query_response = aos_client.search(
-            index_name=index_name,
-            query_type="basic",
-            query_term=next_chunk_id,
-            field="metadata.chunk_id",
-            size=10,
+        chunk_dict = get_chunks_by_ids([walk[0] for walk in frontier], index_name)
+        for walk in frontier:
+            chunk_id, direction, content_list = walk
+            if chunk_id not in chunk_dict:
+                walk[0] = None
+                continue
+            source = chunk_dict[chunk_id]
+            if direction == "previous":
+                content_list.insert(0, source["text"])
+            else:
+                content_list.append(source["text"])
+            walk[0] = source["metadata"].get(
+                "heading_hierarchy", {}).get(direction)
+
+
+@timeit
+def get_batch_context(aos_hits, index_name, window_size):
+    """
+    Get the previous and next context of every hit
+
+    Neighbour chunk ids are computed up front and fetched with one request,
+    hits whose neighbours cannot be found that way fall back to walking the
+    heading_hierarchy links, one batched request per step.
+
+    :param aos_hits: aos hits
+    :param index_name: Target Index Name
+    :param window_size: number of neighbours on each side
+
+    :return: list of [previous_content_list, next_content_list] per hit,
+        both in document order
+    """
+    context_list = [[[], []] for _ in aos_hits]
+    if not window_size:
+        return context_list
+    sibling_id_list = []
+    for aos_hit in aos_hits:
+        chunk_id = aos_hit["_source"]["metadata"].get("chunk_id")
+        sibling_id_list.append(
+            get_sibling_chunk_ids(chunk_id, window_size) if chunk_id else None
         )
-        if len(opensearch_query_response["hits"]["hits"]) > 0:
-            r = opensearch_query_response["hits"]["hits"][0]
-            next_chunk_id = r["_source"]["metadata"]["chunk_id"]
-            next_content_list.append(r["_source"]["text"])
-        else:
-            break
-    return [previous_content_list, next_content_list]
+    chunk_dict = get_chunks_by_ids(
+        [
+            chunk_id
+            for sibling_ids in sibling_id_list
+            if sibling_ids
+            for chunk_id in sibling_ids[0] + sibling_ids[1]
+        ],
+        index_name,
+    )
+
+    walk_list = []
+    for aos_hit, sibling_ids, context in zip(
+        aos_hits, sibling_id_list, context_list
+    ):
+        metadata = aos_hit["_source"]["metadata"]
+        if "chunk_id" not in metadata:
+            continue
+        if sibling_ids:
+            previous_content_list = _collect_contiguous(
+                sibling_ids[0], chunk_dict)
+            next_content_list = _collect_contiguous(sibling_ids[1], chunk_dict)
+            if (
+                len(previous_content_list) == window_size
+                and len(next_content_list) == window_size
+            ):
+                context[0] = previous_content_list[::-1]
+                context[1] = next_content_list
+                continue
+        heading_hierarchy = metadata.get("heading_hierarchy")
+        if not heading_hierarchy:
+            continue
+        for direction, content_list in zip(["previous", "next"], context):
+            if direction in heading_hierarchy:
+                walk_list.append(
+                    [heading_hierarchy[direction], direction, content_list]
+                )
+    _walk_heading_hierarchy(walk_list, index_name, window_size)
+    return context_list
 
 
 def organize_faq_results(
@@ -538,22 +571,6 @@ class QueryDocumentKNNRetriever(BaseRetriever):
     enable_debug: bool = False
     lang: str = "zh"
 
-    async def __ainvoke_get_context(self, aos_hit, window_size, loop):
-        return await loop.run_in_executor(
-            None, get_context, aos_hit, self.index_name, window_size
-
-        )
-    async def __spawn_task(self, aos_hits, context_size):
-        loop = asyncio.get_event_loop()
-        task_list = []
-        for aos_hit in aos_hits:
-            if context_size:
-                task = asyncio.create_task(
-                    self.__ainvoke_get_context(aos_hit, context_size, loop)
-                )
-                task_list.append(task)
-        return await asyncio.gather(*task_list)
-
     @timeit
     def organize_results(
         self,
@@ -592,8 +609,8 @@ class QueryDocumentKNNRetriever(BaseRetriever):
                     if doc:
                         result["doc"] = doc
             else:
-                response_list = asyncio.run(
-                    self.__spawn_task(aos_hits, context_size))
+                response_list = get_batch_context(
+                    aos_hits, aos_index, context_size)
                 for context, result in zip(response_list, results):
                     result["doc"] = "\n".join(
                         context[0] + [result["content"]] + context[1])
@@ -682,22 +699,6 @@ class QueryDocumentBM25Retriever(BaseRetriever):
     enable_debug: Any
     config: Dict = {"run_name": "BM25"}
 
-    async def __ainvoke_get_context(self, aos_hit, window_size, loop):
-        return await loop.run_in_executor(
-            None, get_context, aos_hit, self.index_name, window_size
-        )
-
-    async def __spawn_task(self, aos_hits, context_size):
-        loop = asyncio.get_event_loop()
-        task_list = []
-        for aos_hit in aos_hits:
-            if context_size:
-                task = asyncio.create_task(
-                    self.__ainvoke_get_context(aos_hit, context_size, loop)
-                )
-                task_list.append(task)
-        return await asyncio.gather(*task_list)
-
     @timeit
     def organize_results(
         self,
@@ -755,17 +756,11 @@ class QueryDocumentBM25Retriever(BaseRetriever):
                 if doc:
                     result["doc"] = doc
         else:
-            response_list = asyncio.run(
-                self.__spawn_task(aos_hits, context_size))
+            response_list = get_batch_context(
+                aos_hits, aos_index, context_size)
             for context, result in zip(response_list, results):
                 result["doc"] = "\n".join(
                     context[0] + [result["doc"]] + context[1])
-            # context = get_context(aos_hit['_source']["metadata"]["heading_hierarchy"]["previous"],
-            #                     aos_hit['_source']["metadata"]["heading_hierarchy"]["next"],
-            #                     aos_index,
-            #                     context_size)
-            # if context:
-            #     result["doc"] = "\n".join(context[0] + [result["doc"]] + context[1])
         return results
 
     @timeit
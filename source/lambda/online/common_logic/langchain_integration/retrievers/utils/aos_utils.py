@@ -1,11 +1,17 @@
 import os
 import threading
+import time
 
 import boto3
 from opensearchpy import OpenSearch, RequestsHttpConnection
 from requests_aws4auth import AWS4Auth
 
 open_search_client_lock = threading.Lock()
+index_metadata_cache_lock = threading.Lock()
+
+# Seconds an index lookup stays valid in the warm container
+INDEX_METADATA_CACHE_TTL = int(os.environ.get("AOS_INDEX_CACHE_TTL", 300))
+INDEX_NOT_FOUND_CACHE_TTL = int(os.environ.get("AOS_INDEX_NOT_FOUND_CACHE_TTL", 30))
 
 credentials = boto3.Session().get_credentials()
 
@@ -32,8 +38,24 @@ def _import_not_found_error():
     return NotFoundError
 
 
+def _get_vector_dimensions(properties, prefix=""):
+    """Collect the dimension of every knn_vector field in an index mapping."""
+    vector_dimensions = {}
+    for field, field_mapping in properties.items():
+        if field_mapping.get("type") == "knn_vector":
+            vector_dimensions[prefix + field] = field_mapping.get("dimension")
+        elif "properties" in field_mapping:
+            vector_dimensions.update(
+                _get_vector_dimensions(
+                    field_mapping["properties"], f"{prefix}{field}.")
+            )
+    return vector_dimensions
+
+
 class LLMBotOpenSearchClient:
     instance = None
+    # (host, index_name) -> (expire_time, index metadata or None)
+    index_metadata_cache = {}
 
     def __new__(cls, host, auth=None):
         with open_search_client_lock:
@@ -65,6 +87,7 @@ class LLMBotOpenSearchClient:
             "exact": self._build_exactly_match_query,
             "fuzzy": self._build_fuzzy_search_query,
             "basic": self._build_basic_search_query,
+            "terms": self._build_terms_query,
         }
 
     def _build_basic_search_query(
@@ -147,6 +170,24 @@ class LLMBotOpenSearchClient:
             }
         return query
 
+    def _build_terms_query(self, index_name, query_term, field, size, filter=None):
+        """
+        Build terms query
+
+        :param index_name: Target Index Name
+        :param query_term: list of exact values to match
+        :param field: search field
+        :param size: number of results to return from aos
+
+        :return: aos response json
+        """
+        query = {
+            "size": size,
+            "query": {"terms": {field: query_term}},
+            "_source": {"excludes": ["*.additional_vecs", "vector_field"]},
+        }
+        return query
+
     def _build_exactly_match_query(self, index_name, query_term, field, size):
         """
         Build exactly match query
@@ -206,12 +247,58 @@ class LLMBotOpenSearchClient:
         :return: aos response json
         """
         not_found_error = _import_not_found_error()
-        try:
-            self.client.indices.get(index=index_name)
-        except not_found_error:
+        if self.get_index_metadata(index_name) is None:
             return []
         query = self.query_match[query_type](
             index_name, query_term, field, size, filter
         )
-        response = self.client.search(body=query, index=index_name)
+        try:
+            response = self.client.search(body=query, index=index_name)
+        except not_found_error:
+            self.invalidate_index_metadata(index_name)
+            return []
         return response
+
+    def get_index_metadata(self, index_name):
+        """
+        Get index metadata, cached per container for INDEX_METADATA_CACHE_TTL
+
+        :param index_name: Target Index Name
+
+        :return: dict with mappings and vector_dimensions, None if the index does not exist
+        """
+        cache_key = (self.host, index_name)
+        now = time.time()
+        with index_metadata_cache_lock:
+            cached = self.index_metadata_cache.get(cache_key)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+        not_found_error = _import_not_found_error()
+        try:
+            response = self.client.indices.get(index=index_name)
+        except not_found_error:
+            with index_metadata_cache_lock:
+                self.index_metadata_cache[cache_key] = (
+                    now + INDEX_NOT_FOUND_CACHE_TTL, None)
+            return None
+        index_info = next(iter(response.values()), {})
+        mappings = index_info.get("mappings", {})
+        index_metadata = {
+            "mappings": mappings,
+            "vector_dimensions": _get_vector_dimensions(
+                mappings.get("properties", {})),
+        }
+        with index_metadata_cache_lock:
+            self.index_metadata_cache[cache_key] = (
+                now + INDEX_METADATA_CACHE_TTL, index_metadata)
+        return index_metadata
+
+    def invalidate_index_metadata(self, index_name):
+        """
+        Drop the cached metadata of an index
+
+        :param index_name: Target Index Name
+        """
+        with index_metadata_cache_lock:
+            self.index_metadata_cache.pop((self.host, index_name), None)
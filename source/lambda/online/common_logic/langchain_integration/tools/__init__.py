@@ -1,8 +1,9 @@
 from typing import Optional,Union
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, create_model
 import platform
 import json 
 import inspect 
+import hashlib
 from functools import wraps
 import types 
 
@@ -29,13 +30,85 @@ class ToolIdentifier(BaseModel):
         return f"{self.scene}__{self.name}"
 
 
+# json schema types which can be built without code generation
+JSON_SCHEMA_TYPE_MAP = {
+    "string": str,
+    "integer": int,
+    "number": float,
+    "boolean": bool,
+    "array": list,
+    "object": dict,
+}
+SIMPLE_SCHEMA_KEYS = {"type", "title", "description", "properties", "required"}
+SIMPLE_PROPERTY_KEYS = {"type", "title", "description", "items"}
+
+
+def get_fingerprint(obj) -> str:
+    return hashlib.sha256(
+        json.dumps(obj, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
 class ToolManager:
     tool_map = {}
+    # tool_id -> fingerprint of the definition the registered tool was built from
+    tool_fingerprint_map = {}
+    # schema fingerprint -> pydantic model
+    pydantic_model_cache = {}
+
+    @staticmethod
+    def _get_simple_field_type(property_def:dict):
+        if not set(property_def) <= SIMPLE_PROPERTY_KEYS:
+            return None
+        field_type = JSON_SCHEMA_TYPE_MAP.get(property_def.get("type"))
+        if field_type is list and "items" in property_def:
+            items = property_def["items"]
+            item_type = ToolManager._get_simple_field_type(items) if isinstance(items, dict) else None
+            if item_type is None or item_type in (list, dict):
+                return None
+            return list[item_type]
+        if "items" in property_def:
+            return None
+        return field_type
+
+    @staticmethod
+    def build_pydantic_model_from_schema(tool_def:dict):
+        """Build a pydantic model directly from a flat json schema.
+        Returns None when the schema needs datamodel_code_generator.
+        """
+        if not set(tool_def) <= SIMPLE_SCHEMA_KEYS or tool_def.get("type", "object") != "object":
+            return None
+        required = set(tool_def.get("required", []))
+        fields = {}
+        for name, property_def in tool_def.get("properties", {}).items():
+            if not isinstance(property_def, dict) or not name.isidentifier() or name.startswith("_"):
+                return None
+            field_type = ToolManager._get_simple_field_type(property_def)
+            if field_type is None:
+                return None
+            if name in required:
+                fields[name] = (field_type, Field(..., description=property_def.get("description")))
+            else:
+                fields[name] = (Optional[field_type], Field(None, description=property_def.get("description")))
+        return create_model("Model", __doc__=tool_def.get("description"), **fields)
 
     @staticmethod
     def convert_tool_def_to_pydantic(tool_id,tool_def:Union[dict,BaseModel]):
         if not isinstance(tool_def,dict):
             return tool_def 
+        # models are cached by schema content, identical schemas are only built once
+        schema_fingerprint = get_fingerprint(tool_def)
+        model_cls = ToolManager.pydantic_model_cache.get(schema_fingerprint)
+        if model_cls is not None:
+            return model_cls
+        model_cls = ToolManager.build_pydantic_model_from_schema(tool_def)
+        if model_cls is None:
+            model_cls = ToolManager._generate_pydantic_model(tool_id,tool_def)
+        ToolManager.pydantic_model_cache[schema_fingerprint] = model_cls
+        return model_cls
+
+    @staticmethod
+    def _generate_pydantic_model(tool_id,tool_def:dict):
         # convert tool definition to pydantic model 
         current_python_version = ".".join(platform.python_version().split(".")[:-1])
         data_model_types = get_data_model_types(
@@ -66,6 +139,14 @@ class ToolManager:
             tool_identifier = ToolIdentifier(scene=scene,name=name)
         return tool_identifier
 
+    @classmethod
+    def get_registered_tool(cls,tool_identifier:ToolIdentifier,fingerprint:str):
+        """Return the registered tool if it was built from the same definition."""
+        tool_id = tool_identifier.tool_id
+        if tool_id in cls.tool_map and cls.tool_fingerprint_map.get(tool_id) == fingerprint:
+            return cls.tool_map[tool_id]
+        return None
+
 
     @classmethod
     def register_lc_tool(
@@ -82,6 +163,7 @@ class ToolManager:
         )
         assert isinstance(tool,BaseTool),(tool,type(tool))
         cls.tool_map[tool_identifier.tool_id] = tool 
+        cls.tool_fingerprint_map.pop(tool_identifier.tool_id, None)
         return tool
     
 
@@ -135,6 +217,10 @@ class ToolManager:
             name=name,
             tool_identifier=tool_identifier
         )
+        fingerprint = get_fingerprint([lambda_name, tool_def, return_direct])
+        tool = cls.get_registered_tool(tool_identifier, fingerprint)
+        if tool is not None:
+            return tool
         tool = StructuredTool.from_function(
             func=_func,
             name=tool_identifier.name,
@@ -144,10 +230,12 @@ class ToolManager:
             ),
             return_direct=return_direct
         )
-        return ToolManager.register_lc_tool(
+        tool = ToolManager.register_lc_tool(
             tool_identifier=tool_identifier,
             tool=tool
         )
+        cls.tool_fingerprint_map[tool_identifier.tool_id] = fingerprint
+        return tool
 
     @classmethod
     def register_common_rag_tool(
@@ -167,6 +255,18 @@ class ToolManager:
             name=name,
             tool_identifier=tool_identifier
         )
+        # rag_tool overwrites the query of retriever_config on every call
+        fingerprint = get_fingerprint([
+            {k: v for k, v in retriever_config.items() if k != "query"},
+            description,
+            return_direct
+        ])
+        tool = cls.get_registered_tool(tool_identifier, fingerprint)
+        if tool is not None:
+            # rag_tool and the retriever update the config in place, bind the
+            # config of the current request instead of the first one
+            tool.func = partial(rag_tool, retriever_config=retriever_config)
+            return tool
 
         class RagModel(BaseModel):
             class Config:
@@ -186,10 +286,12 @@ class ToolManager:
             response_format="content_and_artifact"
         )
         
-        return ToolManager.register_lc_tool(
+        tool = ToolManager.register_lc_tool(
             tool_identifier=tool_identifier,
             tool=tool
         )
+        cls.tool_fingerprint_map[tool_identifier.tool_id] = fingerprint
+        return tool
         
 
     @classmethod
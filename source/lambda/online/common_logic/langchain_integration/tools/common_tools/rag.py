@@ -4,7 +4,10 @@ from common_logic.common_utils.constant import (
     LLMTaskType
 )
 from common_logic.common_utils.lambda_invoke_utils import send_trace
-from common_logic.langchain_integration.retrievers.retriever import lambda_handler as retrieve_fn
+from common_logic.langchain_integration.retrievers.retriever import (
+    get_submitted_retrieval,
+    lambda_handler as retrieve_fn,
+)
 from common_logic.langchain_integration.chains import LLMChain
 from common_logic.common_utils.monitor_utils import format_rag_data
 
@@ -19,7 +22,10 @@ def rag_tool(retriever_config: dict, query=None):
     retriever_params = retriever_config
     retriever_params["query"] = query or state[retriever_config.get(
         "query_key", "query")]
-    output = retrieve_fn(retriever_params)
+    # reuse the retrieval started by intention detection for the same query
+    output = get_submitted_retrieval(retriever_params)
+    if output is None:
+        output = retrieve_fn(retriever_params)
 
     for doc in output["result"]["docs"]:
         context_list.append(doc["page_content"])
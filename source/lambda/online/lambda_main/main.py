@@ -1,18 +1,23 @@
 import os
+import time
 import traceback
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
 import boto3
 from botocore.exceptions import ClientError
-from common_logic.common_utils.constant import EntryType
-from common_logic.common_utils.ddb_utils import DynamoDBChatMessageHistory
+from common_logic.common_utils.cache_utils import get_cache_stats, reset_request_caches
+from common_logic.common_utils.chatbot_utils import ChatbotManager
+from common_logic.common_utils.constant import EntryType, LLMModelType
+from common_logic.common_utils.ddb_utils import CHAT_HISTORY_MAX_ROUNDS, DynamoDBChatMessageHistory
 from common_logic.common_utils.lambda_invoke_utils import (
     chatbot_lambda_call_wrapper,
     is_running_local,
     send_trace
 )
 from common_logic.common_utils.logger_utils import get_logger
+from common_logic.common_utils.prompt_utils import prefetch_prompt_templates
 from common_logic.common_utils.websocket_utils import load_ws_client
 from lambda_main.main_utils.online_entries import get_entry
 from common_logic.common_utils.response_utils import process_response
@@ -42,6 +47,11 @@ connect_domain_id = os.environ.get("CONNECT_DOMAIN_ID", "")
 connect_user_arn = os.environ.get("CONNECT_USER_ARN", "")
 kb_enabled = os.environ["KNOWLEDGE_BASE_ENABLED"]
 kb_type = os.environ["KNOWLEDGE_BASE_TYPE"]
+# Runs the request bootstrap steps concurrently, shared in the warm container
+bootstrap_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("BOOTSTRAP_WORKERS", 8)),
+    thread_name_prefix="bootstrap",
+)
 
 
 def get_secret_value(secret_arn: str):
@@ -87,6 +97,101 @@ def create_ddb_history_obj(session_id: str, user_id: str, client_type: str) -> D
     )
 
 
+def load_chat_history(ddb_history_obj: DynamoDBChatMessageHistory, chatbot_config: dict) -> list:
+    """Load the latest rounds of chat history used by the chains
+
+    Args:
+        ddb_history_obj (DynamoDBChatMessageHistory): The history of the session
+        chatbot_config (dict): The chatbot config of the request, its context_round
+            sets the number of rounds, CHAT_HISTORY_MAX_ROUNDS by default
+
+    Returns:
+        list: The chat history, empty when use_history is disabled
+    """
+    if str(chatbot_config.get("use_history", "true")).lower() != "true":
+        return []
+    max_rounds = int(chatbot_config.get("context_round", CHAT_HISTORY_MAX_ROUNDS))
+    return ddb_history_obj.get_recent_messages_as_langchain(max_rounds)
+
+
+def _collect_model_ids(config) -> list:
+    """Collect the model ids set anywhere in a raw chatbot config"""
+    model_ids = []
+    if isinstance(config, dict):
+        for key, value in config.items():
+            if key == "model_id" and isinstance(value, str):
+                model_ids.append(value)
+            else:
+                model_ids.extend(_collect_model_ids(value))
+    elif isinstance(config, list):
+        for value in config:
+            model_ids.extend(_collect_model_ids(value))
+    return model_ids
+
+
+def _timed(timings: dict, name: str, func, *args):
+    start = time.time()
+    try:
+        return func(*args)
+    finally:
+        timings[name] = time.time() - start
+
+
+def bootstrap_request(ddb_history_obj: DynamoDBChatMessageHistory, chatbot_config: dict, group_name: str, chatbot_id: str):
+    """Load the chat history while prefetching the chatbot with its indexes and
+    models and the prompt templates of the request concurrently. The prefetched
+    items land in the request caches the entry reads them from, so the setup
+    costs the slowest of them instead of their sum.
+
+    Args:
+        ddb_history_obj (DynamoDBChatMessageHistory): The history of the session
+        chatbot_config (dict): The raw chatbot config of the request
+        group_name (str): The group of the chatbot
+        chatbot_id (str): The chatbot id
+
+    Returns:
+        tuple: The chat history and the seconds each step took
+    """
+    timings = {}
+    start = time.time()
+    history_future = bootstrap_executor.submit(
+        _timed, timings, "chat_history", load_chat_history, ddb_history_obj, chatbot_config)
+    prefetch_futures = [bootstrap_executor.submit(
+        _timed, timings, "chatbot", ChatbotManager.from_environ().get_chatbot, group_name, chatbot_id)]
+    scene = chatbot_config.get("scene", "common")
+    # the default llm config applies wherever the request sets no model
+    model_ids = dict.fromkeys(
+        _collect_model_ids(chatbot_config) + [LLMModelType.CLAUDE_3_SONNET])
+    # llm results generation reads the prompts of the admin chatbot
+    for prompt_chatbot_id in dict.fromkeys([chatbot_id, "admin"]):
+        for model_id in model_ids:
+            prefetch_futures.append(bootstrap_executor.submit(
+                _timed, timings, f"prompt {model_id} {prompt_chatbot_id}",
+                prefetch_prompt_templates, group_name, model_id, prompt_chatbot_id, scene))
+
+    for future in prefetch_futures:
+        try:
+            future.result()
+        except Exception as e:
+            # the entry loads the item again and surfaces the error
+            logger.warning(f"bootstrap prefetch failed: {e}")
+    chat_history = history_future.result()
+    timings["all"] = time.time() - start
+    return chat_history, timings
+
+
+def send_bootstrap_trace(timings: dict, chatbot_config: dict, stream: bool, ws_connection_id: str):
+    timings_md = "\n".join(
+        f"- {name}: {elapsed:.3f}s" for name, elapsed in timings.items())
+    send_trace(
+        f"\n\n**bootstrap:**\n{timings_md}\n\n",
+        current_stream_use=stream,
+        ws_connection_id=ws_connection_id,
+        enable_trace=str(chatbot_config.get(
+            "enable_trace", "true")).lower() == "true",
+    )
+
+
 def compose_connect_body(event_body: dict, context: dict):
     """
     Compose the body for the Amazon Connect API request based on the event and context.
@@ -138,7 +243,8 @@ def compose_connect_body(event_body: dict, context: dict):
         user_id=user_id,
         client_type=client_type,
     )
-    chat_history = ddb_history_obj.messages_as_langchain
+    history_config = {"context_round": context_round} if context_round else {}
+    chat_history = load_chat_history(ddb_history_obj, history_config)
 
     agent_flow_body = {}
     agent_flow_body["query"] = query
@@ -270,7 +376,11 @@ def restapi_event_handler(event_body: dict, context: dict, entry_executor):
 
     ddb_history_obj = create_ddb_history_obj(
         assembled_body["session_id"], assembled_body["user_id"], assembled_body["client_type"])
-    chat_history = ddb_history_obj.messages_as_langchain
+    chat_history, bootstrap_timings = bootstrap_request(
+        ddb_history_obj, event_body.get("chatbot_config", {}),
+        assembled_body["group_name"], assembled_body["chatbot_id"])
+    send_bootstrap_trace(
+        bootstrap_timings, event_body.get("chatbot_config", {}), False, None)
 
     standard_event_body = {
         "query": event_body["query"],
@@ -327,7 +437,11 @@ def default_event_handler(event_body: dict, context: dict, entry_executor):
 
     ddb_history_obj = create_ddb_history_obj(
         assembled_body["session_id"], assembled_body["user_id"], assembled_body["client_type"])
-    chat_history = ddb_history_obj.messages_as_langchain
+    chat_history, bootstrap_timings = bootstrap_request(
+        ddb_history_obj, event_body["chatbot_config"],
+        assembled_body["group_name"], assembled_body["chatbot_id"])
+    send_bootstrap_trace(
+        bootstrap_timings, event_body["chatbot_config"], context["stream"], ws_connection_id)
 
     event_body["stream"] = context["stream"]
     event_body["chat_history"] = chat_history
@@ -355,6 +469,7 @@ def default_event_handler(event_body: dict, context: dict, entry_executor):
 def lambda_handler(event_body: dict, context: dict):
     logger.info(f"Raw event_body: {event_body}")
     entry_type = event_body.get("entry_type", EntryType.COMMON).lower()
+    reset_request_caches()
     try:
         entry_executor = get_entry(entry_type)
         stream = context["stream"]
@@ -377,3 +492,5 @@ def lambda_handler(event_body: dict, context: dict):
         process_response(event_body, error_response)
         logger.error(f"{traceback.format_exc()}\nAn error occurred: {str(e)}")
         return {"error": str(e)}
+    finally:
+        logger.info(f"cache stats: {get_cache_stats()}")
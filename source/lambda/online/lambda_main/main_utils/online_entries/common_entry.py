@@ -1,3 +1,4 @@
+import os
 import traceback
 import json
 import uuid
@@ -32,7 +33,12 @@ from common_logic.common_utils.monitor_utils import format_intention_output, for
 from common_logic.common_utils.ddb_utils import custom_index_desc
 from lambda_main.main_utils.parse_config import CommonConfigParser
 from langgraph.graph import END, StateGraph
-from common_logic.langchain_integration.retrievers.retriever import lambda_handler as retrieve_fn
+from common_logic.langchain_integration.retrievers.retriever import (
+    get_submitted_retrieval,
+    lambda_handler as retrieve_fn,
+    submit_background,
+    submit_retrieval,
+)
 from common_logic.common_utils.monitor_utils import (
     format_preprocess_output,
     format_qq_data,
@@ -45,6 +51,11 @@ from common_logic.common_utils.serialization_utils import JSONEncoder
 
 
 logger = get_logger("common_entry")
+# Run the qq match retrieval concurrently with the intention retrieval, or
+# with the all knowledge retrieval when only the rag tool is used, at the
+# cost of retrievals a qq match hit makes unnecessary
+speculative_retrieval = os.environ.get(
+    "SPECULATIVE_RETRIEVAL", "true").lower() == "true"
 
 
 class ChatbotState(TypedDict):
@@ -155,6 +166,45 @@ def query_preprocess(state: ChatbotState):
     return {"query_rewrite": output}
 
 
+def set_retriever_query(retriever_params: dict, state: ChatbotState):
+    retriever_params["query"] = state[
+        retriever_params.get("retriever_config", {}).get("query_key", "query")
+    ]
+    return retriever_params
+
+
+def submit_intention_retrievals(state: ChatbotState):
+    """Start the retrievals intention_detection needs next to the qq match.
+
+    The all knowledge retrieval is only started ahead when the rag tool is
+    the only tool, it is submitted with the same event the
+    all_knowledge_rag_tool builds so the tool reuses its output.
+    """
+    chatbot_config = state["chatbot_config"]
+    futures = {}
+    futures["qq_match"] = submit_retrieval(chatbot_config["qq_match_config"])
+    if chatbot_config["agent_config"]["only_use_rag_tool"]:
+        futures["all_knowledge"] = submit_retrieval(
+            set_retriever_query(chatbot_config["private_knowledge_config"], state))
+        return futures
+
+    intention_config = chatbot_config.get("intention_config", {})
+    query_key = intention_config.get(
+        "retriever_config", {}).get("query_key", "query")
+    futures["intention"] = submit_background(
+        get_intention_results,
+        state[query_key],
+        {**intention_config},
+        intent_threshold=intention_config["intent_threshold"],
+    )
+    futures["custom_qd_index"] = submit_background(
+        custom_index_desc,
+        chatbot_config["group_name"],
+        chatbot_config["chatbot_id"],
+    )
+    return futures
+
+
 @node_monitor_wrapper
 def intention_detection(state: ChatbotState):
     retriever_params = state["chatbot_config"]["qq_match_config"]
@@ -162,7 +212,12 @@ def intention_detection(state: ChatbotState):
         retriever_params.get("retriever_config", {}).get("query_key", "query")
     ]
 
-    output = retrieve_fn(retriever_params)
+    futures = {}
+    if speculative_retrieval:
+        futures = submit_intention_retrievals(state)
+        output = futures["qq_match"].result()
+    else:
+        output = retrieve_fn(retriever_params)
     context_list = []
     qq_match_contexts = []
     qq_match_threshold = retriever_params["qq_match_threshold"]
@@ -170,6 +225,9 @@ def intention_detection(state: ChatbotState):
 
     for doc in output["result"]["docs"]:
         if doc["retrieval_score"] > qq_match_threshold:
+            # the answer is found, drop the retrievals not started yet
+            for future in futures.values():
+                future.cancel()
             doc_md = format_qq_data(doc)
             send_trace(
                 f"\n\n**similar query found**\n\n{doc_md}",
@@ -203,13 +261,16 @@ def intention_detection(state: ChatbotState):
     query = state[query_key]
     intent_threshold = intention_config['intent_threshold']
     all_knowledge_in_agent_threshold = intention_config['all_knowledge_in_agent_threshold']
-    intent_fewshot_examples, intention_ready = get_intention_results(
-        query,
-        {
-            **intention_config,
-        },
-        intent_threshold=intent_threshold
-    )
+    if futures:
+        intent_fewshot_examples, intention_ready = futures["intention"].result()
+    else:
+        intent_fewshot_examples, intention_ready = get_intention_results(
+            query,
+            {
+                **intention_config,
+            },
+            intent_threshold=intent_threshold
+        )
 
     intent_fewshot_tools: list[str] = list(
         set([e["intent"] for e in intent_fewshot_examples])
@@ -219,18 +280,25 @@ def intention_detection(state: ChatbotState):
 
     group_name = state["chatbot_config"]["group_name"]
     chatbot_id = state["chatbot_config"]["chatbot_id"]
-    custom_qd_index = custom_index_desc(group_name, chatbot_id)
+    if futures:
+        custom_qd_index = futures["custom_qd_index"].result()
+    else:
+        custom_qd_index = custom_index_desc(group_name, chatbot_id)
 
     # TODO need to modify with new intent logic
     if not intention_ready and not custom_qd_index:
         # if not intention_ready:
         # retrieve all knowledge
-        retriever_params = state["chatbot_config"]["private_knowledge_config"]
-        retriever_params["query"] = state[
-            retriever_params.get("retriever_config", {}).get(
-                "query_key", "query")
-        ]
-        output = retrieve_fn(retriever_params)
+        retriever_params = set_retriever_query(
+            state["chatbot_config"]["private_knowledge_config"], state)
+        if futures:
+            # submitted so the all_knowledge_rag_tool can reuse the output
+            submit_retrieval(retriever_params)
+            output = get_submitted_retrieval(retriever_params)
+        else:
+            output = None
+        if output is None:
+            output = retrieve_fn(retriever_params)
 
         info_to_log = []
         all_knowledge_retrieved_list = []
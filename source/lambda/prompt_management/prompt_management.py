@@ -57,6 +57,8 @@ def __put_prompt(event, group_name):
             "Prompt": body.get("Prompt"),
             # "LastModifiedBy": email,
             "LastModifiedTime": str(int(time.time())),
+            # Lets the online prompt cache detect changes
+            "Version": str(time.time_ns()),
         }
     )
     return {"Message": "OK"}
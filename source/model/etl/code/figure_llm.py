@@ -1,15 +1,67 @@
 import boto3
 import logging
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
 import re
 import io
 import base64
 import json
 
+# Number of figures understood concurrently per document
+figure_workers = int(os.environ.get('FIGURE_LLM_WORKERS', 4))
+# 'bedrock' calls Bedrock, 'local' uses LocalLLMClient for offline runs
+figure_llm_client = os.environ.get('FIGURE_LLM_CLIENT', 'bedrock')
+
+
+class LocalLLMClient():
+    """
+    Stands in for the bedrock-runtime client without network access. Every
+    invoke_model call returns the same canned text and is recorded in calls.
+    """
+    def __init__(self, text='local figure description'):
+        self.text = text
+        self.calls = []
+    def invoke_model(self, body, modelId):
+        self.calls.append((modelId, json.loads(body)))
+        response_body = json.dumps({'content': [{'type': 'text', 'text': self.text}]})
+        return {'body': io.BytesIO(response_body.encode('utf-8'))}
+
+
+def image_hash(img):
+    """Content hash of a PIL image, identical figures share the same hash."""
+    digest = hashlib.sha256()
+    digest.update(f'{img.mode}{img.size}'.encode('utf-8'))
+    digest.update(img.tobytes())
+    return digest.hexdigest()
+
+
+def format_figure(figure_type, s3_link, description, value=None):
+    output = f'\n<figure>\n<type>{figure_type}</type>\n<link>{s3_link}</link>\n<desp>\n{description}\n</desp>\n'
+    if value is not None:
+        output += f'<value>\n{value}\n</value>\n'
+    return output + '</figure>\n'
+
+
 class figureUnderstand():
-    def __init__(self):
-        self.bedrock_runtime = boto3.client(service_name='bedrock-runtime')
+    def __init__(self, bedrock_runtime=None, max_workers=figure_workers):
+        if bedrock_runtime is None:
+            if figure_llm_client == 'local':
+                bedrock_runtime = LocalLLMClient()
+            else:
+                # boto3 clients are thread safe, size the pool for the workers
+                bedrock_runtime = boto3.client(
+                    service_name='bedrock-runtime',
+                    config=Config(max_pool_connections=max(10, max_workers)))
+        self.bedrock_runtime = bedrock_runtime
+        self.max_workers = max_workers
         self.mermaid_prompt = json.load(open('prompt/mermaid.json', 'r'))
+        with open('prompt/figure_classification.txt') as f:
+            self.figure_classification_prompt = f.read()
+        with open('prompt/mermaid_template.txt') as f:
+            self.mermaid_template = f.read()
     def invoke_llm(self, img, prompt, prefix="<output>", stop="</output>"):
         image_stream = io.BytesIO()
         img.save(image_stream, format="JPEG")
@@ -47,9 +99,7 @@ class figureUnderstand():
         result = prefix + response_body['content'][0]['text'] + stop
         return result
     def get_classification(self, img):
-        with open('prompt/figure_classification.txt') as f:
-            figure_classification_prompt = f.read()
-        output = self.invoke_llm(img, figure_classification_prompt)
+        output = self.invoke_llm(img, self.figure_classification_prompt)
         return output
     def get_chart(self, img, context, tag):
         prompt = '''您是文档阅读专家。您的任务是将图片中的图表转换成Markdown格式。以下是说明：
@@ -86,9 +136,7 @@ class figureUnderstand():
         output = self.invoke_llm(img, prompt.format(context=context, tag=tag))
         return f'![{output}]()'
     def get_mermaid(self, img, classification):
-        with open('prompt/mermaid_template.txt') as f:
-            mermaid_prompt = f.read()
-        prompt = mermaid_prompt.format(diagram_type=classification, diagram_example=self.mermaid_prompt[classification])
+        prompt = self.mermaid_template.format(diagram_type=classification, diagram_example=self.mermaid_prompt[classification])
         output = self.invoke_llm(img, prompt, prefix='<description>', stop='</mermaid>')
         return output
     def parse_result(self, llm_output, tag):
@@ -98,7 +146,13 @@ class figureUnderstand():
         except:
             output = llm_output.replace(f"<{tag}>", '').replace(f"</{tag}>", '')
         return output
-    def __call__(self, img, context, tag, s3_link):
+    def understand(self, img, context, tag):
+        """
+        Describes one figure with the LLM.
+
+        Returns:
+            tuple: The figure type, its description and its value, None for images.
+        """
         classification = self.get_classification(img)
         classification = self.parse_result(classification, 'output')
         if classification in self.mermaid_prompt:
@@ -108,11 +162,36 @@ class figureUnderstand():
             if classification in ('XY Chart', 'Pie chart diagrams'):
                 table = self.get_chart(img, context, tag)
                 table = self.parse_result(table, 'output')
-                output = f'\n<figure>\n<type>chart</type>\n<link>{s3_link}</link>\n<desp>\n{description}\n</desp>\n<value>\n{table}\n</value>\n</figure>\n'
-            else:
-                output = f'\n<figure>\n<type>chart-mermaid</type>\n<link>{s3_link}</link>\n<desp>\n{description}\n</desp>\n<value>\n{mermaid_code}\n</value>\n</figure>\n'
-        else:
-            description = self.get_description(img, context, tag)
-            description = self.parse_result(description, 'output')
-            output = f'\n<figure>\n<type>image</type>\n<link>{s3_link}</link>\n<desp>\n{description}\n</desp>\n</figure>\n'
-        return output
\ No newline at end of file
+                return 'chart', description, table
+            return 'chart-mermaid', description, mermaid_code
+        description = self.get_description(img, context, tag)
+        description = self.parse_result(description, 'output')
+        return 'image', description, None
+    def __call__(self, img, context, tag, s3_link):
+        figure_type, description, value = self.understand(img, context, tag)
+        return format_figure(figure_type, s3_link, description, value)
+    def understand_figures(self, figures):
+        """
+        Understands the figures of one document on max_workers threads.
+        Figures with identical content, such as logos and repeated headers,
+        are sent to the LLM once using the context of their first occurrence.
+
+        Args:
+            figures (list): (img, context, tag, s3_link) tuples.
+
+        Returns:
+            list: The formatted figure of each input, in input order.
+        """
+        hashes = [image_hash(img) for img, _, _, _ in figures]
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for key, (img, context, tag, _) in zip(hashes, figures):
+                if key not in futures:
+                    futures[key] = executor.submit(self.understand, img, context, tag)
+            outputs = []
+            for key, (_, _, _, s3_link) in zip(hashes, figures):
+                figure_type, description, value = futures[key].result()
+                outputs.append(format_figure(figure_type, s3_link, description, value))
+        if len(futures) < len(figures):
+            logging.info("Understood %d figures, %d duplicates reused", len(futures), len(figures) - len(futures))
+        return outputs
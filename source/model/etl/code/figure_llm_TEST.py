@@ -0,0 +1,39 @@
+from PIL import Image
+
+import figure_llm
+from figure_llm import LocalLLMClient, figureUnderstand
+
+
+def test_understand_figures_dedup():
+    # run from source/model/etl/code so that the prompt files are found
+    client = LocalLLMClient()
+    figure_understand = figureUnderstand(bedrock_runtime=client, max_workers=2)
+    img = Image.new('RGB', (64, 64), color=(255, 0, 0))
+    figures = [
+        (img, 'context of the first figure', '[FIGURE0]', 'image/00000.jpg'),
+        (img.copy(), 'context of the second figure', '[FIGURE1]', 'image/00001.jpg'),
+    ]
+    outputs = figure_understand.understand_figures(figures)
+
+    # the identical figures are understood once, a classification and a
+    # description call
+    assert len(client.calls) == 2, client.calls
+    assert '<link>image/00000.jpg</link>' in outputs[0]
+    assert '<link>image/00001.jpg</link>' in outputs[1]
+    assert outputs[0].replace('00000', '00001') == outputs[1]
+    print(outputs)
+
+
+def test_local_client():
+    # FIGURE_LLM_CLIENT=local runs without bedrock access
+    figure_llm.figure_llm_client = 'local'
+    figure_understand = figureUnderstand()
+    assert isinstance(figure_understand.bedrock_runtime, LocalLLMClient)
+    img = Image.new('RGB', (32, 32), color=(0, 0, 255))
+    output = figure_understand(img, 'context', '[FIGURE0]', 'image/00000.jpg')
+    assert 'local figure description' in output, output
+
+
+if __name__ == "__main__":
+    test_understand_figures_dedup()
+    test_local_client()
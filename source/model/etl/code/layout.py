@@ -19,6 +19,7 @@ import time
 
 from utils import preprocess, multiclass_nms, postprocess
 import onnxruntime
+from onnx_utils import get_session_options
 import GPUtil
 if len(GPUtil.getGPUs()):
     provider = [("CUDAExecutionProvider", {"cudnn_conv_algo_search": "HEURISTIC"}), "CPUExecutionProvider"]
@@ -29,7 +30,7 @@ else:
 
 class LayoutPredictor(object):
     def __init__(self):
-        self.ort_session = onnxruntime.InferenceSession(os.path.join(os.environ['MODEL_PATH'], model), providers=provider)
+        self.ort_session = onnxruntime.InferenceSession(os.path.join(os.environ['MODEL_PATH'], model), sess_options=get_session_options(), providers=provider)
         #_ = self.ort_session.run(['output'], {'images': np.zeros((1,3,640,640), dtype='float32')})[0]
         self.categorys = ['text', 'title', 'figure', 'table']
     def __call__(self, img):
@@ -5,6 +5,9 @@ import logging
 import os
 import re
 import subprocess
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from ocr import TextSystem
@@ -12,7 +15,8 @@ from table import TableSystem
 from layout import LayoutPredictor
 import numpy as np
 from markdownify import markdownify as md
-from utils import check_and_read
+from utils import check_and_read, get_pdf_page_count, read_pdf_page
+from onnx_utils import page_workers
 from figure_llm import figureUnderstand
 from xycut import recursive_xy_cut
 import time
@@ -23,10 +27,112 @@ import io
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Scales of the page the text detector runs at to estimate the text line
+# height for auto dpi, "1,0.66,0.33" reproduces the former three pass estimation
+DPI_SCALE_BASES = [float(scale) for scale in os.environ.get('OCR_DPI_SCALE_BASES', '0.5').split(',')]
+# Pages of a document running the estimation, later pages reuse their scale
+DPI_SAMPLE_PAGES = int(os.environ.get('OCR_DPI_SAMPLE_PAGES', 3))
+# Write the markdown page by page with a multipart upload instead of building
+# the whole document in memory, can be overridden by the request. Turning it
+# off falls back to the whole document path, where figure contexts may span
+# pages
+STREAMING_OUTPUT = os.environ.get('OCR_STREAMING_OUTPUT', 'true').lower() == 'true'
+OUTPUT_PART_SIZE = int(os.environ.get('OCR_OUTPUT_PART_SIZE', 8 * 1024 * 1024))
+
+def crop_padded_region(img, x1, y1, x2, y2):
+    """
+    Crops the region with a margin of up to its own size on every side, the
+    margin is filled with the same constant as a blank page canvas. Equivalent
+    to pasting the region into a page sized canvas and cropping that, without
+    allocating the page sized canvas.
+
+    Returns:
+        tuple: The padded crop and the left and top margin.
+    """
+    h, w = img.shape[:2]
+    top = min(y2-y1, y1)
+    left = min(x2-x1, x1)
+    win_y1 = min(y2+(y2-y1), h)
+    win_x1 = min(x2+(x2-x1), w)
+    window = np.ones(
+        (max(win_y1-(y1-top), 0), max(win_x1-(x1-left), 0), img.shape[2]),
+        dtype=img.dtype)
+    roi_img = img[y1:y2, x1:x2, :]
+    window[top:top+roi_img.shape[0], left:left+roi_img.shape[1], :] = roi_img
+    return window, left, top
+
+
+def assign_boxes_to_regions(dt_boxes, regions):
+    """
+    Assigns text boxes detected on the whole page to the layout regions
+    containing their center, the smallest region wins for nested regions.
+
+    Returns:
+        dict: region index -> list of boxes
+    """
+    region_boxes = {}
+    if dt_boxes is None:
+        return region_boxes
+    for box in dt_boxes:
+        cx, cy = box[:, 0].mean(), box[:, 1].mean()
+        owner, owner_area = None, None
+        for idx, (x1, y1, x2, y2) in regions.items():
+            if x1 <= cx < x2 and y1 <= cy < y2:
+                area = (x2-x1) * (y2-y1)
+                if owner is None or area < owner_area:
+                    owner, owner_area = idx, area
+        if owner is not None:
+            region_boxes.setdefault(owner, []).append(box)
+    return region_boxes
+
+
+class DpiEstimator(object):
+    """
+    Estimates the scale that brings the small text lines of a page to the
+    height the recognizer works best with. Pages of one document usually share
+    their typography, so only the first sample_pages pages run the text
+    detector for it and later pages reuse the largest scale found.
+    """
+    def __init__(self, sample_pages=DPI_SAMPLE_PAGES, scale_bases=DPI_SCALE_BASES):
+        self.sample_pages = sample_pages
+        self.scale_bases = scale_bases
+        self.scales = []
+        self.lock = threading.Lock()
+
+    def __call__(self, img, text_detector, lang):
+        with self.lock:
+            if self.sample_pages > 0 and len(self.scales) >= self.sample_pages:
+                return max(self.scales)
+        scale = self.estimate(img, text_detector, lang)
+        with self.lock:
+            self.scales.append(scale)
+        return scale
+
+    def estimate(self, img, text_detector, lang):
+        final_s = 0
+        height_limit =  18 if lang=='ch' else 15
+        for scale_base in self.scale_bases:
+            img_cur_scale = cv2.resize(img, (None, None), fx=scale_base, fy=scale_base)
+            temp_result = text_detector(img_cur_scale, scale=1)
+            height_list = [max(text_line[:, 1]) - min(text_line[:, 1]) for text_line in temp_result]
+            height_list.sort()
+            if len(height_list) == 0:
+                min_text_line_h = 2*height_limit
+            else:
+                min_text_line_h = height_list[int(len(height_list)*0.05)]
+            min_s = (height_limit/min_text_line_h)*scale_base
+            if min_s>final_s:
+                final_s = min_s
+        return final_s
+
+
 class StructureSystem(object):
     def __init__(self):
         self.mode = 'structure'
         self.recovery = True
+        # crop: detect text on a padded crop of every region
+        # page: detect text once per page and assign the boxes to regions
+        self.region_det = os.environ.get('OCR_REGION_DET', 'crop')
         drop_score = 0
         # init model
         self.layout_predictor = LayoutPredictor()
@@ -34,10 +140,11 @@ class StructureSystem(object):
         self.table_system = TableSystem(
             self.text_system.text_detector,
             self.text_system.text_recognizer)
-    def __call__(self, img, return_ocr_result_in_table=False, lang='ch', auto_dpi=False):
+    def __call__(self, img, return_ocr_result_in_table=False, lang='ch', auto_dpi=False, dpi_estimator=None):
         time_dict = {
             'image_orientation': 0,
             'layout': 0,
+            'dpi': 0,
             'table': 0,
             'table_match': 0,
             'det': 0,
@@ -49,51 +156,76 @@ class StructureSystem(object):
             lang = 'ch'
         start = time.time()
         ori_im_shape = img.shape
-        ori_im_dtype = img.dtype
         layout_res, elapse = self.layout_predictor(img)
         final_s = None
         if auto_dpi:
-            final_s = 0
-            height_limit =  18 if lang=='ch' else 15
-            for scale_base in [1, 0.66, 0.33]:
-                img_cur_scale = cv2.resize(img, (None, None), fx=scale_base, fy=scale_base)
-                temp_result = self.text_system.text_detector[lang](img_cur_scale, scale=1)
-                height_list = [max(text_line[:, 1]) - min(text_line[:, 1]) for text_line in temp_result]
-                height_list.sort()
-                if len(height_list) == 0:
-                    min_text_line_h = 2*height_limit
-                else:
-                    min_text_line_h = height_list[int(len(height_list)*0.05)]
-                min_s = (height_limit/min_text_line_h)*scale_base
-                if min_s>final_s:
-                    final_s = min_s
+            tic = time.time()
+            if dpi_estimator is None:
+                dpi_estimator = DpiEstimator(sample_pages=0)
+            final_s = dpi_estimator(img, self.text_system.text_detector[lang], lang)
+            time_dict['dpi'] += time.time() - tic
         time_dict['layout'] += elapse
-        res_list = []
+        region_bboxes = []
         for region in layout_res:
-            res = ''
             if region['bbox'] is not None:
                 x1, y1, x2, y2 = region['bbox']
                 x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
                 x1, y1, x2, y2 = max(x1, 0), max(y1, 0), max(x2, 0), max(y2, 0)
-                roi_img = img[y1:y2, x1:x2, :]
             else:
-                x1, y1, x2, y2 = 0, 0, w, h
-                roi_img = img
+                x1, y1, x2, y2 = 0, 0, ori_im_shape[1], ori_im_shape[0]
+            region_bboxes.append((x1, y1, x2, y2))
+        page_region_boxes = None
+        if self.region_det == 'page':
+            tic = time.time()
+            page_region_boxes = assign_boxes_to_regions(
+                self.text_system.text_detector[lang](img, final_s),
+                {idx: bbox for idx, bbox in enumerate(region_bboxes)
+                 if layout_res[idx]['label'] != 'table'})
+            time_dict['det'] += time.time() - tic
+        # Detect and crop the text lines of every region first, then recognize
+        # the lines of all regions of the page in shared batches
+        region_crops = []
+        for region_idx, region in enumerate(layout_res):
+            x1, y1, x2, y2 = region_bboxes[region_idx]
+            roi_img = img[y1:y2, x1:x2, :]
             if region['label'] == 'table':
-                res, table_time_dict = self.table_system(
-                    roi_img, return_ocr_result_in_table, lang)
-                time_dict['table'] += table_time_dict['table']
-                time_dict['table_match'] += table_time_dict['match']
-                time_dict['det'] += table_time_dict['det']
-                time_dict['rec'] += table_time_dict['rec']
-            else:
-                wht_im = np.ones(ori_im_shape, dtype=ori_im_dtype)
-                wht_im[y1:y2, x1:x2, :] = roi_img
+                prepared = self.table_system.prepare(roi_img, lang)
+                time_dict['table'] += prepared['time_dict']['table']
+                time_dict['det'] += prepared['time_dict']['det']
+                region_crops.append((prepared, prepared['img_crop_list']))
+            elif page_region_boxes is not None:
                 top = min(y2-y1, y1)
                 left = min(x2-x1, x1)
-                cur_wht_im = wht_im[y1-top:min(y2+(y2-y1), wht_im.shape[0]), x1-left:min(x2+(x2-x1), wht_im.shape[1])]
-                filter_boxes, filter_rec_res = self.text_system(
-                    cur_wht_im, lang, final_s)
+                dt_boxes, img_crop_list = self.text_system.crop(
+                    img, np.array(page_region_boxes.get(region_idx, [])))
+                # Same coordinates as detecting on the padded region crop
+                dt_boxes = [box - [x1-left, y1-top] for box in dt_boxes]
+                region_crops.append((dt_boxes, img_crop_list))
+            else:
+                cur_wht_im, left, top = crop_padded_region(img, x1, y1, x2, y2)
+                tic = time.time()
+                dt_boxes = self.text_system.text_detector[lang](cur_wht_im, final_s)
+                time_dict['det'] += time.time() - tic
+                region_crops.append(self.text_system.crop(cur_wht_im, dt_boxes))
+
+        tic = time.time()
+        rec_res_lists = self.text_system.recognize_batch(
+            [img_crop_list for _, img_crop_list in region_crops], lang)
+        time_dict['rec'] += time.time() - tic
+
+        res_list = []
+        for region_idx, region in enumerate(layout_res):
+            x1, y1, x2, y2 = region_bboxes[region_idx]
+            roi_img = img[y1:y2, x1:x2, :]
+            region_data, _ = region_crops[region_idx]
+            rec_res_list = rec_res_lists[region_idx]
+            if region['label'] == 'table':
+                res, table_time_dict = self.table_system.finish(
+                    region_data, rec_res_list, return_ocr_result_in_table)
+                time_dict['table_match'] += table_time_dict['match']
+            else:
+                filter_boxes, filter_rec_res = self.text_system.filter(
+                    region_data, rec_res_list)
 
                 # remove style char,
                 # when using the recognition model trained on the PubtabNet dataset,
@@ -104,6 +236,8 @@ class StructureSystem(object):
                     '</overline>', '<underline>', '</underline>', '<i>',
                     '</i>'
                 ]
+                top = min(y2-y1, y1)
+                left = min(x2-x1, x1)
                 res = []
                 for box, rec_res in zip(filter_boxes, filter_rec_res):
                     rec_str, rec_conf = rec_res
@@ -152,13 +286,17 @@ def upload_images_to_s3(
     return name_s3path
 
 
-def upload_chunk_to_s3(
-    logger_content: str, bucket: str, prefix: str, splitting_type: str
-):
+def chunk_object_key(prefix: str, splitting_type: str):
     # round the timestamp to hours to avoid too many folders
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d-%H")
     # make the logger file name unique
-    object_key = f"{prefix}/{splitting_type}/{timestamp}/{datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S-%f')}.log"
+    return f"{prefix}/{splitting_type}/{timestamp}/{datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S-%f')}.log"
+
+
+def upload_chunk_to_s3(
+    logger_content: str, bucket: str, prefix: str, splitting_type: str
+):
+    object_key = chunk_object_key(prefix, splitting_type)
     try:
         res = s3.put_object(Bucket=bucket, Key=object_key, Body=logger_content)
         logger.info("Upload logger file to S3: %s", res)
@@ -168,6 +306,48 @@ def upload_chunk_to_s3(
         return None
 
 
+class S3MultipartWriter:
+    """
+    Writes text to an S3 object with a multipart upload, only the current
+    part is kept in memory. S3 requires every part but the last to be at
+    least 5MB.
+    """
+
+    def __init__(self, bucket: str, object_key: str, part_size: int = OUTPUT_PART_SIZE):
+        self.bucket = bucket
+        self.object_key = object_key
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+        self.buffer = io.BytesIO()
+        self.parts = []
+        self.upload_id = s3.create_multipart_upload(
+            Bucket=bucket, Key=object_key)["UploadId"]
+
+    def write(self, text: str):
+        self.buffer.write(text.encode("utf-8"))
+        if self.buffer.tell() >= self.part_size:
+            self._upload_part()
+
+    def _upload_part(self):
+        part_number = len(self.parts) + 1
+        res = s3.upload_part(
+            Bucket=self.bucket, Key=self.object_key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=self.buffer.getvalue())
+        self.parts.append({"ETag": res["ETag"], "PartNumber": part_number})
+        self.buffer = io.BytesIO()
+
+    def close(self):
+        if self.buffer.tell() > 0 or not self.parts:
+            self._upload_part()
+        s3.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.object_key, UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts})
+        logger.info("Upload %d parts to S3: %s", len(self.parts), self.object_key)
+
+    def abort(self):
+        s3.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.object_key, UploadId=self.upload_id)
+
+
 def remove_symbols(text):
     """
     Removes symbols from the given text using regular expressions.
@@ -182,49 +362,90 @@ def remove_symbols(text):
     return cleaned_text
 
 
-def structure_predict(file_path: Path, lang: str, auto_dpi, figure_rec) -> str:
+def predict_page(img, lang, auto_dpi, dpi_estimator=None):
     """
-    Extracts structured information from images in the given file path and returns a formatted document.
-
-    Args:
-        file_path (Path): The path to the file containing the images.
+    Runs the structure engine on one page and sorts its regions in reading order.
 
     Returns:
-        str: The formatted document containing the extracted information.
+        tuple: The sorted regions and the time_dict of the page.
     """
+    result, time_dict = structure_engine(
+        img, lang=lang, auto_dpi=auto_dpi, dpi_estimator=dpi_estimator)
+    if result == []:
+        return [], time_dict
+    boxes = [row["bbox"] for row in result]
+    res = []
+    recursive_xy_cut(np.asarray(boxes).astype(int), np.arange(len(boxes)), res)
+    return [result[idx] for idx in res], time_dict
 
-    # img_list, flag_gif, flag_pdf are returned from check_and_read
-    #img_list, _, _ = check_and_read(file_path)
 
-    all_res = []
-    for index, img in enumerate(check_and_read(file_path)):
-        result, _ = structure_engine(img, lang=lang, auto_dpi=auto_dpi)
-        if result != []:
-            boxes = [row["bbox"] for row in result]
-            res = []
-            recursive_xy_cut(np.asarray(boxes).astype(int), np.arange(len(boxes)), res)
-            result_sorted = [result[idx] for idx in res]
-            all_res += result_sorted
+def predict_pdf_pages(file_path, lang, auto_dpi, dpi_estimator=None):
+    """
+    Rasterizes and predicts the pages of a pdf on page_workers threads. ONNX
+    sessions release the GIL while running, so pages are predicted in
+    parallel, while rasterizing is serialized as PyMuPDF is not thread safe.
+    Results are yielded in page order, at most 2 * page_workers pages are in
+    flight so a slow consumer does not pile up finished pages.
+    """
+    def _predict(page_index):
+        return predict_page(
+            read_pdf_page(file_path, page_index), lang, auto_dpi, dpi_estimator)
+
+    page_count = get_pdf_page_count(file_path)
+    with ThreadPoolExecutor(max_workers=page_workers) as executor:
+        pending = deque()
+        for page_index in range(page_count):
+            pending.append(executor.submit(_predict, page_index))
+            if len(pending) >= 2 * page_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def predict_pages(file_path, lang, auto_dpi, dpi_estimator):
+    """Yields the sorted regions and time_dict of each page of the file."""
+    if str(file_path).lower().endswith(".pdf") and page_workers > 1:
+        yield from predict_pdf_pages(file_path, lang, auto_dpi, dpi_estimator)
+    else:
+        for img in check_and_read(file_path):
+            yield predict_page(img, lang, auto_dpi, dpi_estimator)
+
+
+def regions_to_markdown(regions, figure_rec, prev_region_text="", figure_start=0):
+    """
+    Converts sorted regions to markdown, figures are left as placeholders.
+    The region image arrays are views of the page, they are released once the
+    figures are copied out so the page buffer can be freed.
+
+    Args:
+        regions (list): The sorted regions of one or more pages.
+        figure_rec (bool): Whether the figures will be understood by the LLM.
+        prev_region_text (str): The text of the last region before regions, used to drop repeated text.
+        figure_start (int): The index of the first figure of regions in the document.
+
+    Returns:
+        tuple: The markdown, the placeholder to [image, ocr text] dict and the text of the last region.
+    """
     doc = ""
-    prev_region_text = ""
     figure = {}
-    for _, region in enumerate(all_res):
+    for _, region in enumerate(regions):
+        region_img = region.pop("img", None)
         if len(region["res"]) == 0:
             continue
         if region["type"].lower() == "figure":
             region_text = ""
+            placeholder = '<{{figure_' + str(figure_start + len(figure)) + '}}>'
+            doc += placeholder + '\n'
             if figure_rec:
-                doc += '<{{figure_' + str(len(figure)) + '}}>\n'
-                figure['<{{figure_' + str(len(figure)) + '}}>'] = [Image.fromarray(region["img"][:,:,::-1]), None]
+                figure[placeholder] = [Image.fromarray(region_img[:,:,::-1]), None]
             else:
-                doc += '<{{figure_' + str(len(figure)) + '}}>\n'
                 for _, line in enumerate(region["res"]):
                     region_text += line["text"] + " "
                 if remove_symbols(region_text) != remove_symbols(prev_region_text):
-                    figure['<{{figure_' + str(len(figure)) + '}}>'] = [Image.fromarray(region["img"][:,:,::-1]), region_text]
+                    figure[placeholder] = [Image.fromarray(region_img[:,:,::-1]), region_text]
                     prev_region_text = region_text
                 else:
-                    figure['<{{figure_' + str(len(figure)) + '}}>'] = [Image.fromarray(region["img"][:,:,::-1]), None]
+                    figure[placeholder] = [Image.fromarray(region_img[:,:,::-1]), None]
             
         elif region["type"].lower() == "title":
             region_text = ''
@@ -259,19 +480,89 @@ def structure_predict(file_path: Path, lang: str, auto_dpi, figure_rec) -> str:
 
         doc += "\n\n"
     doc = re.sub("\n{2,}", "\n\n", doc.strip())
+    return doc, figure, prev_region_text
+
+
+def resolve_figures(doc, figure, figure_rec, figure_start=0):
+    """
+    Replaces the figure placeholders of doc with the figure markdown.
+
+    Returns:
+        tuple: The markdown and the image name to image dict.
+    """
     images = {}
-    for figure_idx, (k,v) in enumerate(figure.items()):
+    figure_jobs = []
+    for figure_idx, (k,v) in enumerate(figure.items(), figure_start):
         images[f'{figure_idx:05d}.jpg'] = v[0]
-        region_text = v[1] if not v[1] is None else ''
         if figure_rec:
             start_pos = doc.index(k)
             context = doc[max(start_pos-200, 0): min(start_pos+200, len(doc))]
-            doc = doc.replace(k, figure_understand(v[0], context, k, s3_link=f'{figure_idx:05d}.jpg'))
+            figure_jobs.append((v[0], context, k, f'{figure_idx:05d}.jpg'))
         else:
+            region_text = v[1] if not v[1] is None else ''
             doc = doc.replace(k, f"\n<figure>\n<link>{figure_idx:05d}.jpg</link>\n<type>ocr</type>\n<desp>\n{region_text}\n</desp>\n</figure>\n")
+    if figure_jobs:
+        # Contexts are taken before any placeholder is replaced, so figures
+        # are independent and understood concurrently
+        start = time.time()
+        outputs = figure_understand.understand_figures(figure_jobs)
+        for (_, _, k, _), output in zip(figure_jobs, outputs):
+            doc = doc.replace(k, output)
+        logger.info("Figure understanding time: %s", time.time() - start)
     doc = re.sub("\n{2,}", "\n\n", doc.strip())
     return doc, images
 
+
+def structure_predict(file_path: Path, lang: str, auto_dpi, figure_rec) -> str:
+    """
+    Extracts structured information from images in the given file path and returns a formatted document.
+
+    Args:
+        file_path (Path): The path to the file containing the images.
+
+    Returns:
+        str: The formatted document containing the extracted information.
+    """
+
+    # img_list, flag_gif, flag_pdf are returned from check_and_read
+    #img_list, _, _ = check_and_read(file_path)
+
+    # The dpi scale is estimated once per document
+    dpi_estimator = DpiEstimator()
+    all_res = []
+    doc_time_dict = {}
+    for result_sorted, time_dict in predict_pages(file_path, lang, auto_dpi, dpi_estimator):
+        all_res += result_sorted
+        for key, value in time_dict.items():
+            doc_time_dict[key] = doc_time_dict.get(key, 0) + value
+    logger.info("Structure time of %s: %s", file_path, doc_time_dict)
+    doc, figure, _ = regions_to_markdown(all_res, figure_rec)
+    return resolve_figures(doc, figure, figure_rec)
+
+
+def structure_predict_stream(file_path: Path, lang: str, auto_dpi, figure_rec):
+    """
+    Streaming version of structure_predict, the markdown of each page is
+    yielded as soon as the page and its figures are done and nothing of the
+    page is kept afterwards. The context of a figure is limited to its page.
+
+    Yields:
+        tuple: The markdown and the image name to image dict of a page.
+    """
+    dpi_estimator = DpiEstimator()
+    doc_time_dict = {}
+    prev_region_text = ""
+    figure_count = 0
+    for result_sorted, time_dict in predict_pages(file_path, lang, auto_dpi, dpi_estimator):
+        for key, value in time_dict.items():
+            doc_time_dict[key] = doc_time_dict.get(key, 0) + value
+        doc, figure, prev_region_text = regions_to_markdown(
+            result_sorted, figure_rec, prev_region_text, figure_count)
+        doc, images = resolve_figures(doc, figure, figure_rec, figure_count)
+        figure_count += len(figure)
+        yield doc, images
+    logger.info("Structure time of %s: %s", file_path, doc_time_dict)
+
 def process_pdf_pipeline(request_body):
     """
     Process PDF pipeline.
@@ -284,6 +575,7 @@ def process_pdf_pipeline(request_body):
             - portal_bucket (str): The portal S3 bucket name
             - mode (str, optional): The processing mode. Defaults to "ppstructure".
             - lang (str, optional): The language of the PDF. Defaults to "zh".
+            - streaming (bool, optional): Write the markdown page by page. Defaults to OCR_STREAMING_OUTPUT.
 
     Returns:
         dict: The result of the pipeline containing the following key:
@@ -297,6 +589,7 @@ def process_pdf_pipeline(request_body):
     lang = request_body.get("lang", "zh")
     auto_dpi = bool(request_body.get("auto_dpi", True))
     figure_rec = bool(request_body.get("figure_recognition", True))
+    streaming = bool(request_body.get("streaming", STREAMING_OUTPUT))
     logging.info("Processing bucket: %s, object_key: %s", bucket, object_key)
     local_path = str(os.path.basename(object_key))
     local_path = f"/tmp/{local_path}"
@@ -304,8 +597,28 @@ def process_pdf_pipeline(request_body):
     logger.info("Downloading %s to %s", object_key, local_path)
     s3.download_file(Bucket=bucket, Key=object_key, Filename=local_path)
 
-    content, images = structure_predict(local_path, lang, auto_dpi, figure_rec)
     filename = file_path.stem
+    if streaming:
+        destination_s3_path = chunk_object_key(filename, "before-splitting")
+        writer = S3MultipartWriter(destination_bucket, destination_s3_path)
+        try:
+            separator = ""
+            for content, images in structure_predict_stream(local_path, lang, auto_dpi, figure_rec):
+                name_s3path = upload_images_to_s3(
+                    images, portal_bucket, filename, "image"
+                )
+                for key, s3_path in name_s3path.items():
+                    content = content.replace(f'<link>{key}</link>', f'<link>{s3_path}</link>')
+                if content:
+                    writer.write(separator + content)
+                    separator = "\n\n"
+            writer.close()
+        except Exception:
+            writer.abort()
+            raise
+        return {"destination_prefix": destination_s3_path}
+
+    content, images = structure_predict(local_path, lang, auto_dpi, figure_rec)
     name_s3path = upload_images_to_s3(
         images, portal_bucket, filename, "image"
     )
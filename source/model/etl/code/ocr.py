@@ -5,6 +5,7 @@ import os
 
 import numpy as np
 import onnxruntime
+from onnx_utils import LazyModelDict, get_session_options, preload_langs
 from PIL import Image, ImageDraw
 import cv2
 from imaug import create_operators, transform
@@ -12,10 +13,13 @@ from postprocess import build_post_process
 import GPUtil
 if len(GPUtil.getGPUs()):
     provider = [("CUDAExecutionProvider", {"cudnn_conv_algo_search": "HEURISTIC"}), "CPUExecutionProvider"]
-    rec_batch_num = 6
+    rec_batch_num = int(os.environ.get('OCR_GPU_REC_BATCH_NUM', 6))
 else:
     provider = ["CPUExecutionProvider"]
-    rec_batch_num = 1
+    rec_batch_num = int(os.environ.get('OCR_CPU_REC_BATCH_NUM', 8))
+# Lines in one recognition batch are padded to the widest one, a batch is
+# closed once the width ratio grows beyond this factor of its narrowest line
+rec_bucket_ratio = float(os.environ.get('OCR_REC_BUCKET_RATIO', 2))
 
 class TextClassifier():
     def __init__(self):
@@ -31,7 +35,7 @@ class TextClassifier():
         }
         self.postprocess_op = build_post_process(postprocess_params)
 
-        self.ort_session = onnxruntime.InferenceSession(self.weights_path, providers=provider)
+        self.ort_session = onnxruntime.InferenceSession(self.weights_path, sess_options=get_session_options(), providers=provider)
 
     def resize_norm_img(self, img):
         imgC, imgH, imgW = self.cls_image_shape
@@ -118,7 +122,7 @@ class TextDetector():
         self.preprocess_op = create_operators(pre_process_list)
         self.preprocess_op_identity = create_operators(pre_process_list_identity)
         self.postprocess_op = build_post_process(postprocess_params)
-        self.ort_session = onnxruntime.InferenceSession(self.weights_path, providers=provider)
+        self.ort_session = onnxruntime.InferenceSession(self.weights_path, sess_options=get_session_options(), providers=provider)
         _ = self.ort_session.run(None, {"x": np.zeros([1, 3, 64, 64], dtype='float32')})
 
     # load_pytorch_weights
@@ -244,7 +248,7 @@ class TextRecognizer():
 
         self.postprocess_op = build_post_process(postprocess_params)
 
-        self.ort_session = onnxruntime.InferenceSession(self.weights_path, providers=provider)
+        self.ort_session = onnxruntime.InferenceSession(self.weights_path, sess_options=get_session_options(), providers=provider)
 
     def resize_norm_img(self, img, max_wh_ratio):
         imgC, imgH, imgW = self.rec_image_shape
@@ -272,6 +276,20 @@ class TextRecognizer():
         padding_im[:, :, 0:resized_w] = resized_image
         return padding_im
 
+    def bucket_batches(self, width_list, indices):
+        """
+        Split the lines sorted by width ratio into batches of at most
+        rec_batch_num lines with similar width ratios, so padding stays small.
+        """
+        batches = []
+        beg_img_no = 0
+        for ino in range(1, len(indices) + 1):
+            if ino == len(indices) or ino - beg_img_no >= self.rec_batch_num or \
+                    width_list[indices[ino]] > rec_bucket_ratio * max(width_list[indices[beg_img_no]], 1):
+                batches.append((beg_img_no, ino))
+                beg_img_no = ino
+        return batches
+
     def __call__(self, img_list):
         img_num = len(img_list)
         # Calculate the aspect ratio of all text bars
@@ -283,9 +301,7 @@ class TextRecognizer():
 
         # rec_res = []
         rec_res = [['', 0.0]] * img_num
-        batch_num = self.rec_batch_num
-        for beg_img_no in range(0, img_num, batch_num):
-            end_img_no = min(img_num, beg_img_no + batch_num)
+        for beg_img_no, end_img_no in self.bucket_batches(width_list, indices):
             norm_img_batch = []
             max_wh_ratio = 0
             for ino in range(beg_img_no, end_img_no):
@@ -333,16 +349,11 @@ def sorted_boxes(dt_boxes):
 class TextSystem:
     def __init__(self):
         #self.text_detector = TextDetector()
-        self.text_detector = {
-            'ch': TextDetector('ch'),
-            'en': TextDetector('en'),
-            'multi': TextDetector('multi'),
-        }
-        self.text_recognizer = {
-            'ch': TextRecognizer('ch'),
-            'en': TextRecognizer('en'),
-            'multi': TextRecognizer('multi'),
-        }
+        # A request only uses one language, models are loaded on first use
+        self.text_detector = LazyModelDict(
+            TextDetector, ['ch', 'en', 'multi'], preload=preload_langs)
+        self.text_recognizer = LazyModelDict(
+            TextRecognizer, ['ch', 'en', 'multi'], preload=preload_langs)
         
         self.drop_score = 0.4
         #self.text_classifier = TextClassifier()
@@ -398,17 +409,42 @@ class TextSystem:
         
         if dt_boxes is None:
             return None, None
+        return self.recognize(ori_im, dt_boxes, lang)
+
+    def recognize(self, img, dt_boxes, lang='ch'):
+        """Recognize the text of already detected boxes of img."""
+        dt_boxes, img_crop_list = self.crop(img, dt_boxes)
+        rec_res = self.text_recognizer[lang](img_crop_list)
+        return self.filter(dt_boxes, rec_res)
+
+    def crop(self, img, dt_boxes):
+        """Sort the boxes in reading order and crop their text lines."""
         img_crop_list = []
 
         dt_boxes = sorted_boxes(dt_boxes)
 
         for bno in range(len(dt_boxes)):
             tmp_box = copy.deepcopy(dt_boxes[bno])
-            img_crop = self.get_rotate_crop_image(ori_im, tmp_box)
+            img_crop = self.get_rotate_crop_image(img, tmp_box)
             img_crop_list.append(img_crop)
         #img_crop_list, angle_list = self.text_classifier(img_crop_list)
+        return dt_boxes, img_crop_list
 
-        rec_res = self.text_recognizer[lang](img_crop_list)
+    def recognize_batch(self, img_crop_lists, lang='ch'):
+        """
+        Recognize the text lines of several regions in shared batches and
+        scatter the results back, one result list per input crop list.
+        """
+        all_crops = [img_crop for img_crop_list in img_crop_lists for img_crop in img_crop_list]
+        all_rec_res = self.text_recognizer[lang](all_crops) if all_crops else []
+        rec_res_lists = []
+        offset = 0
+        for img_crop_list in img_crop_lists:
+            rec_res_lists.append(all_rec_res[offset:offset + len(img_crop_list)])
+            offset += len(img_crop_list)
+        return rec_res_lists
+
+    def filter(self, dt_boxes, rec_res):
         filter_boxes, filter_rec_res = [], []
         for box, rec_reuslt in zip(dt_boxes, rec_res):
             text, score = rec_reuslt
@@ -0,0 +1,72 @@
+import os
+import threading
+
+import onnxruntime
+
+cpu_count = os.cpu_count() or 1
+# Number of pages processed concurrently by structure_predict
+page_workers = int(os.environ.get('OCR_PAGE_WORKERS', max(1, cpu_count // 2)))
+# Threads used by one session run, concurrent pages together keep all cores
+# busy without oversubscribing them
+intra_op_num_threads = int(os.environ.get('ORT_INTRA_OP_NUM_THREADS', max(1, cpu_count // page_workers)))
+inter_op_num_threads = int(os.environ.get('ORT_INTER_OP_NUM_THREADS', 1))
+graph_optimization_level = os.environ.get('ORT_GRAPH_OPTIMIZATION_LEVEL', 'ORT_ENABLE_ALL')
+# The arena keeps the largest buffers seen, detection inputs vary in size so
+# disabling it trades some speed for resident memory
+enable_cpu_mem_arena = os.environ.get('ORT_ENABLE_CPU_MEM_ARENA', 'true').lower() == 'true'
+# Languages whose OCR models are loaded at startup, the others on first use
+preload_langs = [lang for lang in os.environ.get('OCR_PRELOAD_LANGS', 'ch').split(',') if lang]
+
+_session_options = None
+_session_options_lock = threading.Lock()
+
+
+def get_session_options():
+    """Session options shared by all ONNX sessions of the endpoint."""
+    global _session_options
+    with _session_options_lock:
+        if _session_options is None:
+            sess_options = onnxruntime.SessionOptions()
+            sess_options.intra_op_num_threads = intra_op_num_threads
+            sess_options.inter_op_num_threads = inter_op_num_threads
+            sess_options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+            sess_options.graph_optimization_level = getattr(
+                onnxruntime.GraphOptimizationLevel, graph_optimization_level)
+            sess_options.enable_cpu_mem_arena = enable_cpu_mem_arena
+            _session_options = sess_options
+        return _session_options
+
+
+class LazyModelDict(object):
+    """
+    Dict like container which creates the model of a key on first use, so
+    that only the models of the requested languages are loaded.
+
+    Args:
+        factory: called with the key to create its model
+        keys: the valid keys
+        preload: keys whose models are created right away
+    """
+    def __init__(self, factory, keys, preload=()):
+        self.factory = factory
+        self.keys = list(keys)
+        self.models = {}
+        self.lock = threading.Lock()
+        for key in preload:
+            if key in self.keys:
+                self[key]
+
+    def __getitem__(self, key):
+        model = self.models.get(key)
+        if model is None:
+            if key not in self.keys:
+                raise KeyError(key)
+            with self.lock:
+                model = self.models.get(key)
+                if model is None:
+                    model = self.factory(key)
+                    self.models[key] = model
+        return model
+
+    def __contains__(self, key):
+        return key in self.keys
@@ -3,16 +3,13 @@ from postprocess import build_post_process
 from matcher import TableMatch
 import time
 import copy
+import threading
 from imaug import create_operators, transform
 import numpy as np
 import os
 import onnxruntime as ort
+from onnx_utils import get_session_options
 
-sess_options = ort.SessionOptions()
-
-sess_options.intra_op_num_threads = 8
-sess_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
-sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
 def sorted_boxes(dt_boxes):
     """
     Sort text boxes in order from top to bottom, left to right
@@ -46,7 +43,7 @@ class TableStructurer(object):
         self.preprocess_op = create_operators(pre_process_list)
         self.postprocess_op = build_post_process(postprocess_params)
         
-        sess = ort.InferenceSession(os.environ['MODEL_PATH'] + 'table_sim.onnx', providers=['CPUExecutionProvider']) #, sess_options=sess_options, providers=[("CUDAExecutionProvider", {"cudnn_conv_algo_search": "DEFAULT"})]
+        sess = ort.InferenceSession(os.environ['MODEL_PATH'] + 'table_sim.onnx', sess_options=get_session_options(), providers=['CPUExecutionProvider']) #, sess_options=sess_options, providers=[("CUDAExecutionProvider", {"cudnn_conv_algo_search": "DEFAULT"})]
         _ = sess.run(None, {'x': np.zeros((1, 3, 488, 488), dtype='float32')})
         self.predictor, self.input_tensor, self.output_tensors, self.config = sess, sess.get_inputs()[0], None, None
 
@@ -96,21 +93,54 @@ class TableSystem(object):
         self.text_detector = text_detector
         self.text_recognizer = text_recognizer
 
-        self.table_structurer = TableStructurer()
+        # Created on the first table
+        self._table_structurer = None
+        self._table_structurer_lock = threading.Lock()
         self.match = TableMatch(filter_ocr_result=True)
 
+    @property
+    def table_structurer(self):
+        if self._table_structurer is None:
+            with self._table_structurer_lock:
+                if self._table_structurer is None:
+                    self._table_structurer = TableStructurer()
+        return self._table_structurer
+
     def __call__(self, img, return_ocr_result_in_table=False, lang='ch'):
-        result = dict()
+        prepared = self.prepare(img, lang)
+        tic = time.time()
+        rec_res = self.text_recognizer[lang](prepared['img_crop_list'])
+        prepared['time_dict']['rec'] = time.time() - tic
+        return self.finish(prepared, rec_res, return_ocr_result_in_table)
+
+    def prepare(self, img, lang='ch'):
+        """
+        Runs the table structure model and the text detection. The returned
+        text crops are recognized by the caller, possibly batched with the
+        crops of other regions, and passed to finish.
+        """
         time_dict = {'det': 0, 'rec': 0, 'table': 0, 'all': 0, 'match': 0}
         start = time.time()
         structure_res, elapse = self._structure(copy.deepcopy(img))
-        result['cell_bbox'] = structure_res[1].tolist()
         time_dict['table'] = elapse
 
-        dt_boxes, rec_res, det_elapse, rec_elapse = self._ocr(
-            copy.deepcopy(img), lang)
-        time_dict['det'] = det_elapse
-        time_dict['rec'] = rec_elapse
+        tic = time.time()
+        dt_boxes, img_crop_list = self._det(copy.deepcopy(img), lang)
+        time_dict['det'] = time.time() - tic
+        return {
+            'structure_res': structure_res,
+            'dt_boxes': dt_boxes,
+            'img_crop_list': img_crop_list,
+            'time_dict': time_dict,
+            'start': start,
+        }
+
+    def finish(self, prepared, rec_res, return_ocr_result_in_table=False):
+        result = dict()
+        time_dict = prepared['time_dict']
+        structure_res = prepared['structure_res']
+        dt_boxes = prepared['dt_boxes']
+        result['cell_bbox'] = structure_res[1].tolist()
 
         if return_ocr_result_in_table:
             result['boxes'] = [x.tolist() for x in dt_boxes]
@@ -122,7 +152,7 @@ class TableSystem(object):
         time_dict['match'] = toc - tic
         result['html'] = pred_html
         end = time.time()
-        time_dict['all'] = end - start
+        time_dict['all'] = end - prepared['start']
         return result, time_dict
 
     def _structure(self, img):
@@ -130,6 +160,12 @@ class TableSystem(object):
         return structure_res, elapse
 
     def _ocr(self, img, lang):
+        dt_boxes, img_crop_list = self._det(img, lang)
+        rec_res = self.text_recognizer[lang](img_crop_list)
+
+        return dt_boxes, rec_res, 0, 0
+
+    def _det(self, img, lang):
         h, w = img.shape[:2]
         dt_boxes = self.text_detector[lang](copy.deepcopy(img))
         dt_boxes = sorted_boxes(dt_boxes)
@@ -144,15 +180,11 @@ class TableSystem(object):
             r_boxes.append(box)
         dt_boxes = np.array(r_boxes)
 
-        if dt_boxes is None:
-            return None, None
-
         img_crop_list = []
         for i in range(len(dt_boxes)):
             det_box = dt_boxes[i]
             x0, y0, x1, y1 = expand(2, det_box, img.shape)
             text_rect = img[int(y0):int(y1), int(x0):int(x1), :]
             img_crop_list.append(text_rect)
-        rec_res = self.text_recognizer[lang](img_crop_list)
 
-        return dt_boxes, rec_res, 0, 0
\ No newline at end of file
+        return dt_boxes, img_crop_list
@@ -2,6 +2,7 @@
 # -*- coding:utf-8 -*-
 # Copyright (c) Megvii Inc. All rights reserved.
 import os
+import threading
 
 import cv2
 import numpy as np
@@ -166,14 +167,41 @@ def check_and_read(img_path):
         imgs = []
         with fitz.open(img_path) as pdf:
             for pg in range(0, pdf.page_count):
-                page = pdf[pg]
-                mat = fitz.Matrix(3, 3)
-                pm = page.get_pixmap(matrix=mat, alpha=False)
+                yield render_pdf_page(pdf[pg])
 
-                # if width or height > 2000 pixels, don't enlarge the image
-                # if pm.width > 2000 or pm.height > 2000:
-                #     pm = page.get_pixmap(matrix=fitz.Matrix(1, 1), alpha=False)
 
-                img = Image.frombytes("RGB", [pm.width, pm.height], pm.samples)
-                img = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
-                yield img
+def render_pdf_page(page, zoom=3):
+    import fitz
+    from PIL import Image
+
+    mat = fitz.Matrix(zoom, zoom)
+    pm = page.get_pixmap(matrix=mat, alpha=False)
+
+    # if width or height > 2000 pixels, don't enlarge the image
+    # if pm.width > 2000 or pm.height > 2000:
+    #     pm = page.get_pixmap(matrix=fitz.Matrix(1, 1), alpha=False)
+
+    img = Image.frombytes("RGB", [pm.width, pm.height], pm.samples)
+    img = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
+    return img
+
+
+# PyMuPDF shares one global MuPDF context and is not thread safe, even with
+# a separate document per thread
+_fitz_lock = threading.Lock()
+
+
+def get_pdf_page_count(pdf_path):
+    import fitz
+
+    with _fitz_lock, fitz.open(pdf_path) as pdf:
+        return pdf.page_count
+
+
+def read_pdf_page(pdf_path, page_index, zoom=3):
+    """Rasterize a single pdf page. Callers may run on several threads, the
+    rendering itself is serialized by _fitz_lock."""
+    import fitz
+
+    with _fitz_lock, fitz.open(pdf_path) as pdf:
+        return render_pdf_page(pdf[page_index], zoom)